@@ -0,0 +1,89 @@
+import os
+import re
+
+DEFAULT_ACCOUNT = "default"
+DEFAULT_TOKEN_ENV = "GOOGLE_TOKEN_JSON"
+# Mailbox-independent directives an account may inherit from the shared folder.
+# Label maps and Drive config hold per-mailbox IDs, so they are never inherited.
+SHARED_DIRECTIVES = ('gmail_instructions.md', 'gmail_rules.md')
+
+_ACCOUNT_LINE = re.compile(r'^\s*-\s*\*\*(?P<account_id>[A-Za-z0-9_-]+)\*\*\s*:\s*(?P<fields>.*)$')
+_FIELD = re.compile(r'(\w+)\s+`([^`]+)`')
+
+
+class Account:
+    """One mailbox: its credentials, directives folder and state folder."""
+
+    def __init__(self, account_id, email=None, token_env=None, directives_dir="/root/directives", state_dir="/root/state"):
+        self.account_id = account_id
+        self.email = email.lower() if email else None
+        self.token_env = token_env or (
+            DEFAULT_TOKEN_ENV if account_id == DEFAULT_ACCOUNT
+            else f"{DEFAULT_TOKEN_ENV}_{account_id.upper().replace('-', '_')}"
+        )
+        self.shared_directives_dir = directives_dir
+        self.state_dir = state_dir
+        if account_id != DEFAULT_ACCOUNT:
+            self.directives_dir = os.path.join(directives_dir, "accounts", account_id)
+            self.state_dir = os.path.join(state_dir, "accounts", account_id)
+        else:
+            self.directives_dir = directives_dir
+
+    def __repr__(self):
+        return f"Account({self.account_id!r}, email={self.email!r})"
+
+    def token_json(self):
+        return os.environ.get(self.token_env)
+
+    def directive(self, name):
+        """Path of a directive file, falling back to the shared copy for mailbox-independent ones."""
+        path = os.path.join(self.directives_dir, name)
+        if name in SHARED_DIRECTIVES and not os.path.exists(path):
+            return os.path.join(self.shared_directives_dir, name)
+        return path
+
+
+def parse_accounts(text):
+    """Parses the `## Accounts` section of accounts.md into (account_id, {field: value}) pairs."""
+    entries = []
+    in_accounts = False
+    for line in text.splitlines():
+        if line.startswith('#'):
+            in_accounts = line.lstrip('#').strip().lower() == 'accounts'
+            continue
+        if not in_accounts:
+            continue
+        match = _ACCOUNT_LINE.match(line)
+        if match:
+            entries.append((match.group('account_id'), dict(_FIELD.findall(match.group('fields')))))
+    return entries
+
+
+def load_accounts(directives_dir="/root/directives", state_dir="/root/state"):
+    """Accounts from directives/accounts.md; without a registry, the single legacy mailbox."""
+    try:
+        with open(os.path.join(directives_dir, "accounts.md"), "r") as f:
+            entries = parse_accounts(f.read())
+    except FileNotFoundError:
+        entries = []
+    except Exception as e:
+        print(f"Error reading account registry: {e}")
+        entries = []
+    if not entries:
+        return [Account(DEFAULT_ACCOUNT, directives_dir=directives_dir, state_dir=state_dir)]
+    return [
+        Account(account_id, email=fields.get('email'), token_env=fields.get('token'),
+                directives_dir=directives_dir, state_dir=state_dir)
+        for account_id, fields in entries
+    ]
+
+
+def find_account(accounts, email_address):
+    """The account for a push notification's mailbox; a lone unaddressed account takes everything."""
+    email_address = (email_address or '').lower()
+    for account in accounts:
+        if account.email == email_address:
+            return account
+    if len(accounts) == 1 and not accounts[0].email:
+        return accounts[0]
+    return None
@@ -0,0 +1,210 @@
+import time
+import sqlite3
+import contextlib
+import hashlib
+import threading
+
+SHORTCUT_MIME_TYPE = 'application/vnd.google-apps.shortcut'
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def sha256_of(reader, chunk_size=HASH_CHUNK_BYTES):
+    """Hashes a seekable reader in chunks and rewinds it."""
+    digest = hashlib.sha256()
+    reader.seek(0)
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    reader.seek(0)
+    return digest.hexdigest()
+
+
+class AttachmentIndex:
+    """Content-addressed index of attachments already saved to Drive.
+
+    SHA-256 -> Drive file ID is kept in SQLite on the state volume and
+    mirrored on the Drive file itself as appProperties.sha256, so the
+    index can be rebuilt from Drive after the local copy is lost: the first
+    local miss for a folder lists that folder once, and later misses are
+    answered locally. Gmail part
+    metadata (filename, size, MIME type) is also remembered per blob. When
+    `trust_metadata` is set, a metadata match skips even the download.
+    """
+
+    def __init__(self, path, trust_metadata=False, shortcuts=True):
+        self.trust_metadata = trust_metadata
+        self.shortcuts = shortcuts
+        self.skipped_bytes = 0
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._claims = {}
+        self._mirror_locks = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " sha256 TEXT PRIMARY KEY,"
+            " file_id TEXT NOT NULL,"
+            " folder_id TEXT,"
+            " size INTEGER,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS part_metadata ("
+            " filename TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mime_type TEXT NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " PRIMARY KEY (filename, size, mime_type))"
+        )
+        # Folders whose Drive copies are in `blobs`; emptied along with the index when the volume is reset
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS mirrored_folders ("
+            " folder_id TEXT PRIMARY KEY,"
+            " loaded_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def part_key(part):
+        return (
+            (part.get('filename') or '').lower(),
+            int(part.get('body', {}).get('size') or 0),
+            (part.get('mimeType') or '').lower(),
+        )
+
+    @contextlib.contextmanager
+    def claim(self, digest):
+        """Per-content lock, so two messages carrying the same file upload it only once."""
+        with self._lock:
+            entry = self._claims.setdefault(digest, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._claims[digest]
+
+    def lookup_metadata(self, part):
+        """Returns the sha256 of a known blob with identical Gmail part metadata, if trusted."""
+        if not self.trust_metadata:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256 FROM part_metadata WHERE filename = ? AND size = ? AND mime_type = ?",
+                self.part_key(part)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _forget(self, digest):
+        with self._lock:
+            self._conn.execute("DELETE FROM blobs WHERE sha256 = ?", (digest,))
+            self._conn.execute("DELETE FROM part_metadata WHERE sha256 = ?", (digest,))
+            self._conn.commit()
+
+    def find(self, drive_service, digest, folder_id=None):
+        """Returns (file_id, folder_id) of a live Drive copy of this content, or None.
+
+        On a local miss, `folder_id`'s Drive copies are loaded into the index
+        if they never were (e.g. after the volume was reset).
+        """
+        row = self._row(digest)
+        if not row and folder_id and self._load_mirror(drive_service, folder_id):
+            row = self._row(digest)
+        if not row:
+            return None
+        try:
+            existing = drive_service.files().get(fileId=row[0], fields='id, trashed').execute()
+            if not existing.get('trashed'):
+                return row[0], row[1]
+        except Exception as e:
+            print(f"Known attachment {row[0]} unavailable ({e}), will re-upload.")
+        self._forget(digest)
+        return None
+
+    def _row(self, digest):
+        with self._lock:
+            return self._conn.execute("SELECT file_id, folder_id FROM blobs WHERE sha256 = ?", (digest,)).fetchone()
+
+    def _load_mirror(self, drive_service, folder_id):
+        """Indexes the hashed files in a Drive folder, once. Returns True if anything new was loaded."""
+        with self._lock:
+            folder_lock = self._mirror_locks.setdefault(folder_id, threading.Lock())
+        with folder_lock:
+            with self._lock:
+                if self._conn.execute("SELECT 1 FROM mirrored_folders WHERE folder_id = ?", (folder_id,)).fetchone():
+                    return False
+            loaded, page_token = 0, None
+            try:
+                while True:
+                    results = drive_service.files().list(
+                        q=f"'{folder_id}' in parents and trashed=false",
+                        spaces='drive', fields='nextPageToken, files(id, size, appProperties)', pageSize=1000,
+                        pageToken=page_token
+                    ).execute()
+                    with self._lock:
+                        for found in results.get('files', []):
+                            digest = (found.get('appProperties') or {}).get('sha256')
+                            if digest:
+                                loaded += self._conn.execute(
+                                    "INSERT OR IGNORE INTO blobs (sha256, file_id, folder_id, size, created_at)"
+                                    " VALUES (?, ?, ?, ?, ?)",
+                                    (digest, found['id'], folder_id, int(found.get('size') or 0), time.time())
+                                ).rowcount
+                    page_token = results.get('nextPageToken')
+                    if not page_token:
+                        break
+            except Exception as e:
+                print(f"Drive hash lookup failed for folder {folder_id}: {e}")
+                with self._lock:
+                    self._conn.commit()
+                return loaded > 0
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO mirrored_folders (folder_id, loaded_at) VALUES (?, ?)", (folder_id, time.time())
+                )
+                self._conn.commit()
+            if loaded:
+                print(f"Indexed {loaded} existing attachments from Drive folder {folder_id}.")
+            return loaded > 0
+
+    def link(self, drive_service, file_id, folder_id, file_metadata, size=0):
+        """Reuses an existing blob: nothing to do in its own folder, a shortcut anywhere else."""
+        with self._lock:
+            self.duplicates += 1
+            self.skipped_bytes += size
+        target_parents = file_metadata.get('parents') or []
+        if not self.shortcuts or not target_parents or folder_id in target_parents:
+            return file_id, 'duplicate'
+        shortcut = drive_service.files().create(body={
+            'name': file_metadata['name'],
+            'mimeType': SHORTCUT_MIME_TYPE,
+            'parents': target_parents,
+            'shortcutDetails': {'targetId': file_id},
+        }, fields='id').execute()
+        return shortcut.get('id'), 'shortcut'
+
+    def record(self, digest, file_id, folder_id, size, part=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blobs (sha256, file_id, folder_id, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                (digest, file_id, folder_id, size, time.time())
+            )
+            if part is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO part_metadata (filename, size, mime_type, sha256) VALUES (?, ?, ?, ?)",
+                    self.part_key(part) + (digest,)
+                )
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            return {'duplicates': self.duplicates, 'skipped_mb': round(self.skipped_bytes / (1024 * 1024), 2)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,200 @@
+import io
+import os
+import time
+import base64
+import resource
+import contextlib
+import threading
+
+from googleapiclient.errors import HttpError  # type: ignore
+from googleapiclient.http import MediaIoBaseUpload  # type: ignore
+
+from attachment_dedup import sha256_of
+
+MB = 1024 * 1024
+# Drive resumable upload chunks must be multiples of 256 KiB
+UPLOAD_CHUNK_ALIGN = 256 * 1024
+
+DEFAULT_CHUNK_BYTES = 8 * MB
+DEFAULT_SINGLE_SHOT_BYTES = 5 * MB
+DEFAULT_INFLIGHT_BYTES = 64 * MB
+
+
+class ByteBudget:
+    """Caps the attachment bytes held in memory across all concurrent transfers.
+
+    A transfer larger than the whole budget is still let through once nothing
+    else is in flight, so oversized attachments don't deadlock.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_INFLIGHT_BYTES):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n):
+        with self._cond:
+            while self.in_flight and self.in_flight + n > self.max_bytes:
+                self._cond.wait()
+            self.in_flight += n
+
+    def release(self, n):
+        with self._cond:
+            self.in_flight -= n
+            self._cond.notify_all()
+
+
+class Base64Reader(io.RawIOBase):
+    """Seekable file object that decodes a urlsafe base64 span on demand.
+
+    The base64 text stays in memory; only the requested window is decoded, so
+    a resumable upload never holds the full decoded attachment next to it.
+    """
+
+    def __init__(self, buffer, start, end):
+        self._data = memoryview(buffer)[start:end]
+        encoded = end - start
+        while encoded and self._data[encoded - 1] == ord('='):
+            encoded -= 1
+        self._encoded = encoded
+        self.size = encoded * 3 // 4
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(0, min(offset, self.size))
+        return self._pos
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self._pos
+        n = min(n, self.size - self._pos)
+        if n <= 0:
+            return b""
+        # Decode whole 4-char groups covering [pos, pos + n)
+        group_start = self._pos // 3
+        group_end = (self._pos + n + 2) // 3
+        chunk = bytes(self._data[group_start * 4:min(group_end * 4, self._encoded)])
+        decoded = base64.urlsafe_b64decode(chunk + b"=" * (-len(chunk) % 4))
+        skip = self._pos - group_start * 3
+        out = decoded[skip:skip + n]
+        self._pos += len(out)
+        return out
+
+
+def fetch_attachment_raw(gmail_service, msg_id, att_id):
+    """Returns (raw_json_bytes, start, end) where [start, end) is the base64 `data` span.
+
+    The whole JSON response (about 4/3 of the attachment) is read into memory;
+    callers reserve that much from a ByteBudget. It is kept as bytes rather
+    than parsed, which avoids a second full-size copy as a Python string.
+    """
+    request = gmail_service.users().messages().attachments().get(userId='me', messageId=msg_id, id=att_id)
+    request.postproc = lambda resp, content: content
+    raw = request.execute()
+    key = raw.find(b'"data"')
+    start = raw.find(b'"', raw.find(b':', key) + 1) + 1 if key != -1 else 0
+    end = raw.find(b'"', start) if start else -1
+    if key == -1 or end == -1:
+        raise ValueError(f"Attachment {att_id} response has no data field")
+    return raw, start, end
+
+
+def transfer_attachment(gmail_service, drive_service, msg_id, part, file_metadata, budget=None,
+                        chunk_size=DEFAULT_CHUNK_BYTES, single_shot_limit=DEFAULT_SINGLE_SHOT_BYTES,
+                        on_parent_missing=None, dedup=None):
+    """Streams one Gmail attachment into Drive. Returns (file_id, stats).
+
+    Attachments up to `single_shot_limit` go up in one multipart request;
+    larger ones use a chunked resumable session fed straight from the base64
+    text. `on_parent_missing(parent_id)` may return a replacement parent when
+    Drive answers 404 for the target folder. With a `dedup` AttachmentIndex,
+    content already in Drive is linked instead of uploaded again.
+    """
+    chunk_size = max(UPLOAD_CHUNK_ALIGN, chunk_size - chunk_size % UPLOAD_CHUNK_ALIGN)
+    mimetype = part.get('mimeType') or 'application/octet-stream'
+    expected = int(part.get('body', {}).get('size') or 0)
+    # Base64 text is ~4/3 of the decoded size; that is what sits in memory
+    reserved = expected * 4 // 3 + chunk_size
+    started = time.perf_counter()
+
+    def timing(size, mode, held=0):
+        elapsed = time.perf_counter() - started
+        return {
+            'bytes': size,
+            'seconds': round(elapsed, 3),
+            'mb_per_s': round(size / MB / elapsed, 2) if elapsed else 0.0,
+            'mode': mode,
+            'peak_buffer_mb': round(held / MB, 2),
+            # ru_maxrss is in KiB on Linux
+            'process_max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+    # Part metadata alone can identify a known blob, skipping the download entirely
+    if dedup:
+        known_digest = dedup.lookup_metadata(part)
+        existing = dedup.find(drive_service, known_digest) if known_digest else None
+        if existing:
+            file_id, mode = dedup.link(drive_service, existing[0], existing[1], file_metadata, expected)
+            return file_id, timing(expected, mode)
+
+    if budget:
+        budget.acquire(reserved)
+    try:
+        raw, start, end = fetch_attachment_raw(gmail_service, msg_id, part['body']['attachmentId'])
+        reader = Base64Reader(raw, start, end)
+        single_shot = reader.size <= single_shot_limit
+
+        digest = None
+        claim = contextlib.nullcontext()
+        if dedup:
+            digest = sha256_of(reader)
+            claim = dedup.claim(digest)
+
+        with claim:
+            if dedup:
+                existing = dedup.find(drive_service, digest, (file_metadata.get('parents') or [None])[0])
+                if existing:
+                    file_id, mode = dedup.link(drive_service, existing[0], existing[1], file_metadata, reader.size)
+                    return file_id, timing(reader.size, mode, len(raw))
+                file_metadata.setdefault('appProperties', {})['sha256'] = digest
+
+            def upload():
+                reader.seek(0)
+                if single_shot:
+                    media = MediaIoBaseUpload(io.BytesIO(reader.read()), mimetype=mimetype, resumable=False)
+                else:
+                    media = MediaIoBaseUpload(reader, mimetype=mimetype, chunksize=chunk_size, resumable=True)
+                return drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+
+            try:
+                created = upload()
+            except HttpError as e:
+                parents = file_metadata.get('parents') or []
+                if e.resp.status != 404 or not on_parent_missing or not parents:
+                    raise
+                replacement = on_parent_missing(parents[0])
+                if not replacement or replacement == parents[0]:
+                    raise
+                file_metadata['parents'] = [replacement]
+                created = upload()
+
+            if dedup:
+                dedup.record(digest, created.get('id'), (file_metadata.get('parents') or [None])[0], reader.size, part)
+        held = len(raw) + (reader.size if single_shot else chunk_size)
+        return created.get('id'), timing(reader.size, 'single-shot' if single_shot else 'resumable', held)
+    finally:
+        if budget:
+            budget.release(reserved)
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import contextlib
+
+import gmail_bot
+import telemetry
+from accounts import Account
+from rate_limits import backend_stats, reset_backends
+from fake_services import (AI_PROCESSED_LABEL_ID, CallStats, Faults, FakeDrive, FakeGmail, FakeLLM,
+                           generate_mailbox)
+
+BENCH_ACCOUNT = "bench"
+BENCH_TOKEN_ENV = "GOOGLE_TOKEN_JSON_BENCH"
+REPO_DIRECTIVES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "directives")
+# Pipeline settings for the one-message-at-a-time baseline
+SEQUENTIAL_ENV = {"PIPELINE_CONCURRENCY": "1", "GMAIL_BATCH_SIZE": "1", "LLM_BATCH_SIZE": "1", "DRAFT_CONCURRENCY": "1"}
+# Report fields compared against a baseline: (path, True when higher is better)
+COMPARED_METRICS = [
+    (('msgs_per_s',), True),
+    (('latency_ms', 'p95'), False),
+    (('api_totals', 'gmail'), False),
+    (('api_totals', 'drive'), False),
+    (('api_totals', 'llm'), False),
+    (('llm_tokens', 'total'), False),
+    (('peak_rss_mb',), False),
+]
+
+
+class NullVolume:
+    def commit(self):
+        pass
+
+    def reload(self):
+        pass
+
+
+class RunProbe:
+    """Records each message's latency and the category it was acted on as.
+
+    Latency runs from prepare (the first touch after the fetch) to the end of its actions.
+    """
+
+    def __init__(self):
+        self.started = {}
+        self.latencies = []
+        self.categories = {}
+        self._lock = threading.Lock()
+
+    def wrap_start(self, fn):
+        def wrapped(msg_id, *args, **kwargs):
+            with self._lock:
+                self.started.setdefault(msg_id, time.perf_counter())
+            return fn(msg_id, *args, **kwargs)
+        return wrapped
+
+    def wrap_end(self, fn):
+        def wrapped(email, category, *args, **kwargs):
+            result = fn(email, category, *args, **kwargs)
+            with self._lock:
+                self.categories[email['subject']] = category
+                started = self.started.get(email['id'])
+                if started is not None:
+                    self.latencies.append(time.perf_counter() - started)
+            return result
+        return wrapped
+
+    def percentiles(self):
+        values = sorted(self.latencies)
+        if not values:
+            return {'p50': None, 'p95': None, 'max': None}
+
+        def pick(q):
+            return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 1)
+        return {'p50': pick(0.5), 'p95': pick(0.95), 'max': round(values[-1] * 1000, 1)}
+
+
+@contextlib.contextmanager
+def patched(module, **attrs):
+    saved = {name: getattr(module, name) for name in attrs}
+    for name, value in attrs.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+@contextlib.contextmanager
+def environment(values):
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def write_bench_directives(account, drive_root_id):
+    os.makedirs(account.directives_dir, exist_ok=True)
+    with open(account.directive("gmail_labels.md"), "w") as f:
+        f.write(f"# Gmail Label Map\n\n- **INBOX**: `INBOX`\n- **UNREAD**: `UNREAD`\n- **AI Processed**: `{AI_PROCESSED_LABEL_ID}`\n")
+    with open(account.directive("drive_config.md"), "w") as f:
+        f.write(f"# Google Drive Configuration\n\n**Root_Folder_ID**: `{drive_root_id}`\n")
+    # Instructions and rules come from the repo, so the run exercises the real rule set
+    for name in ("gmail_instructions.md", "gmail_rules.md"):
+        source = os.path.join(REPO_DIRECTIVES, name)
+        if os.path.exists(source):
+            shutil.copy(source, os.path.join(account.directives_dir, name))
+
+
+def classification_accuracy(categories, truth):
+    """Fraction of acted-on messages whose category matches the mailbox's ground truth."""
+    if not categories:
+        return None
+    correct = sum(1 for subject, category in categories.items() if truth.get(subject, '').lower() == category.lower())
+    return round(correct / len(categories), 3)
+
+
+def run_benchmark(messages=500, seed=7, gmail_ms=40.0, drive_ms=80.0, llm_ms=400.0, jitter=0.3, error_rate=0.0,
+                  rate_limit_rate=0.0, retry_after=1, attachment_rate=0.2, duplicate_rate=0.3, env=None, log=None):
+    """Runs one full tick of the real pipeline against in-memory Gmail, Drive and LLM stand-ins.
+
+    Returns a report dict: throughput, per-message latency, API calls per
+    backend and method, LLM tokens, peak RSS and rate limiter counters.
+    """
+    mailbox = generate_mailbox(messages, seed=seed, attachment_rate=attachment_rate, duplicate_rate=duplicate_rate)
+    stats = CallStats()
+
+    def faults(latency_ms, offset):
+        return Faults(latency_ms, jitter, error_rate, rate_limit_rate, retry_after, seed=seed + offset)
+
+    gmail = FakeGmail(mailbox, faults(gmail_ms, 1), stats)
+    drive = FakeDrive(faults(drive_ms, 2), stats)
+    llm = FakeLLM(mailbox.truth, faults(llm_ms, 3), stats)
+    creds = object()
+    probe = RunProbe()
+
+    tmp = tempfile.mkdtemp(prefix="gmail-bot-bench-")
+    account = Account(BENCH_ACCOUNT, token_env=BENCH_TOKEN_ENV, directives_dir=os.path.join(tmp, "directives"),
+                      state_dir=os.path.join(tmp, "state"))
+    write_bench_directives(account, drive.root_id)
+
+    run_env = {BENCH_TOKEN_ENV: "{}", "GMAIL_PUBSUB_TOPIC": ""}
+    run_env.update(env or {})
+    reset_backends()
+    try:
+        with environment(run_env), patched(
+            gmail_bot,
+            get_google_clients=lambda token_json, state_dir=None: (creds, gmail, drive),
+            worker_services=lambda c: contextlib.nullcontext((gmail, drive)),
+            get_llm_client=lambda: (llm, "bench-model"),
+            credentials_scope=lambda c: gmail.scope,
+            state_volume=NullVolume(),
+            prepare_email=probe.wrap_start(gmail_bot.prepare_email),
+            act_on_email=probe.wrap_end(gmail_bot.act_on_email),
+        ), open(os.devnull, "w") as devnull, contextlib.redirect_stdout(log or devnull):
+            started = time.perf_counter()
+            gmail_bot.run_tick(account)
+            seconds = time.perf_counter() - started
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    processed = sum(1 for msg in gmail.messages.values() if AI_PROCESSED_LABEL_ID in msg['labelIds'])
+    report = {
+        'messages': messages,
+        'processed': processed,
+        'seconds': round(seconds, 2),
+        'msgs_per_s': round(processed / seconds, 2) if seconds else 0.0,
+        'latency_ms': probe.percentiles(),
+        'accuracy': classification_accuracy(probe.categories, mailbox.truth),
+        'drafts': len(gmail.drafts),
+        'uploaded_mb': round(drive.uploaded_bytes / 1024 / 1024, 2),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'rate_limits': backend_stats(gmail.scope),
+        'settings': {
+            'seed': seed, 'gmail_ms': gmail_ms, 'drive_ms': drive_ms, 'llm_ms': llm_ms, 'jitter': jitter,
+            'error_rate': error_rate, 'rate_limit_rate': rate_limit_rate, 'env': env or {},
+        },
+    }
+    report.update(stats.report())
+    summary = telemetry.last_summary() or {}
+    report['stages'] = summary.get('stages', {})
+    report['classify_rates'] = {k: v for k, v in summary.get('rates', {}).items() if k.startswith('classify.')}
+    return report
+
+
+def compare_reports(current, baseline, tolerance=0.1):
+    """Returns a description of every compared metric that got worse than `tolerance` (a fraction)."""
+    regressions = []
+    for path, higher_is_better in COMPARED_METRICS:
+        now, before = current, baseline
+        for key in path:
+            now = now.get(key) if isinstance(now, dict) else None
+            before = before.get(key) if isinstance(before, dict) else None
+        if not now or not before:
+            continue
+        change = (now - before) / before
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f"{'.'.join(path)}: {before} -> {now} ({change:+.0%})")
+    return regressions
+
+
+def main(argv=None):
+    """Offline benchmark: one tick over a synthetic mailbox with fake Gmail, Drive and LLM backends."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--gmail-ms", type=float, default=40.0, help="mean Gmail request latency")
+    parser.add_argument("--drive-ms", type=float, default=80.0, help="mean Drive request latency")
+    parser.add_argument("--llm-ms", type=float, default=400.0, help="mean LLM completion latency")
+    parser.add_argument("--jitter", type=float, default=0.3, help="latency standard deviation, as a fraction of the mean")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with a 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls failing with a 429")
+    parser.add_argument("--attachment-rate", type=float, default=0.2)
+    parser.add_argument("--duplicate-rate", type=float, default=0.3, help="fraction of attachments that repeat earlier content")
+    parser.add_argument("--sequential", action="store_true", help="one message at a time (no batching or concurrency)")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="extra bot setting for the run")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed regression, as a fraction")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own log")
+    args = parser.parse_args(argv)
+
+    env = dict(SEQUENTIAL_ENV) if args.sequential else {}
+    env.update(item.split("=", 1) for item in args.env)
+    report = run_benchmark(
+        args.messages, args.seed, args.gmail_ms, args.drive_ms, args.llm_ms, args.jitter, args.error_rate,
+        args.rate_limit_rate, attachment_rate=args.attachment_rate, duplicate_rate=args.duplicate_rate, env=env,
+        log=sys.stderr if args.verbose else None
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare_reports(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Regression: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions against baseline.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import queue
+import hashlib
+import threading
+import contextlib
+
+import httplib2  # type: ignore
+import google_auth_httplib2  # type: ignore
+from google.oauth2.credentials import Credentials  # type: ignore
+from googleapiclient.discovery import build  # type: ignore
+
+from rate_limits import throttled_request_class
+
+# Long-lived clients are kept at module level so a warm container reuses them
+# across invocations instead of rebuilding them every tick.
+_lock = threading.Lock()
+_google_clients = {}
+_llm_clients = {}
+# Account scope -> Queue of idle (gmail, drive) pairs checked out by worker threads
+_worker_pools = {}
+
+TOKEN_CACHE_FILE = "google_token_cache.json"
+
+
+def build_service(name, version, creds, scope=None):
+    # Static discovery documents ship with google-api-python-client: no network fetch at startup.
+    # Every request goes through the quota scheduler of the account (`scope`) it belongs to.
+    return build(name, version, credentials=creds, static_discovery=True, cache_discovery=False,  # type: ignore
+                 requestBuilder=throttled_request_class(scope))
+
+
+def _token_key(info):
+    return hashlib.sha256(info.get('refresh_token', '').encode('utf-8')).hexdigest()[:16]
+
+
+def credentials_scope(creds):
+    """Stable per-account key (hash of the refresh token) used to isolate quota budgets."""
+    return _token_key({'refresh_token': creds.refresh_token or ''})
+
+
+def _read_token_cache(state_dir, key):
+    if not state_dir:
+        return None
+    try:
+        with open(os.path.join(state_dir, TOKEN_CACHE_FILE), "r") as f:
+            return json.load(f).get(key)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error reading token cache: {e}")
+        return None
+
+
+def _write_token_cache(state_dir, key, creds):
+    if not state_dir:
+        return
+    path = os.path.join(state_dir, TOKEN_CACHE_FILE)
+    try:
+        try:
+            with open(path, "r") as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            cache = {}
+        refreshed = json.loads(creds.to_json())
+        cache[key] = {'token': refreshed.get('token'), 'expiry': refreshed.get('expiry')}
+        os.makedirs(state_dir, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(path + ".tmp", path)
+    except Exception as e:
+        print(f"Error writing token cache: {e}")
+
+
+def load_credentials(token_json, state_dir=None):
+    """Credentials from GOOGLE_TOKEN_JSON, reusing a still-valid access token cached on the state volume."""
+    info = json.loads(token_json)
+    key = _token_key(info)
+    cached = _read_token_cache(state_dir, key)
+    if cached and cached.get('token') and cached.get('expiry'):
+        info = dict(info, token=cached['token'], expiry=cached['expiry'])
+    creds = Credentials.from_authorized_user_info(info)
+    if not creds.valid:
+        creds.refresh(google_auth_httplib2.Request(httplib2.Http()))
+        _write_token_cache(state_dir, key, creds)
+    return creds
+
+
+def get_google_clients(token_json, state_dir=None):
+    """Returns (creds, gmail_service, drive_service), built once per account per container.
+
+    The shared credentials refresh themselves when the access token expires;
+    refreshed tokens are written back to the state volume for cold containers.
+    """
+    key = _token_key(json.loads(token_json))
+    with _lock:
+        entry = _google_clients.get(key)
+        if entry is None:
+            creds = load_credentials(token_json, state_dir)
+            entry = (creds, build_service('gmail', 'v1', creds, key), build_service('drive', 'v3', creds, key))
+            _google_clients[key] = entry
+        else:
+            creds = entry[0]
+            if not creds.valid:
+                creds.refresh(google_auth_httplib2.Request(httplib2.Http()))
+                _write_token_cache(state_dir, key, creds)
+    return entry
+
+
+@contextlib.contextmanager
+def worker_services(creds):
+    """Checks out a (gmail, drive) pair for the calling thread (httplib2 connections aren't thread-safe).
+
+    Pairs go back to a per-account pool kept for the life of the container, so
+    each tick's worker threads reuse the clients and connections of earlier ticks.
+    """
+    scope = credentials_scope(creds)
+    with _lock:
+        pool = _worker_pools.setdefault(scope, queue.Queue())
+    try:
+        services = pool.get_nowait()
+    except queue.Empty:
+        services = (build_service('gmail', 'v1', creds, scope), build_service('drive', 'v3', creds, scope))
+    try:
+        yield services
+    finally:
+        pool.put(services)
+
+
+def get_llm_client():
+    """Returns (client, model) for the configured OpenAI/Groq key, or (None, None) without one.
+
+    One client (and its pooled HTTP connections) is shared per key for the life of the container.
+    """
+    api_key = os.environ.get("OPENAI_API_KEY") or os.environ.get("GROQ_API_KEY")
+    if not api_key:
+        return None, None
+
+    with _lock:
+        cached = _llm_clients.get(api_key)
+        if cached:
+            return cached
+
+        # Retries are left to the shared scheduler in rate_limits, which honours Retry-After
+        client_kwargs = {"api_key": api_key, "max_retries": 0}
+        model = "gpt-4o-mini"
+        if api_key.startswith("gsk_"):
+            client_kwargs["base_url"] = "https://api.groq.com/openai/v1"
+            model = "llama-3.1-8b-instant"
+
+        from openai import OpenAI  # type: ignore
+        cached = (OpenAI(**client_kwargs), model)  # type: ignore
+        _llm_clients[api_key] = cached
+        return cached
+
+
+def reset_clients():
+    with _lock:
+        _google_clients.clear()
+        _llm_clients.clear()
+        _worker_pools.clear()
+
+
+def benchmark_startup(token_json, state_dir=None, rounds=3):
+    """Times client setup cold (caches cleared) and warm (reused), in milliseconds."""
+    def timed(fn):
+        started = time.perf_counter()
+        fn()
+        return round((time.perf_counter() - started) * 1000, 1)
+
+    report = {}
+    reset_clients()
+    report['credentials_ms'] = timed(lambda: load_credentials(token_json, state_dir))
+    info = json.loads(token_json)
+    report['credentials_forced_refresh_ms'] = timed(
+        lambda: Credentials.from_authorized_user_info(info).refresh(google_auth_httplib2.Request(httplib2.Http()))
+    )
+    creds = load_credentials(token_json, state_dir)
+    report['gmail_static_build_ms'] = timed(lambda: build_service('gmail', 'v1', creds))
+    report['drive_static_build_ms'] = timed(lambda: build_service('drive', 'v3', creds))
+    report['gmail_discovery_build_ms'] = timed(
+        lambda: build('gmail', 'v1', credentials=creds, static_discovery=False, cache_discovery=False)  # type: ignore
+    )
+
+    cold = []
+    warm = []
+    for _ in range(rounds):
+        reset_clients()
+        cold.append(timed(lambda: (get_google_clients(token_json, state_dir), get_llm_client())))
+        warm.append(timed(lambda: (get_google_clients(token_json, state_dir), get_llm_client())))
+    report['cold_setup_ms'] = sorted(cold)[len(cold) // 2]
+    report['warm_setup_ms'] = sorted(warm)[len(warm) // 2]
+    return report
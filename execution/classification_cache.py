@@ -0,0 +1,112 @@
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from email.utils import parseaddr
+
+DEFAULT_TTL_SECONDS = 30 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 50000
+
+# Matches what classify_email actually sends to the model
+BODY_FINGERPRINT_CHARS = 1000
+
+_REPLY_PREFIX = re.compile(r'^\s*((re|fw|fwd|aw|sv)\s*:\s*)+', re.IGNORECASE)
+_DIGITS = re.compile(r'\d+')
+_SPACES = re.compile(r'\s+')
+
+
+def instructions_version(instructions):
+    return hashlib.sha256(instructions.encode('utf-8')).hexdigest()[:16]
+
+
+def subject_template(subject):
+    """Lowercased subject with reply prefixes dropped and numbers replaced, e.g. 'invoice #'."""
+    subject = _REPLY_PREFIX.sub('', subject or '').lower()
+    subject = _DIGITS.sub('#', subject)
+    return _SPACES.sub(' ', subject).strip()
+
+
+def email_fingerprint(sender, subject, body):
+    address = parseaddr(sender or '')[1].lower() or (sender or '').lower()
+    body_text = _SPACES.sub(' ', _DIGITS.sub('#', (body or '')[:BODY_FINGERPRINT_CHARS])).strip()
+    body_hash = hashlib.sha256(body_text.encode('utf-8')).hexdigest()
+    key = "\x1f".join([address, subject_template(subject), body_hash])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class ClassificationCache:
+    """SQLite-backed fingerprint -> category cache with TTL and LRU eviction.
+
+    Entries are tagged with a hash of the instructions text. Opening the cache
+    with different instructions drops every entry made under the old ones.
+    """
+
+    def __init__(self, path, instructions, ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.version = instructions_version(instructions)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS classifications ("
+            " fingerprint TEXT PRIMARY KEY,"
+            " version TEXT NOT NULL,"
+            " category TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON classifications (last_used)")
+        removed = self._conn.execute("DELETE FROM classifications WHERE version != ?", (self.version,)).rowcount
+        self._conn.commit()
+        if removed:
+            print(f"Instructions changed, invalidated {removed} cached classifications.")
+
+    def get(self, fingerprint):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT category, created_at FROM classifications WHERE fingerprint = ? AND version = ?",
+                (fingerprint, self.version)
+            ).fetchone()
+            if row and now - row[1] <= self.ttl_seconds:
+                self._conn.execute("UPDATE classifications SET last_used = ? WHERE fingerprint = ?", (now, fingerprint))
+                self._conn.commit()
+                self.hits += 1
+                return row[0]
+            if row:
+                self._conn.execute("DELETE FROM classifications WHERE fingerprint = ?", (fingerprint,))
+                self._conn.commit()
+            self.misses += 1
+            return None
+
+    def put(self, fingerprint, category):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO classifications (fingerprint, version, category, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (fingerprint, self.version, category, now, now)
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM classifications").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM classifications WHERE fingerprint IN"
+                    " (SELECT fingerprint FROM classifications ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
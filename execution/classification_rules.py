@@ -0,0 +1,133 @@
+import os
+import re
+import fnmatch
+import threading
+from email.utils import parseaddr
+
+RULE_KINDS = ('label', 'domain', 'sender', 'header')
+
+# Rules file path -> (mtime, RuleMatcher), so a warm container only re-parses a changed file
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+_RULE_LINE = re.compile(r'^\s*-\s*\*\*(?P<category>[^*]+)\*\*\s*:\s*(?P<kind>\w+)\s+(?P<values>.*)$')
+
+
+def parse_rules(text):
+    """Parses the `## Rules` section of gmail_rules.md into (priority, category, kind, value) tuples."""
+    rules = []
+    in_rules = False
+    for line in text.splitlines():
+        if line.startswith('#'):
+            in_rules = line.lstrip('#').strip().lower() == 'rules'
+            continue
+        if not in_rules:
+            continue
+        match = _RULE_LINE.match(line)
+        if not match:
+            continue
+        kind = match.group('kind').lower()
+        if kind not in RULE_KINDS:
+            print(f"Ignoring rule with unknown kind '{kind}': {line.strip()}")
+            continue
+        category = match.group('category').strip()
+        for value in re.findall(r'`([^`]+)`', match.group('values')):
+            rules.append((len(rules), category, kind, value.strip()))
+    return rules
+
+
+class RuleMatcher:
+    """Rules compiled into lookup tables so a message is matched without scanning every rule.
+
+    Labels, exact senders, domains and header names are dict lookups. Only
+    wildcard senders are scanned. The lowest priority (earliest line) wins.
+    """
+
+    def __init__(self, rules):
+        self.rule_count = len(rules)
+        self._labels = {}
+        self._senders = {}
+        self._domains = {}
+        self._sender_globs = []
+        self._headers = {}
+        for priority, category, kind, value in rules:
+            if kind == 'label':
+                self._labels.setdefault(value.upper(), (priority, category))
+            elif kind == 'domain':
+                self._domains.setdefault(value.lower().lstrip('@.'), (priority, category))
+            elif kind == 'sender':
+                if '*' in value or '?' in value:
+                    self._sender_globs.append((priority, category, value.lower()))
+                else:
+                    self._senders.setdefault(value.lower(), (priority, category))
+            elif kind == 'header':
+                name, _, needle = value.partition(':')
+                self._headers.setdefault(name.strip().lower(), []).append((priority, category, needle.strip().lower()))
+
+    def __len__(self):
+        return self.rule_count
+
+    def header_names(self):
+        """Header names the rules look at, so a metadata-only fetch can request them."""
+        return list(self._headers)
+
+    def match(self, sender, label_ids=(), headers=()):
+        """Returns the category of the highest-priority matching rule, or None."""
+        candidates = []
+        for label_id in label_ids:
+            hit = self._labels.get(label_id.upper())
+            if hit:
+                candidates.append(hit)
+
+        address = parseaddr(sender or '')[1].lower()
+        if address:
+            hit = self._senders.get(address)
+            if hit:
+                candidates.append(hit)
+            for priority, category, pattern in self._sender_globs:
+                if fnmatch.fnmatchcase(address, pattern):
+                    candidates.append((priority, category))
+            # Walk domain suffixes: billing.stripe.com -> stripe.com -> com
+            domain = address.rpartition('@')[2]
+            while domain:
+                hit = self._domains.get(domain)
+                if hit:
+                    candidates.append(hit)
+                domain = domain.partition('.')[2]
+
+        if self._headers:
+            for header in headers:
+                for priority, category, needle in self._headers.get(header['name'].lower(), ()):
+                    if not needle or needle in header.get('value', '').lower():
+                        candidates.append((priority, category))
+
+        if not candidates:
+            return None
+        return min(candidates)[1]
+
+
+def load_rules(path):
+    try:
+        with open(path, "r") as f:
+            matcher = RuleMatcher(parse_rules(f.read()))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error reading classification rules: {e}")
+        return None
+    print(f"Loaded {len(matcher)} classification rules.")
+    return matcher
+
+
+def get_rules(path):
+    """The compiled rules in `path`, shared by every invocation in the container and rebuilt when the file changes."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _matchers_lock:
+        cached = _matchers.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, load_rules(path))
+            _matchers[path] = cached
+        return cached[1]
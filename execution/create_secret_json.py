@@ -11,6 +11,13 @@ def main():
             "GROQ_API_KEY": os.environ.get("GROQ_API_KEY", "your_groq_api_key_here")
         }
         
+        # Extra mailboxes from directives/accounts.md: token_<account-id>.json -> GOOGLE_TOKEN_JSON_<ACCOUNT_ID>
+        for name in sorted(os.listdir(".")):
+            if name.startswith("token_") and name.endswith(".json"):
+                account_id = name[len("token_"):-len(".json")]
+                with open(name, "r") as f:
+                    secret_data[f"GOOGLE_TOKEN_JSON_{account_id.upper().replace('-', '_')}"] = json.dumps(json.load(f))
+        
         with open("modal_secret.json", "w") as f:
             json.dump(secret_data, f, indent=2)
             
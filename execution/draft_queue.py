@@ -0,0 +1,156 @@
+import time
+import queue
+import sqlite3
+import threading
+
+DEFAULT_MAX_ATTEMPTS = 3
+DONE_RETENTION_SECONDS = 30 * 24 * 3600
+
+
+class DraftQueue:
+    """Durable reply-draft jobs in SQLite (WAL), keyed by Gmail message ID.
+
+    A job is recorded when its message is classified, so the draft survives a
+    crash or a tick that ran out of time and is generated by a later tick.
+    Lower `priority` values are generated first, oldest first within a level.
+    """
+
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS drafts ("
+            " msg_id TEXT PRIMARY KEY,"
+            " thread_id TEXT,"
+            " priority INTEGER NOT NULL DEFAULT 0,"
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " draft_id TEXT,"
+            " last_error TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_drafts_status ON drafts (status, priority, created_at)")
+        self._conn.execute(
+            "DELETE FROM drafts WHERE status != 'pending' AND updated_at < ?",
+            (time.time() - DONE_RETENTION_SECONDS,)
+        )
+        self._conn.commit()
+
+    def enqueue(self, msg_id, thread_id, priority=0):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO drafts (msg_id, thread_id, priority, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (msg_id, thread_id, priority, now, now)
+            )
+            self._conn.commit()
+
+    def pending(self, limit=200):
+        """Returns (priority, created_at, msg_id, thread_id) for jobs still to generate, in order."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT priority, created_at, msg_id, thread_id FROM drafts WHERE status = 'pending'"
+                " ORDER BY priority, created_at LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+    def complete(self, msg_id, draft_id=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE drafts SET status = ?, draft_id = ?, updated_at = ? WHERE msg_id = ?",
+                ('done' if draft_id else 'skipped', draft_id, time.time(), msg_id)
+            )
+            self._conn.commit()
+
+    def fail(self, msg_id, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE drafts SET attempts = attempts + 1, last_error = ?, updated_at = ?,"
+                " status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END WHERE msg_id = ?",
+                (str(error)[:500], time.time(), self.max_attempts, msg_id)
+            )
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM drafts GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DraftWorkers:
+    """Generates queued drafts on their own threads, off the classification critical path.
+
+    `handler(msg_id, thread_id)` creates the draft and returns its ID (or
+    None when no draft is needed). Jobs left over from earlier ticks are
+    picked up on `start`; jobs still queued when `drain` runs out of time stay
+    pending for the next tick.
+    """
+
+    def __init__(self, draft_queue, handler, concurrency=2):
+        self.queue = draft_queue
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.created = 0
+        self._jobs = queue.PriorityQueue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def _put(self, priority, created_at, msg_id, thread_id):
+        with self._lock:
+            if msg_id in self._queued:
+                return
+            self._queued.add(msg_id)
+        self._jobs.put((priority, created_at, msg_id, thread_id))
+
+    def start(self):
+        for job in self.queue.pending():
+            self._put(*job)
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, msg_id, thread_id, priority=0):
+        self.queue.enqueue(msg_id, thread_id, priority)
+        self._put(priority, time.time(), msg_id, thread_id)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                _, _, msg_id, thread_id = self._jobs.get(timeout=0.2)
+            except queue.Empty:
+                if self._closing.is_set():
+                    return
+                continue
+            try:
+                draft_id = self.handler(msg_id, thread_id)
+                self.queue.complete(msg_id, draft_id)
+                if draft_id:
+                    with self._lock:
+                        self.created += 1
+            except Exception as e:
+                print(f"Failed drafting reply for {msg_id}: {e}")
+                self.queue.fail(msg_id, e)
+
+    def drain(self, timeout=None):
+        """Waits for queued jobs, up to `timeout` seconds. Returns the number left for a later tick."""
+        self._closing.set()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        # Out of time: finish in-flight jobs only
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        return self._jobs.qsize()
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import threading
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+FOLDER_INDEX_FILE = "drive_folders.json"
+
+# Re-list the root after this long so folders created by hand are picked up
+DEFAULT_REFRESH_SECONDS = 3600
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class DriveFolderIndex:
+    """Category name -> Drive folder ID for the children of one root folder.
+
+    Filled by a single paginated listing of the root, persisted to the state
+    volume and kept in memory for the life of the container. Creation is
+    single-flight per name, so concurrent messages in the same new category
+    create exactly one folder.
+    """
+
+    def __init__(self, root_id, state_dir=None, refresh_seconds=DEFAULT_REFRESH_SECONDS):
+        self.root_id = root_id
+        self.state_dir = state_dir
+        self.refresh_seconds = refresh_seconds
+        self.listed_at = 0
+        self._folders = {}
+        self._lock = threading.Lock()
+        self._creating = {}
+        self._load()
+
+    def _path(self):
+        return os.path.join(self.state_dir, FOLDER_INDEX_FILE) if self.state_dir else None
+
+    def _load(self):
+        path = self._path()
+        if not path:
+            return
+        try:
+            with open(path, "r") as f:
+                saved = json.load(f).get(self.root_id, {})
+            self._folders = dict(saved.get('folders', {}))
+            self.listed_at = saved.get('listed_at', 0)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error reading Drive folder index: {e}")
+
+    def _save(self):
+        path = self._path()
+        if not path:
+            return
+        try:
+            try:
+                with open(path, "r") as f:
+                    saved = json.load(f)
+            except FileNotFoundError:
+                saved = {}
+            with self._lock:
+                saved[self.root_id] = {'folders': dict(self._folders), 'listed_at': self.listed_at}
+            os.makedirs(self.state_dir, exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(saved, f)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"Error writing Drive folder index: {e}")
+
+    def refresh(self, drive_service, force=False):
+        """Lists every folder under the root in one paginated pass (skipped while the index is fresh)."""
+        if not force and self._folders and time.time() - self.listed_at < self.refresh_seconds:
+            return
+        folders = {}
+        page_token = None
+        query = f"'{self.root_id}' in parents and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+        try:
+            while True:
+                kwargs = {'q': query, 'spaces': 'drive', 'fields': 'nextPageToken, files(id, name)', 'pageSize': 1000}
+                if page_token:
+                    kwargs['pageToken'] = page_token
+                results = drive_service.files().list(**kwargs).execute()
+                for folder in results.get('files', []):
+                    folders.setdefault(folder['name'].lower(), folder['id'])
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+        except Exception as e:
+            print(f"Error listing Drive folders: {e}")
+            return
+        with self._lock:
+            self._folders = folders
+            self.listed_at = time.time()
+        print(f"Indexed {len(folders)} Drive folders under root.")
+        self._save()
+
+    def get(self, folder_name):
+        with self._lock:
+            return self._folders.get(folder_name.lower())
+
+    def get_or_create(self, drive_service, folder_name):
+        key = folder_name.lower()
+        with self._lock:
+            folder_id = self._folders.get(key)
+            if folder_id:
+                return folder_id
+            name_lock = self._creating.setdefault(key, threading.Lock())
+
+        with name_lock:
+            # Another thread may have created it while we waited
+            with self._lock:
+                folder_id = self._folders.get(key)
+            if folder_id:
+                return folder_id
+            try:
+                file_metadata = {
+                    'name': folder_name,
+                    'parents': [self.root_id],
+                    'mimeType': FOLDER_MIME_TYPE
+                }
+                folder = drive_service.files().create(body=file_metadata, fields='id').execute()
+                folder_id = folder.get('id')
+            except Exception as e:
+                print(f"Error creating folder {folder_name}: {e}")
+                return None
+            with self._lock:
+                self._folders[key] = folder_id
+            print(f"Created Drive folder {folder_name} ({folder_id})")
+            self._save()
+            return folder_id
+
+    def invalidate(self, folder_id):
+        """Drops a folder that Drive reported missing (404)."""
+        with self._lock:
+            for name, known_id in list(self._folders.items()):
+                if known_id == folder_id:
+                    del self._folders[name]
+        self._save()
+
+
+def get_folder_index(root_id, state_dir=None):
+    """One index per root folder, shared by every thread and invocation in the container."""
+    with _indexes_lock:
+        index = _indexes.get(root_id)
+        if index is None:
+            index = DriveFolderIndex(root_id, state_dir)
+            _indexes[root_id] = index
+        return index
@@ -0,0 +1,95 @@
+import queue
+import threading
+
+import telemetry
+
+_DONE = object()
+
+# How long a batching stage waits for more items before running a partial batch
+BATCH_WAIT_SECONDS = 0.5
+
+
+def run_pipeline(source, stages, queue_size=0):
+    """Runs items through a chain of stages, each backed by its own queue and worker threads.
+
+    `source` is an iterable consumed on a dedicated feeder thread. `stages` is a
+    list of (name, fn, workers) or (name, fn, workers, batch_size); `fn(item)`
+    returns the item for the next stage, or None to drop it. Batching stages
+    get a list of up to `batch_size` items and return a list of results.
+    A single item moves through the stages in order, so its side effects keep
+    their sequence while different items overlap freely. `queue_size` bounds
+    every queue, giving backpressure on the source.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    first_workers = max(1, stages[0][2])
+
+    def feed():
+        try:
+            for item in source:
+                queues[0].put(item)
+        except Exception as e:
+            print(f"Pipeline source failed: {e}")
+        finally:
+            for _ in range(first_workers):
+                queues[0].put(_DONE)
+
+    def collect(inbox, first, batch_size):
+        """Greedily gathers up to batch_size items. Returns (items, saw_done)."""
+        items = [first]
+        while len(items) < batch_size:
+            try:
+                item = inbox.get(timeout=BATCH_WAIT_SECONDS)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def work(index, name, fn, batch_size):
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(queues) else None
+        done = False
+        while not done:
+            item = inbox.get()
+            if item is _DONE:
+                return
+            try:
+                if batch_size:
+                    items, done = collect(inbox, item, batch_size)
+                    with telemetry.span(f"stage.{name}", batch=len(items)):
+                        results = fn(items) or []
+                else:
+                    with telemetry.span(f"stage.{name}"):
+                        results = [fn(item)]
+            except Exception as e:
+                print(f"Pipeline stage '{name}' failed: {e}")
+                continue
+            if outbox is not None:
+                for result in results:
+                    if result is not None:
+                        outbox.put(result)
+
+    feeder = threading.Thread(target=feed, name="pipeline-feed", daemon=True)
+    feeder.start()
+
+    stage_threads = []
+    for index, stage in enumerate(stages):
+        name, fn, workers = stage[:3]
+        batch_size = stage[3] if len(stage) > 3 else None
+        threads = [
+            threading.Thread(target=work, args=(index, name, fn, batch_size), name=f"pipeline-{name}-{n}", daemon=True)
+            for n in range(max(1, workers))
+        ]
+        for t in threads:
+            t.start()
+        stage_threads.append(threads)
+
+    # Close each stage once everything upstream of it has drained
+    feeder.join()
+    for index, threads in enumerate(stage_threads):
+        for t in threads:
+            t.join()
+        if index + 1 < len(stages):
+            for _ in range(len(stage_threads[index + 1])):
+                queues[index + 1].put(_DONE)
@@ -0,0 +1,553 @@
+import re
+import copy
+import json
+import time
+import base64
+import random
+import threading
+from collections import Counter
+
+import httplib2  # type: ignore
+from googleapiclient.errors import HttpError  # type: ignore
+
+from rate_limits import NON_IDEMPOTENT_METHODS, get_backend, request_costs, throttled_request_class
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+BENCH_EMAIL = "me@bench.local"
+AI_PROCESSED_LABEL_ID = "Label_AI"
+
+
+class Faults:
+    """Latency and failure injection for one fake backend (seeded, thread-safe)."""
+
+    def __init__(self, latency_ms=0.0, jitter=0.3, error_rate=0.0, rate_limit_rate=0.0, retry_after=None, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        if not self.latency_ms:
+            return
+        with self._lock:
+            ms = max(0.0, self._rng.gauss(self.latency_ms, self.latency_ms * self.jitter))
+        time.sleep(ms / 1000)
+
+    def pick(self):
+        """Returns None, 'rate_limit' or 'error' for the next call."""
+        with self._lock:
+            roll = self._rng.random()
+        if roll < self.rate_limit_rate:
+            return 'rate_limit'
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 'error'
+        return None
+
+
+class CallStats:
+    """Calls per backend and method, injected faults and LLM tokens, shared by all fakes."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.faults = Counter()
+        self.tokens = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, backend, method):
+        with self._lock:
+            self.calls[(backend, method)] += 1
+
+    def fault(self, backend, kind):
+        with self._lock:
+            self.faults[(backend, kind)] += 1
+
+    def add_tokens(self, prompt, completion):
+        with self._lock:
+            self.tokens['prompt'] += prompt
+            self.tokens['completion'] += completion
+
+    def report(self):
+        with self._lock:
+            calls = {}
+            for (backend, method), n in sorted(self.calls.items()):
+                calls.setdefault(backend, {})[method] = n
+            faults = {f"{backend}.{kind}": n for (backend, kind), n in sorted(self.faults.items())}
+            tokens = dict(self.tokens)
+        tokens['total'] = tokens.get('prompt', 0) + tokens.get('completion', 0)
+        return {
+            'api_calls': calls,
+            'api_totals': {backend: sum(methods.values()) for backend, methods in calls.items()},
+            'injected_faults': faults,
+            'llm_tokens': tokens,
+        }
+
+
+def google_error(status, reason="backendError", retry_after=None):
+    info = {'status': str(status)}
+    if retry_after is not None:
+        info['retry-after'] = str(retry_after)
+    content = json.dumps({'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}}).encode()
+    return HttpError(httplib2.Response(info), content)
+
+
+class FakeRequest:
+    """Stands in for googleapiclient's HttpRequest; execute() goes through the real quota scheduler."""
+
+    def __init__(self, service, method_id, handler):
+        self.service = service
+        self.methodId = method_id
+        self.handler = handler
+        self.postproc = None
+
+    def run_once(self, delay=True):
+        if delay:
+            self.service.faults.delay()
+        self.service.stats.count(self.service.name, self.methodId)
+        fault = self.service.faults.pick()
+        if fault:
+            self.service.stats.fault(self.service.name, fault)
+            if fault == 'rate_limit':
+                raise google_error(429, 'rateLimitExceeded', self.service.faults.retry_after)
+            raise google_error(503)
+        result = self.handler()
+        if self.postproc is not None:
+            return self.postproc(None, json.dumps(result).encode())
+        return result
+
+    def execute(self, http=None, num_retries=0):
+        name, costs = request_costs(self.methodId)
+        return get_backend(name, self.service.scope).call(
+            self.run_once, idempotent=self.methodId not in NON_IDEMPOTENT_METHODS, method=self.methodId, **costs
+        )
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        # One HTTP round trip for the whole batch; sub-requests fail independently
+        self.service.faults.delay()
+        self.service.stats.count(self.service.name, 'batch')
+        for request_id, request in self.requests:
+            try:
+                response = request.run_once(delay=False)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+                continue
+            self.callback(request_id, response, None)
+
+
+class _Namespace:
+    """Resolves call chains like users().messages().get(...) to handlers named 'gmail.users.messages.get'."""
+
+    def __init__(self, service, path):
+        self._service = service
+        self._path = path
+
+    def __getattr__(self, name):
+        path = f"{self._path}.{name}"
+
+        def call(**kwargs):
+            handler = self._service.handlers.get(path)
+            if handler is None:
+                return _Namespace(self._service, path)
+            return FakeRequest(self._service, path, lambda: handler(**kwargs))
+        return call
+
+
+class FakeService(_Namespace):
+    def __init__(self, name, faults=None, stats=None, scope='bench'):
+        super().__init__(self, name)
+        self.name = name
+        self.faults = faults or Faults()
+        self.stats = stats or CallStats()
+        self.scope = scope
+        # Lets gmail_batch find the quota scope, as with a real discovery service
+        self._requestBuilder = throttled_request_class(scope)
+        self._lock = threading.Lock()
+        self.handlers = {}
+
+
+class FakeGmail(FakeService):
+    """In-memory Gmail for one mailbox (see `generate_mailbox`)."""
+
+    def __init__(self, mailbox, faults=None, stats=None, scope='bench'):
+        super().__init__('gmail', faults, stats, scope)
+        self.mailbox = mailbox
+        self.messages = {m['id']: m for m in mailbox.messages}
+        self.labels = {
+            'INBOX': 'INBOX', 'UNREAD': 'UNREAD', 'DRAFT': 'DRAFT', 'SENT': 'SENT',
+            AI_PROCESSED_LABEL_ID: 'AI Processed',
+        }
+        self.sent = []
+        self.drafts = []
+        self.history_id = max([int(m['historyId']) for m in mailbox.messages] or [1])
+        self.handlers = {
+            'gmail.users.getProfile': self._get_profile,
+            'gmail.users.watch': lambda **kw: {'historyId': str(self.history_id), 'expiration': str(int((time.time() + 7 * 86400) * 1000))},
+            'gmail.users.labels.list': lambda **kw: {'labels': [{'id': i, 'name': n} for i, n in self.labels.items()]},
+            'gmail.users.labels.create': self._create_label,
+            'gmail.users.history.list': self._list_history,
+            'gmail.users.messages.list': self._list_messages,
+            'gmail.users.messages.get': self._get_message,
+            'gmail.users.messages.attachments.get': self._get_attachment,
+            'gmail.users.messages.batchModify': self._batch_modify,
+            'gmail.users.messages.modify': self._modify,
+            'gmail.users.messages.send': self._send,
+            'gmail.users.drafts.create': self._create_draft,
+            'gmail.users.threads.get': self._get_thread,
+        }
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def _get_profile(self, **kwargs):
+        return {'emailAddress': BENCH_EMAIL, 'historyId': str(self.history_id)}
+
+    def _create_label(self, userId='me', body=None):
+        with self._lock:
+            if any(n.lower() == body['name'].lower() for n in self.labels.values()):
+                raise google_error(409, 'Label name exists or conflicts')
+            label_id = f"Label_{len(self.labels)}"
+            self.labels[label_id] = body['name']
+        return {'id': label_id, 'name': body['name']}
+
+    def _matches(self, msg, q):
+        labels = msg['labelIds']
+        if ('label:INBOX' in q or 'in:inbox' in q) and 'INBOX' not in labels:
+            return False
+        if '-label:"AI Processed"' in q and AI_PROCESSED_LABEL_ID in labels:
+            return False
+        return True
+
+    def _list_messages(self, userId='me', q='', maxResults=100, pageToken=None, **kwargs):
+        with self._lock:
+            ids = [m['id'] for m in sorted(self.messages.values(), key=lambda m: -int(m['internalDate'])) if self._matches(m, q)]
+        start = int(pageToken or 0)
+        page = ids[start:start + maxResults]
+        result = {'messages': [{'id': i, 'threadId': self.messages[i]['threadId']} for i in page], 'resultSizeEstimate': len(ids)}
+        if start + maxResults < len(ids):
+            result['nextPageToken'] = str(start + maxResults)
+        return result
+
+    def _list_history(self, userId='me', startHistoryId=0, pageToken=None, **kwargs):
+        with self._lock:
+            added = [m for m in self.messages.values() if int(m['historyId']) > int(startHistoryId)]
+        return {
+            'history': [{'id': m['historyId'], 'messagesAdded': [{'message': {'id': m['id'], 'labelIds': list(m['labelIds'])}}]} for m in added],
+            'historyId': str(self.history_id),
+        }
+
+    def _find(self, msg_id):
+        msg = self.messages.get(msg_id)
+        if msg is None:
+            raise google_error(404, 'notFound')
+        return msg
+
+    def _get_message(self, userId='me', id=None, format='full', metadataHeaders=None, fields=None):
+        with self._lock:
+            msg = copy.deepcopy(self._find(id))
+        if format == 'metadata':
+            wanted = {h.lower() for h in (metadataHeaders or [])}
+            headers = [h for h in msg['payload']['headers'] if not wanted or h['name'].lower() in wanted]
+            msg['payload'] = {'mimeType': msg['payload']['mimeType'], 'headers': headers}
+        return msg
+
+    def _get_attachment(self, userId='me', messageId=None, id=None):
+        data = self.mailbox.attachments.get((messageId, id))
+        if data is None:
+            raise google_error(404, 'notFound')
+        return {'size': len(data) * 3 // 4, 'data': data}
+
+    def _apply_labels(self, msg_id, add=(), remove=()):
+        msg = self._find(msg_id)
+        labels = [l for l in msg['labelIds'] if l not in remove]
+        msg['labelIds'] = labels + [l for l in add if l not in labels]
+
+    def _batch_modify(self, userId='me', body=None):
+        with self._lock:
+            for msg_id in body['ids']:
+                self._apply_labels(msg_id, body.get('addLabelIds', ()), body.get('removeLabelIds', ()))
+        return {}
+
+    def _modify(self, userId='me', id=None, body=None):
+        with self._lock:
+            self._apply_labels(id, body.get('addLabelIds', ()), body.get('removeLabelIds', ()))
+        return {'id': id}
+
+    def _send(self, userId='me', body=None):
+        with self._lock:
+            self.sent.append(body)
+            return {'id': f"sent-{len(self.sent)}"}
+
+    def _create_draft(self, userId='me', body=None):
+        with self._lock:
+            self.drafts.append(body)
+            return {'id': f"draft-{len(self.drafts)}"}
+
+    def _get_thread(self, userId='me', id=None, format='full', **kwargs):
+        with self._lock:
+            messages = [copy.deepcopy(m) for m in self.messages.values() if m['threadId'] == id]
+        if not messages:
+            raise google_error(404, 'notFound')
+        return {'id': id, 'messages': messages}
+
+
+class FakeDrive(FakeService):
+    """In-memory Drive: folders and uploaded files under one root."""
+
+    def __init__(self, faults=None, stats=None, scope='bench', root_id='root-bench'):
+        super().__init__('drive', faults, stats, scope)
+        self.root_id = root_id
+        self.stored = {root_id: {'id': root_id, 'name': 'Gmail Attachments', 'mimeType': FOLDER_MIME_TYPE, 'parents': [], 'trashed': False}}
+        self.uploaded_bytes = 0
+        self.handlers = {
+            'drive.files.list': self._list,
+            'drive.files.get': self._get,
+            'drive.files.create': self._create,
+        }
+
+    def _list(self, q='', pageSize=100, pageToken=None, **kwargs):
+        parent = re.search(r"'([^']+)' in parents", q)
+        mime = re.search(r"mimeType\s*=\s*'([^']+)'", q)
+        name = re.search(r"name\s*=\s*'([^']+)'", q)
+        sha = re.search(r"key='sha256' and value='([^']+)'", q)
+        with self._lock:
+            found = [
+                f for f in self.stored.values()
+                if not f['trashed']
+                and (not parent or parent.group(1) in f['parents'])
+                and (not mime or f['mimeType'] == mime.group(1))
+                and (not name or f['name'] == name.group(1))
+                and (not sha or f.get('appProperties', {}).get('sha256') == sha.group(1))
+            ]
+        start = int(pageToken or 0)
+        result = {'files': [dict(f) for f in found[start:start + pageSize]]}
+        if start + pageSize < len(found):
+            result['nextPageToken'] = str(start + pageSize)
+        return result
+
+    def _get(self, fileId=None, **kwargs):
+        with self._lock:
+            found = self.stored.get(fileId)
+        if found is None:
+            raise google_error(404, 'notFound')
+        return dict(found)
+
+    def _create(self, body=None, media_body=None, fields=None, **kwargs):
+        size = 0
+        if media_body is not None:
+            size = len(media_body.getbytes(0, media_body.size()))
+        with self._lock:
+            for parent in body.get('parents', []):
+                if parent not in self.stored:
+                    raise google_error(404, 'File not found')
+            file_id = f"file-{len(self.stored)}"
+            self.stored[file_id] = {
+                'id': file_id, 'name': body['name'], 'mimeType': body.get('mimeType', 'application/octet-stream'),
+                'parents': list(body.get('parents', [])), 'appProperties': dict(body.get('appProperties', {})),
+                'size': str(size), 'trashed': False,
+            }
+            self.uploaded_bytes += size
+        return {'id': file_id}
+
+
+class FakeLLMError(Exception):
+    """Shaped like the OpenAI client's APIStatusError (status_code, response.headers)."""
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"Error code: {status_code}")
+        self.status_code = status_code
+        headers = {'retry-after': str(retry_after)} if retry_after is not None else {}
+        self.response = type('Response', (), {'headers': headers})()
+
+
+class _Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeLLM:
+    """OpenAI-compatible chat client that answers from the mailbox's ground truth."""
+
+    def __init__(self, truth, faults=None, stats=None):
+        self.truth = truth
+        self.faults = faults or Faults()
+        self.stats = stats or CallStats()
+        self.chat = _Obj(completions=_Obj(create=self.create))
+
+    def _category(self, subject):
+        return self.truth.get(subject.strip(), 'Misc')
+
+    def create(self, model=None, messages=(), max_tokens=None, temperature=None, **kwargs):
+        self.faults.delay()
+        self.stats.count('llm', 'chat.completions.create')
+        fault = self.faults.pick()
+        if fault:
+            self.stats.fault('llm', fault)
+            raise FakeLLMError(429 if fault == 'rate_limit' else 503, self.faults.retry_after if fault == 'rate_limit' else None)
+        prompt = "\n".join(m['content'] for m in messages)
+        batch = re.findall(r'EMAIL ID: (\S+)\nSUBJECT: (.*)', prompt)
+        if batch:
+            content = json.dumps({email_id: self._category(subject) for email_id, subject in batch})
+        elif prompt.startswith('Write a natural'):
+            content = "Thanks for your note! Happy to help - let me get back to you with details shortly."
+        else:
+            subject = re.search(r'SUBJECT: (.*)', prompt)
+            content = self._category(subject.group(1)) if subject else 'Misc'
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(content) // 4 + 1
+        self.stats.add_tokens(prompt_tokens, completion_tokens)
+        return _Obj(
+            choices=[_Obj(message=_Obj(content=content))],
+            usage=_Obj(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+        )
+
+
+# Synthetic mailbox: sender/subject/header shapes per category. Some senders match
+# directives/gmail_rules.md (no LLM call), the rest need the model.
+CATEGORY_PROFILES = {
+    'Personal': {
+        'senders': ['{first}.{last}@gmail.com', '{first}@{last}family.net'],
+        'subjects': ['Catching up this weekend?', 'Photos from the trip', 'Quick question about {thing}', 'Dinner on {day}?'],
+        'headers': {},
+    },
+    'Accounting': {
+        'senders': ['billing@{company}.com', 'accounts@{company}.com', 'receipts@{company}.io'],
+        'subjects': ['Invoice {ref} for {month}', 'Your receipt from {company}', 'Payment confirmation {ref}'],
+        'headers': {},
+    },
+    'Promotional': {
+        'senders': ['news@{company}.com', 'deals@{company}.shop'],
+        'subjects': ['{pct}% off everything this {day}', 'New arrivals you will love', 'Last chance: {thing} sale'],
+        'headers': {'List-Unsubscribe': '<mailto:unsubscribe@{company}.com>'},
+    },
+    'Social': {
+        'senders': ['notifications@linkedin.com', 'updates@{company}social.com'],
+        'subjects': ['{first} viewed your profile', 'You have {pct} new notifications', '{first} mentioned you'],
+        'headers': {},
+    },
+    'Sales': {
+        'senders': ['{first}@{company}.com'],
+        'subjects': ['Partnership opportunity with {company}', 'Can I get 15 minutes on {day}?', 'Helping teams like yours with {thing}'],
+        'headers': {},
+    },
+    'Misc': {
+        'senders': ['team@{company}.org', '{first}@{company}.dev'],
+        'subjects': ['Shipping update for order {ref}', 'Your {thing} request', 'Reminder: {thing} on {day}'],
+        'headers': {},
+    },
+}
+DEFAULT_MIX = {'Personal': 0.12, 'Accounting': 0.12, 'Promotional': 0.3, 'Social': 0.16, 'Sales': 0.1, 'Misc': 0.2}
+WORDS = ("project budget meeting schedule update review travel family weekend proposal contract invoice "
+         "delivery account report design launch coffee lunch plan notes draft question thanks").split()
+FIRST = ['alex', 'sam', 'jordan', 'taylor', 'morgan', 'casey', 'riley', 'jamie']
+LAST = ['smith', 'garcia', 'chen', 'patel', 'kim', 'nguyen', 'brown', 'lopez']
+COMPANIES = ['acme', 'globex', 'initech', 'umbrella', 'hooli', 'vandelay', 'stark', 'wayne']
+ATTACHMENT_TYPES = [('application/pdf', 'pdf'), ('image/png', 'png'), ('text/csv', 'csv')]
+
+
+class Mailbox:
+    def __init__(self):
+        self.messages = []
+        self.truth = {}
+        self.attachments = {}
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def generate_mailbox(count, seed=7, mix=None, attachment_rate=0.2, attachment_kb=(20, 512), duplicate_rate=0.3,
+                     body_chars=(200, 4000), thread_rate=0.2):
+    """Builds `count` inbox messages with a category mix, attachments (some duplicated) and threads.
+
+    Subjects map to one category each (replies reuse their thread's), so the
+    fake LLM can answer from `mailbox.truth`.
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    categories, weights = zip(*mix.items())
+    mailbox = Mailbox()
+    blobs = []
+    threads = []
+    now_ms = int(time.time() * 1000)
+
+    for n in range(count):
+        msg_id = f"m{n:06d}"
+        if threads and rng.random() < thread_rate:
+            # A reply in an earlier conversation: same participant, category and subject
+            thread = rng.choice(threads)
+            thread_id, category, profile, values, sender = (thread[k] for k in ('id', 'category', 'profile', 'values', 'sender'))
+            subject = f"Re: {thread['subject']}"
+        else:
+            category = rng.choices(categories, weights)[0]
+            profile = CATEGORY_PROFILES.get(category, CATEGORY_PROFILES['Misc'])
+            values = {
+                'first': rng.choice(FIRST), 'last': rng.choice(LAST), 'company': rng.choice(COMPANIES),
+                'thing': rng.choice(WORDS), 'day': rng.choice(['Monday', 'Friday', 'Sunday']),
+                'month': rng.choice(['March', 'July', 'October']), 'ref': f"#{rng.randint(1000, 99999)}",
+                'pct': rng.randint(2, 70),
+            }
+            sender = rng.choice(profile['senders']).format(**values)
+            subject = f"{rng.choice(profile['subjects']).format(**values)} [{n}]"
+            thread_id = f"t{n:06d}"
+            threads.append({'id': thread_id, 'category': category, 'profile': profile, 'values': values,
+                            'sender': sender, 'subject': subject})
+        mailbox.truth[subject] = category
+
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(*body_chars) // 6))
+        headers = [
+            {'name': 'From', 'value': f"{values['first'].title()} <{sender}>"},
+            {'name': 'To', 'value': BENCH_EMAIL},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Date', 'value': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now_ms / 1000 - (count - n) * 30))},
+            {'name': 'Message-ID', 'value': f"<{msg_id}@bench.local>"},
+        ] + [{'name': k, 'value': v.format(**values)} for k, v in profile['headers'].items()]
+        if subject.startswith('Re: '):
+            # Replies quote the conversation so far, as mail clients do
+            quoted = "\n".join(f"> {rng.choice(WORDS)} {rng.choice(WORDS)} {rng.choice(WORDS)}" for _ in range(rng.randint(10, 60)))
+            text += f"\n\nOn {values['day']}, {values['first'].title()} <{sender}> wrote:\n{quoted}"
+        if profile['headers'].get('List-Unsubscribe'):
+            # Marketing mail is HTML-only, with a heavy style block before the text
+            markup = f"<html><head><style>{'td{padding:0}' * 300}</style></head><body><p>{text}</p></body></html>"
+            text_part = {'partId': '0', 'mimeType': 'text/html', 'filename': '', 'headers': [],
+                         'body': {'size': len(markup), 'data': _b64(markup.encode())}}
+        else:
+            text_part = {'partId': '0', 'mimeType': 'text/plain', 'filename': '', 'headers': [],
+                         'body': {'size': len(text), 'data': _b64(text.encode())}}
+
+        parts = []
+        if rng.random() < attachment_rate:
+            for index in range(rng.randint(1, 2)):
+                if blobs and rng.random() < duplicate_rate:
+                    data, mime_type, ext = rng.choice(blobs)
+                else:
+                    mime_type, ext = rng.choice(ATTACHMENT_TYPES)
+                    data = _b64(rng.randbytes(rng.randint(*attachment_kb) * 1024))
+                    blobs.append((data, mime_type, ext))
+                att_id = f"att-{msg_id}-{index}"
+                mailbox.attachments[(msg_id, att_id)] = data
+                parts.append({'partId': str(index + 1), 'mimeType': mime_type, 'filename': f"{values['thing']}-{n}.{ext}",
+                              'headers': [], 'body': {'attachmentId': att_id, 'size': len(data) * 3 // 4}})
+
+        if parts:
+            payload = {'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'headers': headers,
+                       'body': {'size': 0}, 'parts': [text_part] + parts}
+        else:
+            payload = dict(text_part, partId='', headers=headers)
+        mailbox.messages.append({
+            'id': msg_id, 'threadId': thread_id, 'labelIds': ['INBOX', 'UNREAD'],
+            'internalDate': str(now_ms - (count - n) * 30000), 'historyId': str(n + 2),
+            'sizeEstimate': len(text) + sum(p['body']['size'] for p in parts), 'payload': payload,
+        })
+    return mailbox
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+
+BACKFILL_STATE_FILE = "backfill_state.json"
+BACKFILL_BASE_QUERY = "in:inbox"
+
+
+def build_backfill_query(after=None, before=None, query=None):
+    """Gmail search for a backfill: the inbox (or a custom query) within an optional YYYY/MM/DD range.
+
+    Already-processed mail is deliberately not excluded in the query: the
+    result set would shrink under the page tokens as messages get labelled.
+    Those messages are skipped after the cheap metadata fetch instead.
+    """
+    terms = [query or BACKFILL_BASE_QUERY]
+    if after:
+        terms.append(f"after:{after}")
+    if before:
+        terms.append(f"before:{before}")
+    return " ".join(terms)
+
+
+def new_backfill_state(query):
+    return {
+        'query': query,
+        'page_token': None,
+        'done': False,
+        'estimate': None,
+        'listed': 0,
+        'processed': 0,
+        'failed': 0,
+        'seconds': 0.0,
+        'started_at': int(time.time()),
+    }
+
+
+def load_backfill_state(state_dir):
+    try:
+        with open(os.path.join(state_dir, BACKFILL_STATE_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error reading backfill state: {e}")
+        return None
+
+
+def save_backfill_state(state_dir, state):
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, BACKFILL_STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def next_backfill_ids(gmail_service, state, max_messages, page_size=500):
+    """Lists up to `max_messages` more IDs, advancing the page token in `state`.
+
+    The caller must persist the IDs (work queue) before saving `state`, so a
+    stop between the two re-lists a page rather than losing it.
+    """
+    message_ids = []
+    while not state['done'] and len(message_ids) < max_messages:
+        kwargs = {'userId': 'me', 'q': state['query'], 'maxResults': min(page_size, 500)}
+        if state['page_token']:
+            kwargs['pageToken'] = state['page_token']
+        results = gmail_service.users().messages().list(**kwargs).execute()
+        if state['estimate'] is None:
+            state['estimate'] = results.get('resultSizeEstimate')
+        message_ids.extend(m['id'] for m in results.get('messages', []))
+        state['page_token'] = results.get('nextPageToken')
+        state['done'] = not state['page_token']
+    state['listed'] += len(message_ids)
+    return message_ids
+
+
+def record_slice(state, processed, failed, seconds):
+    """Adds one slice's results to `state`. Returns a progress report with rate and ETA."""
+    state['processed'] += processed
+    state['failed'] += failed
+    state['seconds'] += seconds
+    rate = state['processed'] / state['seconds'] if state['seconds'] else 0.0
+    # resultSizeEstimate is rough; once listing is done the listed count is exact
+    total = state['listed'] if state['done'] else max(state['estimate'] or 0, state['listed'])
+    remaining = max(0, total - state['processed'] - state['failed'])
+    return {
+        'processed': state['processed'],
+        'failed': state['failed'],
+        'total': total,
+        'msgs_per_s': round(rate, 2),
+        'eta_s': round(remaining / rate) if rate else None,
+        'done': state['done'],
+    }
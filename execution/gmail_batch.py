@@ -0,0 +1,128 @@
+import time
+import threading
+from collections import defaultdict
+
+import telemetry
+from rate_limits import GMAIL_QUOTA_UNITS, get_backend, is_retryable, service_scope, status_of
+
+# Gmail accepts up to 100 calls per batch but recommends staying at or below 50
+MAX_GET_BATCH = 50
+# users.messages.batchModify takes at most 1000 message IDs per call
+MAX_MODIFY_IDS = 1000
+# Rounds of re-batching sub-requests that came back throttled
+BATCH_RETRIES = 3
+
+
+def batch_get_messages(gmail_service, msg_ids, fmt='full', batch_size=MAX_GET_BATCH, **get_kwargs):
+    """Fetches messages in multipart batch requests. Returns {msg_id: message}.
+
+    Each sub-request is charged its quota units against the shared Gmail
+    budget. Sub-requests answered with 429/5xx are re-batched after a backoff;
+    messages that still failed are left out so callers can fall back to a
+    single `messages().get`.
+    """
+    messages = {}
+    batch_size = max(1, min(batch_size, 100))
+    gmail = get_backend('gmail', service_scope(gmail_service))
+    units = GMAIL_QUOTA_UNITS['gmail.users.messages.get']
+    pending = list(msg_ids)
+
+    for attempt in range(BATCH_RETRIES + 1):
+        throttled = []
+
+        def on_response(request_id, response, exception):
+            telemetry.count('api.calls', backend='gmail', method='gmail.users.messages.get',
+                            outcome='ok' if exception is None else status_of(exception) or type(exception).__name__)
+            if exception is None:
+                messages[request_id] = response
+            elif is_retryable(exception) and attempt < BATCH_RETRIES:
+                throttled.append((request_id, exception))
+            else:
+                print(f"Batch fetch failed for {request_id}: {exception}")
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            gmail.acquire(units=units * len(chunk))
+            batch = gmail_service.new_batch_http_request(callback=on_response)
+            for msg_id in chunk:
+                batch.add(
+                    gmail_service.users().messages().get(userId='me', id=msg_id, format=fmt, **get_kwargs),
+                    request_id=msg_id
+                )
+            try:
+                with telemetry.span('gmail.batch', backend='gmail', size=len(chunk), attempt=attempt):
+                    batch.execute()
+            except Exception as e:
+                if is_retryable(e) and attempt < BATCH_RETRIES:
+                    throttled.extend((msg_id, e) for msg_id in chunk if msg_id not in messages)
+                else:
+                    print(f"Batch fetch request failed: {e}")
+
+        if not throttled:
+            break
+        hints = [gmail.penalize(error) for _, error in throttled]
+        delay = gmail.backoff(attempt, max((h for h in hints if h is not None), default=None))
+        pending = list(dict.fromkeys(msg_id for msg_id, _ in throttled))
+        telemetry.count('api.retries', len(pending), backend='gmail', method='gmail.users.messages.get')
+        print(f"Batch fetch throttled for {len(pending)} messages, retrying in {delay:.1f}s")
+        time.sleep(delay)
+    return messages
+
+
+class LabelChanges:
+    """Collects label mutations for a run and applies them with batchModify.
+
+    Changes for the same message are merged, then messages with identical
+    add/remove sets share a single `users.messages.batchModify` call.
+    """
+
+    def __init__(self):
+        self._adds = defaultdict(set)
+        self._removes = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def add(self, msg_id, add=(), remove=()):
+        add = {l for l in add if l}
+        remove = {l for l in remove if l}
+        with self._lock:
+            self._adds[msg_id] |= add
+            self._adds[msg_id] -= remove
+            self._removes[msg_id] |= remove
+            self._removes[msg_id] -= add
+
+    def message_ids(self):
+        return list(dict.fromkeys(list(self._adds) + list(self._removes)))
+
+    def __len__(self):
+        return len(self.message_ids())
+
+    def groups(self):
+        grouped = defaultdict(list)
+        for msg_id in self.message_ids():
+            key = (frozenset(self._adds[msg_id]), frozenset(self._removes[msg_id]))
+            if key[0] or key[1]:
+                grouped[key].append(msg_id)
+        return grouped
+
+    def flush(self, gmail_service):
+        """Applies all pending changes. Returns a list of (msg_ids, add, remove, error) failures."""
+        failures = []
+        with self._lock:
+            pending = self.groups()
+            self._adds.clear()
+            self._removes.clear()
+        for (add, remove), msg_ids in pending.items():
+            for start in range(0, len(msg_ids), MAX_MODIFY_IDS):
+                chunk = msg_ids[start:start + MAX_MODIFY_IDS]
+                body = {'ids': chunk}
+                if add:
+                    body['addLabelIds'] = sorted(add)
+                if remove:
+                    body['removeLabelIds'] = sorted(remove)
+                try:
+                    gmail_service.users().messages().batchModify(userId='me', body=body).execute()
+                    print(f"Updated labels on {len(chunk)} messages (+{sorted(add)} -{sorted(remove)})")
+                except Exception as e:
+                    print(f"Failed to update labels on {len(chunk)} messages: {e}")
+                    failures.append((chunk, add, remove, e))
+        return failures
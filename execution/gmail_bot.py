@@ -1,128 +1,723 @@
 import os
+import hmac
 import json
 import time
 import base64
-from datetime import datetime, timedelta
+import uuid
+import functools
+import threading
+from datetime import datetime
 from email.message import EmailMessage
 
 import modal  # type: ignore
-from google.oauth2.credentials import Credentials  # type: ignore
-from googleapiclient.discovery import build  # type: ignore
-from googleapiclient.http import MediaIoBaseUpload  # type: ignore
-from googleapiclient.errors import HttpError  # type: ignore
-import io
+
+from gmail_sync import load_sync_state, save_sync_state, sync_message_ids
+from gmail_batch import LabelChanges, batch_get_messages
+from email_pipeline import run_pipeline
+from classification_cache import ClassificationCache, email_fingerprint, instructions_version
+from classification_rules import get_rules
+from neighbour_classifier import NeighbourIndex
+from thread_decisions import ThreadDecisions
+from prompt_builder import PromptBuilder, extract_body, reply_prompt
+from bot_resources import get_google_clients, worker_services, get_llm_client, benchmark_startup, credentials_scope
+from drive_folders import get_folder_index
+from label_registry import AI_PROCESSED_LABEL, get_label_registry
+from attachment_transfer import ByteBudget, transfer_attachment, MB
+from attachment_dedup import AttachmentIndex
+from work_queue import WorkQueue
+from draft_queue import DraftQueue, DraftWorkers
+from rate_limits import Saturated, TokenBucket, get_backend, backend_stats, set_llm_shards
+from gmail_push import PushCoalescer, SyncLease, parse_push_notification, ensure_watch
+from accounts import DEFAULT_ACCOUNT, load_accounts, find_account
+from gmail_backfill import (build_backfill_query, new_backfill_state, load_backfill_state, save_backfill_state,
+                            next_backfill_ids, record_slice)
+import telemetry
 
 app = modal.App("gmail-bot")
 
-# Install missing packages: openai, google-api-python-client, groq, pydantic
+# Persistent state (history cursor etc.) survives across container runs
+STATE_DIR = "/root/state"
+DIRECTIVES_DIR = "/root/directives"
+state_volume = modal.Volume.from_name("gmail-bot-state", create_if_missing=True)
+# Pending-sync markers shared by the push endpoint and the worker
+push_state = modal.Dict.from_name("gmail-bot-push", create_if_missing=True)
+_commit_lock = threading.Lock()
+
+# Polls every minute; with push notifications on (GMAIL_PUBSUB_TOPIC set when deploying) the cron is only a safety net
+POLL_SCHEDULE = os.environ.get(
+    "GMAIL_POLL_SCHEDULE", "*/15 * * * *" if os.environ.get("GMAIL_PUBSUB_TOPIC") else "* * * * *"
+)
+# Wait for the rest of a notification burst before syncing
+PUSH_DEBOUNCE_SECONDS = float(os.environ.get("PUSH_DEBOUNCE_SECONDS", "3"))
+# Back-to-back syncs one account run may do for notifications that arrived mid-run
+PUSH_MAX_ROUNDS = 3
+
+# Each account is synced in its own container, up to this many at once
+ACCOUNT_CONCURRENCY = int(os.environ.get("ACCOUNT_CONCURRENCY", "20"))
+ACCOUNT_TIMEOUT_SECONDS = 600
+# Backfill runs in slices between live syncs, paced to leave Gmail quota for live mail
+BACKFILL_SLICE_MESSAGES = int(os.environ.get("BACKFILL_SLICE_MESSAGES", "2000"))
+BACKFILL_MESSAGES_PER_SECOND = float(os.environ.get("BACKFILL_MESSAGES_PER_SECOND", "20"))
+# Backfill skips forwards and reply drafts for old mail unless this is on
+BACKFILL_ACTIONS = os.environ.get("BACKFILL_ACTIONS", "off").lower() in ("1", "on", "true")
+# How long a backfill slice waits for a live run to release the account
+BACKFILL_LEASE_WAIT_SECONDS = 300
+# A traffic recording holds the account's lease for at most this long
+RECORD_TIMEOUT_SECONDS = 3600
+# Warm label registries re-list the mailbox's labels after this long
+LABEL_REFRESH_SECONDS = float(os.environ.get("LABEL_REFRESH_SECONDS", "3600"))
+
+# Install missing packages: openai, google-api-python-client, groq, pydantic, tiktoken
 image = modal.Image.debian_slim().pip_install(
     "google-api-python-client", 
     "google-auth-httplib2", 
     "google-auth-oauthlib",
     "openai",
     "groq",
-    "pydantic"
-).add_local_dir("directives", remote_path="/root/directives")
+    "pydantic",
+    "numpy",
+    "tiktoken",
+    "fastapi[standard]"
+).env({"TIKTOKEN_CACHE_DIR": "/root/tiktoken"}).run_commands(
+    # Baked into the image so cold containers don't download the tokenizer
+    "python -c \"import tiktoken; tiktoken.get_encoding('o200k_base')\""
+).add_local_dir("directives", remote_path="/root/directives").add_local_python_source("gmail_sync", "gmail_batch", "email_pipeline", "classification_cache", "classification_rules", "neighbour_classifier", "bot_resources", "drive_folders", "attachment_transfer", "attachment_dedup", "work_queue", "rate_limits", "gmail_push", "accounts", "draft_queue", "gmail_backfill", "telemetry", "thread_decisions", "prompt_builder", "label_registry")
+# Only record_traffic needs the offline tools
+record_image = image.add_local_python_source("traffic_replay", "profiling", "benchmark", "fake_services")
 
 @app.function(
     image=image,
-    schedule=modal.Cron("* * * * *"),
-    secrets=[modal.Secret.from_name("gmail-bot-secrets")]
+    schedule=modal.Cron(POLL_SCHEDULE)
 )
 def poll_emails():
+    """Fans the account registry out, one container input per account, without waiting for the runs.
+
+    A slow account therefore never delays the next cron tick; its lease turns away overlapping runs.
+    """
+    account_ids = [account.account_id for account in load_accounts(DIRECTIVES_DIR, STATE_DIR)]
+    process_account.spawn_map(account_ids)
+    print(f"Spawned runs for {len(account_ids)} accounts.")
+
+
+@app.function(
+    image=image,
+    secrets=[modal.Secret.from_name("gmail-bot-secrets")],
+    volumes={STATE_DIR: state_volume},
+    # Keep the container warm between ticks so clients and tokens are reused
+    scaledown_window=120,
+    max_containers=ACCOUNT_CONCURRENCY,
+    timeout=ACCOUNT_TIMEOUT_SECONDS
+)
+def process_account(account_id: str, reason: str = "cron", backfill_query: str = ""):
+    """Syncs one account. A lease keeps cron, push and backfill runs for the same account from overlapping.
+
+    A "backfill" run does a live sync, then one backfill slice, and hands the
+    rest to a fresh run so live syncs get the account in between. A non-empty
+    `backfill_query` starts a new backfill instead of resuming the saved one.
+    A cron run restarts a backfill whose chain of runs broke off (e.g. a
+    slice that timed out).
+    """
+    accounts = {account.account_id: account for account in load_accounts(DIRECTIVES_DIR, STATE_DIR)}
+    account = accounts.get(account_id)
+    if account is None:
+        print(f"Unknown account {account_id}")
+        return "unknown"
+    # Containers running at once split the LLM key's request/token budget between them
+    set_llm_shards(min(ACCOUNT_CONCURRENCY, len(accounts)))
+    if reason == "push":
+        time.sleep(PUSH_DEBOUNCE_SECONDS)
+
+    coalescer = PushCoalescer(push_state)
+    lease = SyncLease(push_state, lease_seconds=ACCOUNT_TIMEOUT_SECONDS)
+    if reason == "backfill":
+        mark_backfill_alive(account_id)
+    backfill_pending = False
+    for round_number in range(PUSH_MAX_ROUNDS):
+        acquired = lease.acquire(account_id)
+        lease_deadline = time.monotonic() + BACKFILL_LEASE_WAIT_SECONDS
+        while not acquired and reason == "backfill" and time.monotonic() < lease_deadline:
+            time.sleep(5)
+            acquired = lease.acquire(account_id)
+        if not acquired:
+            # The run holding the lease picks up the pending notification when it finishes
+            print(f"{account_id} is already syncing.")
+            return "busy"
+        try:
+            # Another container may have synced this account since this one last ran
+            try:
+                state_volume.reload()
+            except Exception as e:
+                print(f"State volume reload failed: {e}")
+            # Notifications arriving from here on schedule one follow-up round
+            coalescer.start(account_id)
+            run_tick(account)
+            if reason == "backfill" and round_number == 0:
+                backfill_pending = run_backfill_slice(account, backfill_query)
+                if not backfill_pending:
+                    push_state.pop(_backfill_key(account_id), None)
+            elif reason == "cron" and round_number == 0:
+                backfill_pending = backfill_stalled(account)
+        finally:
+            lease.release(account_id)
+        if not coalescer.pending(account_id):
+            break
+    if backfill_pending:
+        mark_backfill_alive(account_id)
+        process_account.spawn(account_id, "backfill")
+    return "ok"
+
+
+def _backfill_key(account_id):
+    return f"backfill:{account_id}"
+
+
+def mark_backfill_alive(account_id):
+    """Notes that a backfill run for the account is queued or running."""
+    push_state[_backfill_key(account_id)] = time.time()
+
+
+def backfill_stalled(account):
+    """True if the account has an unfinished backfill and no run has been queued or started for it lately."""
+    state = load_backfill_state(account.state_dir)
+    if not state or state['done']:
+        return False
+    # A run ends within its timeout of being marked; allow as long again for a spawned run to start
+    stale_after = 2 * ACCOUNT_TIMEOUT_SECONDS
+    if time.time() - push_state.get(_backfill_key(account.account_id), 0) < stale_after:
+        return False
+    print(f"Backfill for {account.account_id} stalled, resuming it.")
+    return True
+
+
+@app.function(image=image)
+def backfill(account_id: str = DEFAULT_ACCOUNT, after: str = "", before: str = "", query: str = ""):
+    """Organizes existing mail: walks a date range (YYYY/MM/DD) and/or Gmail query, checkpointing as it goes.
+
+    Run with: python -m modal run execution/gmail_bot.py::backfill --after 2024/01/01
+    Without arguments, resumes the account's saved backfill.
+    """
+    new_query = build_backfill_query(after, before, query) if (after or before or query) else ""
+    mark_backfill_alive(account_id)
+    process_account.spawn(account_id, "backfill", new_query)
+    print(f"Backfill {'started' if new_query else 'resumed'} for {account_id}{': ' + new_query if new_query else ''}")
+
+
+def run_backfill_slice(account, new_query=""):
+    """Processes the next slice of the account's backfill. Returns True while more remains."""
+    state = None if new_query else load_backfill_state(account.state_dir)
+    if new_query:
+        state = new_backfill_state(new_query)
+        save_backfill_state(account.state_dir, state)
+    if state is None:
+        print(f"No backfill in progress for {account.account_id}.")
+        return False
+    if state['done']:
+        print(f"Backfill for {account.account_id} already complete.")
+        return False
+    report = run_tick(account, backfill=state)
+    return bool(report) and not report['done']
+
+
+@app.function(image=image, secrets=[modal.Secret.from_name("gmail-bot-secrets")])
+@modal.fastapi_endpoint(method="POST")
+def gmail_push(envelope: dict, token: str = ""):
+    """Receives Gmail users.watch notifications in Pub/Sub push format."""
+    expected = os.environ.get("PUSH_VERIFICATION_TOKEN")
+    if expected and not hmac.compare_digest(token, expected):
+        from fastapi import HTTPException  # type: ignore
+        raise HTTPException(status_code=403, detail="Invalid token")
+    notification = parse_push_notification(envelope)
+    if notification is None:
+        # Acknowledge anyway, otherwise Pub/Sub keeps redelivering it
+        print("Ignoring malformed push notification.")
+        return {"status": "ignored"}
+    mailbox, history_id = notification
+    account = find_account(load_accounts(DIRECTIVES_DIR, STATE_DIR), mailbox)
+    if account is None:
+        print(f"Ignoring notification for unregistered mailbox {mailbox}.")
+        return {"status": "ignored"}
+    if PushCoalescer(push_state).notify(account.account_id):
+        process_account.spawn(account.account_id, "push")
+        print(f"Scheduled sync for {account.account_id} (historyId {history_id})")
+        return {"status": "scheduled"}
+    return {"status": "coalesced"}
+
+
+def run_tick(account, backfill=None):
+    """One incremental sync and processing pass over an account's mailbox.
+
+    With a `backfill` state, processes the next slice of that backfill
+    instead of the live delta and returns its progress report. Spans and
+    counters for the tick are summarized and exported when it ends.
+    """
+    telemetry.start_tick(account=account.account_id, mode="live" if backfill is None else "backfill")
+    try:
+        return _run_tick(account, backfill)
+    finally:
+        telemetry.finish_tick()
+
+
+def _run_tick(account, backfill=None):
+    state_dir = account.state_dir
     # Load token
-    token_json = os.environ.get("GOOGLE_TOKEN_JSON")
+    token_json = account.token_json()
     if not token_json:
-        print("Error: GOOGLE_TOKEN_JSON not found.")
+        print(f"Error: {account.token_env} not found.")
         return
         
-    creds_dict = json.loads(token_json)
-    creds = Credentials.from_authorized_user_info(creds_dict)
-    
-    gmail_service = build('gmail', 'v1', credentials=creds)  # type: ignore
-    drive_service = build('drive', 'v3', credentials=creds)  # type: ignore
+    creds, gmail_service, drive_service = get_google_clients(token_json, state_dir)
     
-    # 1. SETUP / READ DIRECTIVES
-    # Read labels
-    labels_map = {}
-    ai_processed_id = None
+    # Opened as the tick goes; closed (and leases released) however it ends
+    work = cache = neighbours = threads = attachment_index = draft_queue = draft_workers = None
+    tick_owner = uuid.uuid4().hex
     try:
-        with open("/root/directives/gmail_labels.md", "r") as f:
-            for line in f:
-                if "**" in line and "`" in line:
-                    parts = line.split("**")
-                    if len(parts) >= 3:
-                        name = parts[1]
-                        id_part = line.split("`")[1]
-                        labels_map[name.lower()] = id_part
-                        if name == "AI Processed":
-                            ai_processed_id = id_part
-    except Exception as e:
-        print(f"Error reading labels map: {e}")
+        # 1. SETUP / READ DIRECTIVES
+        # Label name -> ID, kept warm across runs; listed at most once per refresh interval
+        labels = get_label_registry(account.directive("gmail_labels.md"), LABEL_REFRESH_SECONDS, state_dir)
+        with telemetry.span("labels.refresh"):
+            labels.refresh(gmail_service)
+        ai_processed_id = labels.get_or_create(gmail_service, AI_PROCESSED_LABEL, message_visibility='hide')
+        if not ai_processed_id:
+            print("Failed to lookup or create AI Processed label.")
+
+        # Read Drive Root ID
+        drive_root_id = None
+        try:
+            with open(account.directive("drive_config.md"), "r") as f:
+                for line in f:
+                    if "Root_Folder_ID" in line:
+                        drive_root_id = line.split("`")[1]
+        except Exception as e:
+            print(f"Error reading drive config: {e}")
+
+        # Category -> folder ID index, listed once instead of searched per attachment
+        folder_index = None
+        if drive_root_id:
+            folder_index = get_folder_index(drive_root_id, state_dir)
+            with telemetry.span("drive.folder_index"):
+                folder_index.refresh(drive_service)
+        attachment_index = open_attachment_index(state_dir) if drive_root_id else None
+
+        # Read Instructions
+        instructions = load_instructions(account.directive("gmail_instructions.md"))
+
+        # Deterministic header/sender rules, checked before any LLM call
+        rules = get_rules(account.directive("gmail_rules.md"))
+
+        # Get my own email to prevent loops
+        profile = gmail_service.users().getProfile(userId='me').execute()
+        my_email = profile.get('emailAddress', '').lower()
+
+        # Keep the push subscription alive (users.watch expires after 7 days)
+        topic_name = os.environ.get("GMAIL_PUBSUB_TOPIC")
+        if topic_name:
+            try:
+                ensure_watch(gmail_service, state_dir, topic_name)
+            except Exception as e:
+                print(f"Failed to renew Gmail watch: {e}")
+    
+        # 2. INCREMENTAL SYNC (historyId cursor, full resync fallback)
+        tick_started = int(datetime.now().timestamp())
+        slice_started = time.monotonic()
+        work = open_work_queue(state_dir)
+        new_history_id = None
+        if backfill is not None:
+            if not work:
+                print("Backfill needs the work queue (WORK_QUEUE is off).")
+                return None
+            # Listed IDs are durable in the work queue before the page token moves on
+            try:
+                with telemetry.span("sync.list", mode="backfill"):
+                    message_ids = next_backfill_ids(gmail_service, backfill, BACKFILL_SLICE_MESSAGES)
+            except Exception as e:
+                print(f"Failed to list backfill page: {e}")
+                return None
+            work.enqueue(message_ids, origin='backfill')
+            save_backfill_state(state_dir, backfill)
+            # Earlier backfill messages that failed go with this slice (live ticks leave them alone)
+            listed = set(message_ids)
+            retries = [m for m in work.pending_ids(origin='backfill') if m not in listed]
+            if retries:
+                print(f"Retrying {len(retries)} unfinished backfill emails.")
+            message_ids = work.claim(message_ids + retries, tick_owner)
+        else:
+            sync_state = load_sync_state(state_dir)
+            try:
+                with telemetry.span("sync.list", mode="live"):
+                    message_ids, new_history_id = sync_message_ids(gmail_service, sync_state, profile.get('historyId'), ai_processed_id)
+            except Exception as e:
+                print(f"Failed to fetch emails: {e}")
+                return None
+
+        # Durable queue: new mail is checkpointed before the cursor moves, earlier failures are retried
+        if work and backfill is None:
+            work.enqueue(message_ids)
+            save_sync_state(state_dir, {'history_id': new_history_id, 'synced_at': tick_started - 60})
+            new_ids = set(message_ids)
+            retries = [m for m in work.pending_ids(origin='live') if m not in new_ids]
+            if retries:
+                print(f"Retrying {len(retries)} unfinished emails from earlier runs.")
+            message_ids = work.claim(message_ids + retries, tick_owner)
+
+        telemetry.count("messages.listed", len(message_ids))
+        if not message_ids:
+            print("No new emails.")
+        else:
+            print(f"Found {len(message_ids)} emails to process.")
         
-    if not ai_processed_id:
-        print("Warning: AI Processed label ID not found in directives. Looking up dynamically...")
+        # 3. CONCURRENT PIPELINE: fetch -> prepare -> classify (batched) -> act -> mark processed
+        # Label changes are coalesced and applied at the end of the run
+        batch_size = int(os.environ.get("GMAIL_BATCH_SIZE", "50"))
+        concurrency = int(os.environ.get("PIPELINE_CONCURRENCY", "8"))
+        llm_batch_size = int(os.environ.get("LLM_BATCH_SIZE", "8"))
+        label_changes = LabelChanges()
+        headers_to_fetch = metadata_headers(rules)
+        cache = open_classification_cache(instructions, state_dir)
+        neighbours = open_neighbour_index(instructions, state_dir)
+        threads = open_thread_decisions(instructions, state_dir)
+        # Messages that reached the end of the pipeline (or were skipped) this tick
+        finished = set()
+        pacer = TokenBucket(BACKFILL_MESSAGES_PER_SECOND, batch_size) if backfill is not None else None
+        send_actions = backfill is None or BACKFILL_ACTIONS
+
+        # Reply drafts are generated by their own workers alongside (and after) the pipeline
+        draft_queue = open_draft_queue(state_dir) if send_actions else None
+        draft_workers = None
+        if draft_queue:
+            def draft_job(msg_id, thread_id):
+                with worker_services(creds) as (worker_gmail, _), telemetry.span("draft"):
+                    draft_id = create_reply_draft(worker_gmail, msg_id, thread_id, my_email)
+                telemetry.count("drafts", outcome="created" if draft_id else "skipped")
+                if draft_id:
+                    print(f"Drafted reply to {msg_id} ({draft_id})")
+                return draft_id
+            draft_workers = DraftWorkers(draft_queue, draft_job, int(os.environ.get("DRAFT_CONCURRENCY", "2")))
+            draft_workers.start()
+
+        def fail(msg_id, err):
+            print(f"Failed processing {msg_id}: {err}")
+            telemetry.count("messages.failed")
+            if work:
+                work.fail(msg_id, err)
+
+        def fetch_stage():
+            for start in range(0, len(message_ids), batch_size):
+                chunk = message_ids[start:start + batch_size]
+                if pacer:
+                    paced = pacer.reserve(len(chunk))
+                    telemetry.count("backfill.paced_seconds", paced)
+                    time.sleep(paced)
+                fetched = batch_get_messages(gmail_service, chunk, fmt='metadata', batch_size=batch_size,
+                                             metadataHeaders=headers_to_fetch)
+                for msg_id in chunk:
+                    yield msg_id, fetched.get(msg_id)
+
+        def prepare_stage(item):
+            msg_id, msg = item
+            try:
+                with worker_services(creds) as (worker_gmail, _):
+                    email = prepare_email(msg_id, msg, worker_gmail, ai_processed_id, my_email, label_changes, headers_to_fetch)
+                if email is None:
+                    finished.add(msg_id)
+                elif work:
+                    email['work'] = work.item(msg_id)
+                return email
+            except Exception as e:
+                fail(msg_id, e)
+                return None
+
+        def classify_stage(emails):
+            try:
+                # A category checkpointed by an earlier attempt is reused instead of asking again
+                known = [e for e in emails if e.get('work') and e['work'].category]
+                for email in known:
+                    email['category'] = email['work'].category
+                    telemetry.count("classify.source", source="checkpoint")
+                    print(f"Classified {email['id']} as: {email['category']} (checkpoint)")
+                fresh = [e for e in emails if e not in known]
+                with worker_services(creds) as (worker_gmail, _):
+                    classify_batch(fresh, instructions, cache, rules, neighbours, worker_gmail, threads)
+                    complete_messages(worker_gmail, known)
+                if work:
+                    for email in fresh:
+                        work.set_category(email['id'], email['category'])
+                return emails
+            except Exception as e:
+                for email in emails:
+                    fail(email['id'], e)
+                return []
+
+        def act_stage(email):
+            try:
+                with worker_services(creds) as (worker_gmail, worker_drive):
+                    act_on_email(email, email['category'], worker_gmail, worker_drive, labels, drive_root_id, my_email,
+                                 label_changes, folder_index=folder_index, attachment_index=attachment_index,
+                                 work_item=email.get('work'), drafts=draft_workers, send_actions=send_actions)
+                if work:
+                    work.set_stage(email['id'], 'acted')
+                return email
+            except Exception as e:
+                fail(email['id'], e)
+                return None
+
+        def mark_stage(email):
+            label_changes.add(email['id'], add=[ai_processed_id])
+            finished.add(email['id'])
+            telemetry.count("messages.processed")
+
+        run_pipeline(fetch_stage(), [
+            ("prepare", prepare_stage, concurrency),
+            ("classify", classify_stage, concurrency, max(1, llm_batch_size)),
+            ("act", act_stage, concurrency),
+            ("mark", mark_stage, 1),
+        ], queue_size=concurrency * 2)
+
+        with telemetry.span("labels.flush"):
+            unlabelled = flush_label_changes(gmail_service, label_changes, ai_processed_id, labels)
+        if work:
+            work.complete(finished - unlabelled)
+            work.release(tick_owner)
+            print(f"Work queue: {work.stats()}")
+
+        # Labels and AI Processed are applied; remaining drafts get a bounded share of the tick
+        if draft_workers:
+            with telemetry.span("drafts.drain"):
+                left = draft_workers.drain(float(os.environ.get("DRAFT_BUDGET_SECONDS", "120")))
+            telemetry.count("drafts.deferred", left)
+            print(f"Drafts: {draft_workers.created} created, {left} left for the next run, {draft_queue.stats()}")
+
+        if cache:
+            print(f"Classification cache: {cache.stats()}")
+        if neighbours:
+            print(f"Neighbour classifier: {neighbours.stats()}")
+        if threads:
+            print(f"Thread decisions: {threads.stats()}")
+        if attachment_index:
+            print(f"Attachment dedup: {attachment_index.stats()}")
+        print(f"Rate limits: {backend_stats(credentials_scope(creds))}")
+
+        report = None
+        if backfill is not None:
+            processed = len(finished - unlabelled)
+            report = record_slice(backfill, processed, len(message_ids) - processed, time.monotonic() - slice_started)
+            save_backfill_state(state_dir, backfill)
+            eta = f"{report['eta_s'] // 60} min" if report['eta_s'] is not None else "unknown"
+            print(f"Backfill: {report['processed']}/{report['total']} messages, {report['msgs_per_s']} msgs/s, ETA {eta}")
+
+        # Without the work queue, only advance the cursor once the delta has been handled
+        if not work and new_history_id is not None:
+            save_sync_state(state_dir, {'history_id': new_history_id, 'synced_at': tick_started - 60})
+        return report
+    finally:
+        if draft_workers:
+            draft_workers.drain(0)
+        if draft_queue:
+            draft_queue.close()
+        if work:
+            work.release(tick_owner)
+            work.close()
+        if cache:
+            cache.close()
+        if neighbours:
+            neighbours.save()
+        if threads:
+            threads.close()
+        if attachment_index:
+            attachment_index.close()
+        commit_state()
+
+
+def commit_state():
+    """Commits the state volume now (act workers share one container, so one commit at a time)."""
+    with _commit_lock:
         try:
-            results = gmail_service.users().labels().list(userId='me').execute()
-            ai_processed_id = next((l['id'] for l in results.get('labels', []) if l['name'] == 'AI Processed'), None)
-            
-            if not ai_processed_id:
-                print("Label 'AI Processed' not found in Gmail. Creating it...")
-                label_object = {
-                    'name': 'AI Processed',
-                    'labelListVisibility': 'labelShow',
-                    'messageListVisibility': 'hide'
-                }
-                new_label = gmail_service.users().labels().create(userId='me', body=label_object).execute()
-                ai_processed_id = new_label['id']
-                print(f"Created 'AI Processed' label: {ai_processed_id}")
+            state_volume.commit()
         except Exception as e:
-            print(f"Failed to lookup or create AI Processed label: {e}")
-            
-    # Read Drive Root ID
-    drive_root_id = None
+            print(f"Failed to commit state: {e}")
+
+
+def load_instructions(path=os.path.join(DIRECTIVES_DIR, "gmail_instructions.md")):
     try:
-        with open("/root/directives/drive_config.md", "r") as f:
-            for line in f:
-                if "Root_Folder_ID" in line:
-                    drive_root_id = line.split("`")[1]
+        with open(path, "r") as f:
+            return f.read()
+    except Exception:
+        return "Default instructions."
+
+def open_classification_cache(instructions, state_dir=STATE_DIR):
+    if os.environ.get("CLASSIFICATION_CACHE", "on").lower() in ("0", "off", "false"):
+        return None
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        return ClassificationCache(
+            os.path.join(state_dir, "classification_cache.sqlite"),
+            instructions,
+            ttl_seconds=float(os.environ.get("CLASSIFICATION_CACHE_TTL_DAYS", "30")) * 24 * 3600,
+            max_entries=int(os.environ.get("CLASSIFICATION_CACHE_MAX_ENTRIES", "50000"))
+        )
     except Exception as e:
-        print(f"Error reading drive config: {e}")
+        print(f"Classification cache unavailable: {e}")
+        return None
 
-    # Read Instructions
-    instructions = ""
+def open_work_queue(state_dir=STATE_DIR):
+    if os.environ.get("WORK_QUEUE", "on").lower() in ("0", "off", "false"):
+        return None
     try:
-        with open("/root/directives/gmail_instructions.md", "r") as f:
-            instructions = f.read()
-    except Exception:
-        instructions = "Default instructions."
+        os.makedirs(state_dir, exist_ok=True)
+        return WorkQueue(
+            os.path.join(state_dir, "work_queue.sqlite"),
+            max_attempts=int(os.environ.get("WORK_QUEUE_MAX_ATTEMPTS", "5")),
+            lease_seconds=int(os.environ.get("WORK_QUEUE_LEASE_SECONDS", "600"))
+        )
+    except Exception as e:
+        print(f"Work queue unavailable: {e}")
+        return None
 
-    # Get my own email to prevent loops
-    profile = gmail_service.users().getProfile(userId='me').execute()
-    my_email = profile.get('emailAddress', '').lower()
-    
-    # 2. ZERO-DUPLICATE POLLING
-    twenty_mins_ago = int((datetime.now() - timedelta(minutes=20)).timestamp())
-    query = f'label:INBOX -label:"AI Processed" after:{twenty_mins_ago}'
-    
-    print(f"Polling with query: {query}")
+def open_draft_queue(state_dir=STATE_DIR):
+    if os.environ.get("DRAFT_QUEUE", "on").lower() in ("0", "off", "false"):
+        return None
     try:
-        results = gmail_service.users().messages().list(userId='me', q=query, maxResults=50).execute()
-        messages = results.get('messages', [])
+        os.makedirs(state_dir, exist_ok=True)
+        return DraftQueue(os.path.join(state_dir, "draft_queue.sqlite"))
     except Exception as e:
-        print(f"Failed to fetch emails: {e}")
-        return
+        print(f"Draft queue unavailable: {e}")
+        return None
 
-    if not messages:
-        print("No new emails.")
-        return
-        
-    print(f"Found {len(messages)} emails to process.")
-    
-    for msg_ref in messages:
-        msg_id = msg_ref['id']
-        process_single_email(msg_id, gmail_service, drive_service, creds, labels_map, ai_processed_id, drive_root_id, instructions, my_email)
+def open_attachment_index(state_dir=STATE_DIR):
+    if os.environ.get("ATTACHMENT_DEDUP", "on").lower() in ("0", "off", "false"):
+        return None
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        return AttachmentIndex(
+            os.path.join(state_dir, "attachment_index.sqlite"),
+            trust_metadata=os.environ.get("ATTACHMENT_DEDUP_TRUST_METADATA", "off").lower() in ("1", "on", "true"),
+            shortcuts=os.environ.get("ATTACHMENT_DEDUP_SHORTCUTS", "on").lower() not in ("0", "off", "false")
+        )
+    except Exception as e:
+        print(f"Attachment index unavailable: {e}")
+        return None
+
+def open_neighbour_index(instructions, state_dir=STATE_DIR):
+    if os.environ.get("KNN_CLASSIFIER", "on").lower() in ("0", "off", "false"):
+        return None
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        return NeighbourIndex(
+            os.path.join(state_dir, "knn_index.npz"),
+            instructions_version(instructions),
+            k=int(os.environ.get("KNN_K", "5")),
+            threshold=float(os.environ.get("KNN_THRESHOLD", "0.85")),
+            agreement=float(os.environ.get("KNN_AGREEMENT", "0.8"))
+        )
+    except Exception as e:
+        print(f"Neighbour classifier unavailable: {e}")
+        return None
+
+def open_thread_decisions(instructions, state_dir=STATE_DIR):
+    if os.environ.get("THREAD_REUSE", "on").lower() in ("0", "off", "false"):
+        return None
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        return ThreadDecisions(
+            os.path.join(state_dir, "thread_decisions.sqlite"),
+            instructions,
+            ttl_seconds=float(os.environ.get("THREAD_DECISION_TTL_DAYS", "14")) * 24 * 3600
+        )
+    except Exception as e:
+        print(f"Thread decisions unavailable: {e}")
+        return None
+
+@app.function(image=image, volumes={STATE_DIR: state_volume})
+def evaluate_neighbours(sample: int = 2000, account_id: str = DEFAULT_ACCOUNT):
+    """Offline check of the neighbour index: accuracy vs. the LLM and share of LLM calls avoided.
+
+    Run with: python -m modal run execution/gmail_bot.py::evaluate_neighbours
+    """
+    account = next((a for a in load_accounts(DIRECTIVES_DIR, STATE_DIR) if a.account_id == account_id), None)
+    if account is None:
+        print(f"Unknown account {account_id}")
+        return None
+    instructions = load_instructions(account.directive("gmail_instructions.md"))
+    index = open_neighbour_index(instructions, account.state_dir)
+    if not index or not len(index):
+        print("Neighbour index is empty.")
+        return None
+    report = index.evaluate(sample=sample)
+    print(f"Neighbour classifier evaluation: {report}")
+    return report
+
+@app.function(image=image, secrets=[modal.Secret.from_name("gmail-bot-secrets")], volumes={STATE_DIR: state_volume})
+def startup_benchmark(rounds: int = 3):
+    """Measures credential, discovery and client setup cost, cold vs. warm.
+
+    Run with: python -m modal run execution/gmail_bot.py::startup_benchmark
+    """
+    token_json = os.environ.get("GOOGLE_TOKEN_JSON")
+    if not token_json:
+        print("Error: GOOGLE_TOKEN_JSON not found.")
+        return None
+    report = benchmark_startup(token_json, STATE_DIR, rounds=rounds)
+    print(f"Startup benchmark: {report}")
+    return report
 
+@app.function(image=record_image, secrets=[modal.Secret.from_name("gmail-bot-secrets")], volumes={STATE_DIR: state_volume},
+              timeout=RECORD_TIMEOUT_SECONDS)
+def record_traffic(account_id: str = DEFAULT_ACCOUNT, after: str = "", before: str = "", query: str = "",
+                   limit: int = 200, actions: bool = False, write: bool = False):
+    """Records a redacted cassette of one backfill slice for offline replay (see traffic_replay.py).
+
+    Read-only unless `write`: labels, uploads and sends are answered locally
+    instead. Holds the account's lease, so live syncs wait for it.
+
+    Run with: python -m modal run execution/gmail_bot.py::record_traffic --after 2024/01/01 --limit 200
+    Then fetch it with: modal volume get gmail-bot-state cassettes/<file>
+    """
+    from traffic_replay import record_backfill
+
+    account = next((a for a in load_accounts(DIRECTIVES_DIR, STATE_DIR) if a.account_id == account_id), None)
+    if account is None:
+        print(f"Unknown account {account_id}")
+        return None
+    path = os.path.join(STATE_DIR, "cassettes", f"{account_id}-{int(time.time())}.jsonl.gz")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lease = SyncLease(push_state, lease_seconds=RECORD_TIMEOUT_SECONDS)
+    summary = record_backfill(account, build_backfill_query(after, before, query), path,
+                              limit=limit, actions=actions, write=write, lease=lease)
+    if summary is None:
+        return "busy"
+    state_volume.commit()
+    return {"path": path, **summary}
+
+def flush_label_changes(gmail_service, label_changes, ai_processed_id, labels=None):
+    """Applies queued label changes. Returns the IDs whose changes could not be applied."""
+    unlabelled = set()
+    for failed_ids, add, remove, err in label_changes.flush(gmail_service):
+        if labels and ai_processed_id and ai_processed_id in add:
+            if retry_ai_processed_label(gmail_service, failed_ids, add, remove, labels, err):
+                continue
+        unlabelled.update(failed_ids)
+    return unlabelled
+
+def retry_ai_processed_label(gmail_service, msg_ids, add, remove, labels, err):
+    """Re-resolves the labels of a failed change (one fresh listing, re-creating AI Processed if it was deleted) and retries it."""
+    print(f"Failed to apply AI Processed label, re-resolving labels: {err}")
+    if not labels.refresh(gmail_service, force=True):
+        return False
+    real_ai_processed = labels.get_or_create(gmail_service, AI_PROCESSED_LABEL, message_visibility='hide')
+    if not real_ai_processed:
+        return False
+
+    # Labels deleted from the mailbox since they were resolved are dropped
+    add = [l for l in add if labels.has_id(l)]
+    if real_ai_processed not in add:
+        add.append(real_ai_processed)
+    retry = LabelChanges()
+    for msg_id in msg_ids:
+        retry.add(msg_id, add=add, remove=remove)
+    if not retry.flush(gmail_service):
+        print(f"Successfully marked {len(msg_ids)} messages as AI Processed on retry.")
+        return True
+    print("Critical error applying AI Processed label.")
+    return False
 
 def get_header(headers, name):
     for h in headers:
@@ -130,7 +725,25 @@ def get_header(headers, name):
             return h['value']
     return ""
 
-def download_and_upload_attachments(msg_id, msg_payload, gmail_service, drive_service, category, drive_root_id, sender_name, date_str):
+# Shared by every worker thread: caps attachment bytes held in memory at once
+attachment_budget = ByteBudget(int(float(os.environ.get("ATTACHMENT_INFLIGHT_MB", "64")) * MB))
+
+def resolve_target_folder(drive_service, drive_root_id, category, folder_index=None):
+    # Find the target folder ID (category or Misc)
+    with telemetry.span("drive.resolve_folder"):
+        return _resolve_target_folder(drive_service, drive_root_id, category, folder_index)
+
+def _resolve_target_folder(drive_service, drive_root_id, category, folder_index=None):
+    if folder_index:
+        target_folder_id = folder_index.get(category) or folder_index.get_or_create(drive_service, "Misc")
+    else:
+        target_folder_id = get_or_create_drive_folder(drive_service, drive_root_id, category)
+        if not target_folder_id:
+            target_folder_id = get_or_create_drive_folder(drive_service, drive_root_id, "Misc")
+    return target_folder_id or drive_root_id
+
+def download_and_upload_attachments(msg_id, msg_payload, gmail_service, drive_service, category, drive_root_id, sender_name, date_str,
+                                    folder_index=None, attachment_index=None):
     if not drive_root_id:
         return
         
@@ -138,37 +751,49 @@ def download_and_upload_attachments(msg_id, msg_payload, gmail_service, drive_se
     if 'parts' in msg_payload:
         parts = msg_payload['parts']
         
-    # Find the target folder ID (category or Misc)
-    target_folder_id = get_or_create_drive_folder(drive_service, drive_root_id, category)
-    if not target_folder_id:
-        target_folder_id = get_or_create_drive_folder(drive_service, drive_root_id, "Misc")
-        
-    if not target_folder_id:
-        target_folder_id = drive_root_id
+    target_folder_id = None
 
     for part in parts:  # type: ignore
         if part.get('filename') and part.get('body') and 'attachmentId' in part['body']:
-            att_id = part['body']['attachmentId']
             filename = part['filename']
+            # Resolved lazily, so messages without attachments cost no Drive calls
+            if not target_folder_id:
+                target_folder_id = resolve_target_folder(drive_service, drive_root_id, category, folder_index)
             try:
-                # Download from Gmail
-                att = gmail_service.users().messages().attachments().get(userId='me', messageId=msg_id, id=att_id).execute()
-                file_data = base64.urlsafe_b64decode(att['data'].encode('UTF-8'))
-                
                 # Sanitize components for filename
                 clean_sender = "".join(c for c in sender_name if c.isalnum() or c in " ._-").strip()
                 clean_sender = clean_sender[:20]  # type: ignore
                 new_filename = f"{date_str}-{clean_sender}-{filename}"
                 
-                # Upload to Drive
                 file_metadata = {
                     'name': new_filename,
                     'parents': [target_folder_id] if target_folder_id else []
                 }
-                media = MediaIoBaseUpload(io.BytesIO(file_data), mimetype=part.get('mimeType'), resumable=True)
-                drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-                print(f"Saved attachment {filename} to Drive as {new_filename}")
+                
+                def on_parent_missing(missing_id):
+                    # The indexed folder was deleted: forget it and retry against a fresh resolution
+                    nonlocal target_folder_id
+                    if not folder_index or missing_id == drive_root_id:
+                        return None
+                    print(f"Drive folder {missing_id} is gone, re-resolving...")
+                    folder_index.invalidate(missing_id)
+                    target_folder_id = resolve_target_folder(drive_service, drive_root_id, category, folder_index)
+                    return target_folder_id
+                
+                # Stream from Gmail to Drive without holding decoded copies in memory
+                _, stats = transfer_attachment(
+                    gmail_service, drive_service, msg_id, part, file_metadata,
+                    budget=attachment_budget,
+                    chunk_size=int(float(os.environ.get("ATTACHMENT_CHUNK_MB", "8")) * MB),
+                    single_shot_limit=int(float(os.environ.get("ATTACHMENT_SINGLE_SHOT_MB", "5")) * MB),
+                    on_parent_missing=on_parent_missing,
+                    dedup=attachment_index
+                )
+                telemetry.count("attachments", mode=stats['mode'])
+                telemetry.count("attachments.bytes", stats['bytes'], mode=stats['mode'])
+                print(f"Saved attachment {filename} to Drive as {new_filename} {stats}")
             except Exception as e:
+                telemetry.count("attachments", mode="failed")
                 print(f"Failed to process attachment {filename}: {e}")
 
 def get_or_create_drive_folder(drive_service, parent_id, folder_name):
@@ -193,242 +818,490 @@ def get_or_create_drive_folder(drive_service, parent_id, folder_name):
         print(f"Error finding folder {folder_name}: {e}")
     return None
 
-def classify_email(subject, body, instructions):
-    api_key = os.environ.get("OPENAI_API_KEY") or os.environ.get("GROQ_API_KEY")
-    client_kwargs = {"api_key": api_key}
-    model = "gpt-4o-mini"
-    
-    if api_key and api_key.startswith("gsk_"): 
-        client_kwargs["base_url"] = "https://api.groq.com/openai/v1"
-        model = "llama-3.1-8b-instant"
-        
-    if not api_key:
-        print("No AI key found, defaulting to Misc")
-        return "Misc"
-        
-    from openai import OpenAI  # type: ignore
-    filtered_kwargs = {k: v for k, v in client_kwargs.items() if v is not None}
-    client = OpenAI(**filtered_kwargs)  # type: ignore
-    
-    prompt = f"""
+CATEGORY_RULES = """
     You are an AI Email assistant with the ability to dynamically categorize emails.
     Disregard any Ignore-Sender rules for this specific task.
     Classify the following email into the MOST APPROPRIATE category. 
     You MUST output EXACTLY ONE of these standard categories if it fits: 'Personal', 'Accounting', 'Social', 'Promotional', 'Sales', 'Recruitment', or 'Misc'.
     Do NOT combine categories (e.g., do not output "Misc/Sales" or "Social/Promotional"). Pick the single best fit.
     Only if the email is highly specific and sits completely outside these standards, you may invent a concise, relevant new category name (max 2 words).
+    """
+
+# Body tokens sent per email: alone, and when several emails share one classification request
+PROMPT_BODY_TOKENS = int(os.environ.get("PROMPT_BODY_TOKENS", "250"))
+PROMPT_BATCH_BODY_TOKENS = int(os.environ.get("PROMPT_BATCH_BODY_TOKENS", "125"))
+
+@functools.lru_cache(maxsize=8)
+def get_prompt_builder(instructions):
+    return PromptBuilder(
+        CATEGORY_RULES, instructions, PROMPT_BODY_TOKENS, PROMPT_BATCH_BODY_TOKENS,
+        int(os.environ.get("PROMPT_INSTRUCTION_TOKENS", "1500"))
+    )
+
+def clean_category(result):
+    """Normalizes raw model output into a label name, or None if it isn't usable."""
+    clean_result = str(result).replace('"', '').replace("'", "").strip().title()
+    if len(clean_result) > 0 and len(clean_result) < 30:
+        return clean_result
+    return None
+
+def chat_completion(client, model, prompt, max_tokens, temperature, purpose="chat", system=None):
+    """One chat completion under the shared LLM request/token budget. Raises Saturated when backed off.
+
+    `purpose` (classify, classify_batch, draft) labels its span and token counters.
+    A `system` prompt goes first, where providers can cache it across calls.
+    """
+    llm = get_backend('llm')
+    messages = ([{"role": "system", "content": system}] if system else []) + [{"role": "user", "content": prompt}]
+    # ~4 characters per token for the prompt, plus the reply allowance
+    estimate = (len(prompt) + len(system or "")) // 4 + max_tokens
+    resp = llm.call(
+        lambda: client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        ),
+        method=f"llm.{purpose}", requests=1, tokens=estimate
+    )
+    usage = getattr(resp, 'usage', None)
+    if usage and getattr(usage, 'total_tokens', None):
+        llm.adjust('tokens', usage.total_tokens - estimate)
+        telemetry.count("llm.tokens", getattr(usage, 'prompt_tokens', 0) or 0, kind="prompt", purpose=purpose)
+        telemetry.count("llm.tokens", getattr(usage, 'completion_tokens', 0) or 0, kind="completion", purpose=purpose)
+    return resp.choices[0].message.content or ""
+
+def classify_email(subject, body, instructions, default="Misc"):
+    """Returns the category, or `default` when no model answer could be obtained."""
+    client, model = get_llm_client()
+    if not client:
+        print("No AI key found, defaulting to Misc")
+        return default
     
-    INSTRUCTIONS: {instructions}
-    
-    Reply ONLY with the exact category name. Do not include quotes, punctuation, or explanations.
+    system, prompt = get_prompt_builder(instructions).classify(subject, body)
     
-    SUBJECT: {subject}
-    BODY: {body[:1000]}
+    try:
+        # Slightly higher temperature for dynamic category creation
+        result = chat_completion(client, model, prompt, max_tokens=10, temperature=0.2, purpose="classify", system=system).strip()
+        
+        # Clean up the output to ensure it's a valid label name
+        return clean_category(result) or "Misc"
+        
+    except Saturated as e:
+        print(f"LLM saturated ({e}), defaulting to {default}")
+    except Exception as e:
+        print(f"Classify error: {e}")
+            
+    return default
+
+def parse_batch_categories(text, ids):
+    """Parses a {"<id>": "<category>"} reply. Returns {id: category} for the IDs that parsed."""
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end <= start:
+        return {}
+    try:
+        raw = json.loads(text[start:end + 1])
+    except ValueError:
+        return {}
+    if not isinstance(raw, dict):
+        return {}
+    parsed = {}
+    for key, value in raw.items():
+        key = str(key).strip()
+        category = clean_category(value) if isinstance(value, str) else None
+        if key in ids and category:
+            parsed[key] = category
+    return parsed
+
+def classify_emails(emails, instructions, default="Misc"):
+    """Classifies several emails with one request. `emails` is a list of (subject, body).
+
+    Returns categories in the same order. Items the model skipped or mangled
+    fall back to a single `classify_email` call.
     """
+    if len(emails) == 1:
+        return [classify_email(emails[0][0], emails[0][1], instructions, default)]
     
-    for attempt in range(3):
-        try:
-            resp = client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=10,
-                temperature=0.2  # Slightly higher temperature for dynamic category creation
-            )
-            result = resp.choices[0].message.content.strip()
-            
-            # Clean up the output to ensure it's a valid label name
-            clean_result = result.replace('"', '').replace("'", "").strip().title()
-            if len(clean_result) > 0 and len(clean_result) < 30:
-                return clean_result
-            return "Misc"
-            
-        except Exception as e:
-            print(f"Classify error (attempt {attempt+1}): {e}")
-            time.sleep(2 ** attempt)
-            
-    return "Misc"
+    client, model = get_llm_client()
+    if not client:
+        print("No AI key found, defaulting to Misc")
+        return [default] * len(emails)
     
-def draft_reply(subject, body):
-    api_key = os.environ.get("OPENAI_API_KEY") or os.environ.get("GROQ_API_KEY")
-    client_kwargs = {"api_key": api_key}
-    model = "gpt-4o-mini"
+    ids = [str(n + 1) for n in range(len(emails))]
+    system, prompt = get_prompt_builder(instructions).classify_batch(
+        [(email_id, subject, body) for email_id, (subject, body) in zip(ids, emails)]
+    )
     
-    if api_key and api_key.startswith("gsk_"): 
-        client_kwargs["base_url"] = "https://api.groq.com/openai/v1"
-        model = "llama-3.1-8b-instant"
-        
-    if not api_key:
+    parsed = {}
+    try:
+        reply = chat_completion(client, model, prompt, max_tokens=12 * len(emails) + 20, temperature=0.2,
+                                purpose="classify_batch", system=system)
+        parsed = parse_batch_categories(reply, set(ids))
+    except Saturated as e:
+        print(f"LLM saturated ({e}), defaulting {len(emails)} emails to {default}")
+        return [default] * len(emails)
+    except Exception as e:
+        print(f"Batch classify error for {len(emails)} emails: {e}")
+    
+    if len(parsed) < len(ids):
+        print(f"Batch classify parsed {len(parsed)}/{len(ids)}, falling back to single calls for the rest.")
+    return [
+        parsed.get(email_id) or classify_email(subject, body, instructions, default)
+        for email_id, (subject, body) in zip(ids, emails)
+    ]
+    
+def classify_batch(emails, instructions, cache=None, rules=None, neighbours=None, gmail_service=None, threads=None):
+    """Sets email['category'] on prepared emails.
+
+    Rules are tried first on metadata alone, then the thread's earlier
+    decision (ThreadDecisions), so follow-ups in a known conversation cost
+    nothing. Bodies are then fetched (one batch) only for the rest, which go
+    to the exact cache, then the nearest-neighbour index; only what's left
+    goes to the LLM, one message per thread. Finally, messages whose action
+    needs more than metadata are completed.
+    """
+    remaining = []
+    # thread ID -> messages waiting for the one classification of their thread
+    followers = {}
+    claimed = []
+    for email in emails:
+        if rules:
+            msg = email['msg']
+            matched = rules.match(email['sender'], msg.get('labelIds', []), msg['payload'].get('headers', []))
+            if matched:
+                email['category'] = matched
+                telemetry.count("classify.source", source="rule")
+                print(f"Classified {email['id']} as: {matched} (rule)")
+                continue
+        thread_id = email['msg'].get('threadId') if threads else None
+        if thread_id:
+            if thread_id in followers:
+                followers[thread_id].append(email)
+                continue
+            if inherit_thread_category(email, threads):
+                continue
+            followers[thread_id] = []
+            if not threads.claim(thread_id):
+                # Another worker is classifying this thread right now
+                followers[thread_id].append(email)
+                continue
+            claimed.append(thread_id)
+        remaining.append(email)
+
+    try:
+        classify_remaining(remaining, instructions, cache, neighbours, gmail_service, threads)
+    finally:
+        for thread_id in claimed:
+            threads.release(thread_id)
+
+    unresolved = []
+    for thread_id, waiting in followers.items():
+        if waiting and thread_id not in claimed:
+            threads.wait(thread_id)
+        unresolved += [email for email in waiting if not inherit_thread_category(email, threads)]
+    # New participants or subjects inside the thread are classified on their own
+    classify_remaining(unresolved, instructions, cache, neighbours, gmail_service, threads)
+
+    if gmail_service:
+        complete_messages(gmail_service, emails)
+    return emails
+
+def inherit_thread_category(email, threads):
+    category = threads.lookup(email['msg']['threadId'], email['sender'], email['subject'])
+    if not category:
+        return False
+    email['category'] = category
+    telemetry.count("classify.source", source="thread")
+    print(f"Classified {email['id']} as: {category} (thread)")
+    return True
+
+def classify_remaining(emails, instructions, cache=None, neighbours=None, gmail_service=None, threads=None):
+    """Body-based classification for `classify_batch`: exact cache, neighbours, then the LLM."""
+    if not emails:
+        return
+    if gmail_service:
+        fetch_full_messages(gmail_service, emails)
+    
+    pending = []
+    # Emails with a real decision; a default after a failed or saturated call is not one
+    decided = []
+    for email in emails:
+        if cache:
+            email['fingerprint'] = email_fingerprint(email['sender'], email['subject'], email['body'])
+            cached = cache.get(email['fingerprint'])
+            if cached:
+                email['category'] = cached
+                decided.append(email)
+                telemetry.count("classify.source", source="cache")
+                print(f"Classified {email['id']} as: {cached} (cached)")
+                continue
+        if neighbours:
+            predicted = neighbours.predict(email['subject'], email['body'])
+            if predicted:
+                email['category'] = predicted
+                decided.append(email)
+                telemetry.count("classify.source", source="neighbours")
+                print(f"Classified {email['id']} as: {predicted} (neighbours)")
+                continue
+        pending.append(email)
+    
+    if pending:
+        categories = classify_emails([(e['subject'], e['body']) for e in pending], instructions, default=None)
+        for email, category in zip(pending, categories):
+            if category and cache:
+                cache.put(email['fingerprint'], category)
+            if category and neighbours:
+                neighbours.add(email['subject'], email['body'], category)
+            if category:
+                decided.append(email)
+            email['category'] = category or "Misc"
+            telemetry.count("classify.source", source="llm" if category else "default")
+            print(f"Classified {email['id']} as: {email['category']}")
+
+    if threads:
+        for email in decided:
+            if email['msg'].get('threadId'):
+                threads.record(email['msg']['threadId'], email['sender'], email['subject'], email['category'])
+
+def draft_reply(subject, body, context=""):
+    client, model = get_llm_client()
+    if not client:
         return "Hello! I received your email. I will get back to you soon."
-        
-    from openai import OpenAI  # type: ignore
-    filtered_kwargs = {k: v for k, v in client_kwargs.items() if v is not None}
-    client = OpenAI(**filtered_kwargs)  # type: ignore
     
-    prompt = f"Write a natural, friendly, and concise reply to this email. SUBJECT: {subject}\n\nBODY: {body[:1000]}"
+    system, prompt = reply_prompt(subject, body, context, PROMPT_BODY_TOKENS)
     try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=500,
-            temperature=0.6
-        )
-        return resp.choices[0].message.content.strip()
-    except Exception:
+        return chat_completion(client, model, prompt, max_tokens=500, temperature=0.6, purpose="draft", system=system).strip()
+    except Exception as e:
+        print(f"Draft reply error: {e}")
         return "Hello! I received your email. I will get back to you soon."
 
-def get_body(msg_payload):
-    body = ""
-    if 'parts' in msg_payload:
-        for part in msg_payload['parts']:  # type: ignore
-            if part['mimeType'] == 'text/plain':
-                data = part['body'].get('data')
-                if data:
-                    body += base64.urlsafe_b64decode(data).decode('utf-8')  # type: ignore
-    elif 'body' in msg_payload and 'data' in msg_payload['body']:
-        data = msg_payload['body']['data']
-        body = base64.urlsafe_b64decode(data).decode('utf-8')  # type: ignore
-    return body
-
-def process_single_email(msg_id, gmail_service, drive_service, creds, labels_map, ai_processed_id, drive_root_id, instructions, my_email):
+# Reply drafting: personal mail first, and at most this much of the earlier thread in the prompt
+DRAFT_PRIORITY = {'personal': 0, 'primary': 1}
+THREAD_CONTEXT_MESSAGES = 4
+THREAD_CONTEXT_CHARS = 1500
+
+def create_reply_draft(gmail_service, msg_id, thread_id, my_email):
+    """Drafts a reply to `msg_id` from its whole thread, fetched in one call. Returns the draft ID.
+
+    Returns None without drafting when a later message in the thread is
+    already ours (a reply or draft exists), or when someone wrote again
+    later: one draft answers the latest message, so a burst of replies in
+    a thread gets a single draft.
+    """
+    if not thread_id:
+        thread = {'messages': [gmail_service.users().messages().get(userId='me', id=msg_id, format='full').execute()]}
+    else:
+        thread = gmail_service.users().threads().get(userId='me', id=thread_id, format='full').execute()
+    messages = sorted(thread.get('messages', []), key=lambda m: int(m.get('internalDate', 0)))
+    position = next((n for n, m in enumerate(messages) if m['id'] == msg_id), None)
+    if position is None:
+        raise ValueError(f"Message {msg_id} not found in thread {thread_id}")
+    target = messages[position]
+    for later in messages[position + 1:]:
+        if 'DRAFT' in later.get('labelIds', []) or my_email in get_header(later['payload']['headers'], 'From').lower():
+            print(f"Skipping draft for {msg_id}, thread already has a reply.")
+            return None
+    if messages[position + 1:]:
+        print(f"Skipping draft for {msg_id}, a later message in the thread gets the reply.")
+        return None
+
+    headers = target['payload']['headers']
+    sender = get_header(headers, 'From')
+    subject = get_header(headers, 'Subject')
+    context = []
+    for earlier in messages[max(0, position - THREAD_CONTEXT_MESSAGES):position]:
+        earlier_from = get_header(earlier['payload']['headers'], 'From')
+        context.append(f"FROM: {earlier_from}\n{extract_body(earlier['payload'], BODY_CHAR_BUDGET)}")
+    reply_body = draft_reply(subject, extract_body(target['payload'], BODY_CHAR_BUDGET), "\n\n".join(context)[-THREAD_CONTEXT_CHARS:])
+
+    reply_msg = EmailMessage()
+    reply_msg.set_content(reply_body)
+    reply_msg['To'] = sender
+    reply_msg['Subject'] = subject if subject.lower().startswith('re:') else f"Re: {subject}"
+    message_id = get_header(headers, 'Message-ID')
+    if message_id:
+        reply_msg['In-Reply-To'] = message_id
+        reply_msg['References'] = f"{get_header(headers, 'References')} {message_id}".strip()
+    
+    raw_reply = base64.urlsafe_b64encode(reply_msg.as_bytes()).decode()
+    draft = gmail_service.users().drafts().create(
+        userId='me', 
+        body={
+            'message': {
+                'raw': raw_reply,
+                'threadId': target.get('threadId')
+            }
+        }
+    ).execute()
+    return draft.get('id')
+
+# Tiered fetch: metadata first, then the message structure or the full body only when a stage needs it
+METADATA_HEADERS = ['From', 'Subject', 'Date', 'List-Unsubscribe', 'Precedence']
+PART_FIELDS = 'partId,mimeType,filename,headers,body(size,attachmentId)'
+STRUCTURE_FIELDS = f'id,threadId,labelIds,payload({PART_FIELDS},parts({PART_FIELDS},parts({PART_FIELDS})))'
+# Body characters kept for prompts (classification and reply drafting)
+BODY_CHAR_BUDGET = 1000
+BODY_CATEGORIES = ['accounting', 'personal', 'primary']
+
+def metadata_headers(rules=None):
+    headers = list(METADATA_HEADERS)
+    if rules:
+        headers += [h for h in rules.header_names() if h.lower() not in (x.lower() for x in headers)]
+    return headers
+
+def may_have_attachments(msg):
+    mime_type = msg.get('payload', {}).get('mimeType', '')
+    return mime_type not in ('text/plain', 'text/html', 'multipart/alternative')
+
+def set_full_message(email, msg):
+    email['msg'] = msg
+    email['tier'] = 'full'
+    email['body'] = extract_body(msg['payload'], BODY_CHAR_BUDGET)
+
+def fetch_full_messages(gmail_service, emails):
+    """Upgrades metadata-tier emails to full messages with one batch request."""
+    missing = [e for e in emails if e.get('tier') != 'full']
+    if not missing:
+        return
+    fetched = batch_get_messages(gmail_service, [e['id'] for e in missing], fmt='full')
+    for email in missing:
+        msg = fetched.get(email['id'])
+        try:
+            if msg is None:
+                msg = gmail_service.users().messages().get(userId='me', id=email['id'], format='full').execute()
+            set_full_message(email, msg)
+        except Exception as e:
+            print(f"Failed to fetch body of {email['id']}: {e}")
+
+def complete_messages(gmail_service, emails):
+    """After classification: full bodies for body-dependent actions, part structure for attachments."""
+    fetch_full_messages(gmail_service, [e for e in emails if e['category'].lower() in BODY_CATEGORIES])
+    need_structure = [e for e in emails if e.get('tier') == 'metadata' and may_have_attachments(e['msg'])]
+    if need_structure:
+        fetched = batch_get_messages(gmail_service, [e['id'] for e in need_structure], fmt='full', fields=STRUCTURE_FIELDS)
+        for email in need_structure:
+            if email['id'] in fetched:
+                email['msg'] = fetched[email['id']]
+                email['tier'] = 'structure'
+
+def prepare_email(msg_id, msg, gmail_service, ai_processed_id, my_email, label_changes, headers_to_fetch=None):
+    """Returns the parsed email ready for classification, or None if it should be skipped.
+
+    Works on a metadata-format message; the body is only loaded by later stages.
+    """
     print(f"Processing message {msg_id}...")
-    try:
-        msg = gmail_service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-        headers = msg['payload']['headers']
+    if msg is None:
+        msg = gmail_service.users().messages().get(
+            userId='me', id=msg_id, format='metadata', metadataHeaders=headers_to_fetch or METADATA_HEADERS
+        ).execute()
+    if ai_processed_id and ai_processed_id in msg.get('labelIds', []):
+        print(f"Skipping {msg_id}, already AI Processed.")
+        return None
+    headers = msg['payload']['headers']
+    
+    sender = get_header(headers, 'From')
+    subject = get_header(headers, 'Subject')
+    date_str_full = get_header(headers, 'Date')
+    date_str = date_str_full[:10]  # type: ignore
+    
+    # Self-prevention loop
+    if my_email in sender.lower() or "daemon" in sender.lower() or "noreply" in sender.lower():
+        print(f"Skipping email from myself/system: {sender}")
+        label_changes.add(msg_id, add=[ai_processed_id])
+        return None
         
-        sender = get_header(headers, 'From')
-        subject = get_header(headers, 'Subject')
-        date_str_full = get_header(headers, 'Date')
-        date_str = date_str_full[:10]  # type: ignore
+    email = {
+        'id': msg_id,
+        'msg': msg,
+        'sender': sender,
+        'subject': subject,
+        'date_str': date_str,
+        'tier': 'metadata',
+        'body': "",
+    }
+    # A message handed over in full format needs no second fetch
+    if msg['payload'].get('parts') or msg['payload'].get('body', {}).get('data'):
+        set_full_message(email, msg)
+    return email
+
+def act_on_email(email, category, gmail_service, drive_service, labels, drive_root_id, my_email, label_changes,
+                 folder_index=None, attachment_index=None, work_item=None, drafts=None, send_actions=True):
+    """Runs the category's side effects. With a work_item, effects already checkpointed are skipped.
+
+    With `drafts` (DraftWorkers), reply drafting is queued instead of done inline.
+    With `send_actions` off (backfill of old mail), forwards and drafts are skipped.
+    """
+    def already(effect):
+        if work_item and work_item.done(effect):
+            print(f"Skipping {effect} for {email['id']}, already done.")
+            return True
+        return False
+    
+    def checkpoint(effect):
+        if work_item:
+            work_item.record(effect)
+            # Sends cannot be repeated safely, so their checkpoint is persisted at once
+            if effect in ('forward', 'draft'):
+                commit_state()
+    
+    msg_id = email['id']
+    # Queued drafts fetch their own thread, so only inline actions need the body here
+    needs_body = category.lower() in BODY_CATEGORIES and not (drafts and category.lower() in DRAFT_PRIORITY)
+    if email.get('tier') == 'metadata' and (needs_body or may_have_attachments(email['msg'])):
+        set_full_message(email, gmail_service.users().messages().get(userId='me', id=msg_id, format='full').execute())
+    msg = email['msg']
+    sender = email['sender']
+    subject = email['subject']
+    
+    # Attachments
+    if not already('attachments'):
+        with telemetry.span("attachments"):
+            download_and_upload_attachments(msg_id, msg['payload'], gmail_service, drive_service, category, drive_root_id, sender, email['date_str'],
+                                            folder_index=folder_index, attachment_index=attachment_index)
+        checkpoint('attachments')
+    
+    # Actions
+    category_lower = category.lower()
+    
+    if category_lower in ['social', 'promotional']:
+        # Mark as read and archive
+        label_changes.add(msg_id, remove=['UNREAD', 'INBOX'])
+        print("Queued archive for Social/Promo.")
         
-        # Self-prevention loop
-        if my_email in sender.lower() or "daemon" in sender.lower() or "noreply" in sender.lower():
-            print(f"Skipping email from myself/system: {sender}")
-            if ai_processed_id:
-                gmail_service.users().messages().modify(userId='me', id=msg_id, body={'addLabelIds': [ai_processed_id]}).execute()
+    elif category_lower in ['accounting']:
+        if already('forward') or not send_actions:
             return
-            
-        body = get_body(msg['payload'])
-        
-        # Classify
-        category = classify_email(subject, body, instructions)
-        print(f"Classified {msg_id} as: {category}")
+        # Forward
+        accounting_email = os.environ.get("ACCOUNTING_EMAIL", my_email)
+        print(f"Forwarding to Accounting ({accounting_email})")
+        fwd_msg = EmailMessage()
+        fwd_msg.set_content(f"Forwarded Accounting Email:\n\n{extract_body(msg['payload'], clean=False)}")
+        fwd_msg['To'] = accounting_email
+        fwd_msg['Subject'] = f"Fwd: {subject}"
         
-        # Attachments
-        download_and_upload_attachments(msg_id, msg['payload'], gmail_service, drive_service, category, drive_root_id, sender, date_str)
+        raw_fwd = base64.urlsafe_b64encode(fwd_msg.as_bytes()).decode()
+        gmail_service.users().messages().send(userId='me', body={'raw': raw_fwd}).execute()
+        checkpoint('forward')
+        print("Forwarded accounting email.")
         
-        # Actions
-        category_lower = category.lower()
+    elif category_lower in ['personal', 'primary']:
+        if already('draft') or not send_actions:
+            return
+        if drafts:
+            drafts.submit(msg_id, msg.get('threadId'), DRAFT_PRIORITY.get(category_lower, len(DRAFT_PRIORITY)))
+            checkpoint('draft')
+            print("Queued reply draft.")
+            return
+        print("Drafting reply...")
+        create_reply_draft(gmail_service, msg_id, msg.get('threadId'), my_email)
+        checkpoint('draft')
+        print("Drafted reply.")
         
-        if category_lower in ['social', 'promotional']:
-            # Mark as read and archive
-            gmail_service.users().messages().modify(
-                userId='me', 
-                id=msg_id, 
-                body={'removeLabelIds': ['UNREAD', 'INBOX']}
-            ).execute()
-            print("Archived Social/Promo.")
-            
-        elif category_lower in ['accounting']:
-            # Forward
-            accounting_email = os.environ.get("ACCOUNTING_EMAIL", my_email)
-            print(f"Forwarding to Accounting ({accounting_email})")
-            fwd_msg = EmailMessage()
-            fwd_msg.set_content(f"Forwarded Accounting Email:\n\n{body}")
-            fwd_msg['To'] = accounting_email
-            fwd_msg['Subject'] = f"Fwd: {subject}"
-            
-            raw_fwd = base64.urlsafe_b64encode(fwd_msg.as_bytes()).decode()
-            gmail_service.users().messages().send(userId='me', body={'raw': raw_fwd}).execute()
-            print("Forwarded accounting email.")
-            
-        elif category_lower in ['personal', 'primary']:
-            print("Drafting reply...")
-            reply_body = draft_reply(subject, body)
-            reply_msg = EmailMessage()
-            reply_msg.set_content(reply_body)
-            reply_msg['To'] = sender
-            reply_msg['Subject'] = f"Re: {subject}"
-            
-            raw_reply = base64.urlsafe_b64encode(reply_msg.as_bytes()).decode()
-            gmail_service.users().drafts().create(
-                userId='me', 
-                body={
-                    'message': {
-                        'raw': raw_reply,
-                        'threadId': msg.get('threadId')
-                    }
-                }
-            ).execute()
-            print("Drafted reply.")
-            
-        else: # Misc/Sales/Recruitment or dynamically created label
-            cat_label_id = labels_map.get(category_lower)
-            
-            # If the label doesn't exist, create it dynamically
-            if not cat_label_id:
-                print(f"Dynamic label '{category}' not found. Creating in Gmail...")
-                try:
-                    label_object = {
-                        'name': category,
-                        'labelListVisibility': 'labelShow',
-                        'messageListVisibility': 'show'
-                    }
-                    new_label = gmail_service.users().labels().create(userId='me', body=label_object).execute()
-                    cat_label_id = new_label['id']
-                    labels_map[category_lower] = cat_label_id  # Update map for the current run
-                    print(f"Successfully created dynamic label '{category}' ({cat_label_id})")
-                except Exception as label_err:
-                    print(f"Warning: Failed to create dynamic label '{category}': {label_err}")
-                    if "409" in str(label_err) or "exists" in str(label_err).lower():
-                        try:
-                            results = gmail_service.users().labels().list(userId='me').execute()
-                            existing = next((l for l in results.get('labels', []) if l['name'].lower() == category_lower), None)
-                            if existing:
-                                cat_label_id = existing['id']
-                                labels_map[category_lower] = cat_label_id
-                                print(f"Recovered existing label {category} ({cat_label_id}) from Gmail API")
-                        except Exception:
-                            pass
-                    if not cat_label_id:
-                        # Fallback to Misc if creation fails
-                        cat_label_id = labels_map.get('misc')
-            
-            # If we still don't have a cat_label_id (e.g. Misc doesn't exist either), just skip applying the category label
-            if cat_label_id:
-                try:
-                    gmail_service.users().messages().modify(userId='me', id=msg_id, body={'addLabelIds': [cat_label_id]}).execute()
-                    print(f"Applied label {category} ({cat_label_id})")
-                except Exception as apply_err:
-                    print(f"Failed to apply label {cat_label_id} to message: {apply_err}")
+    else: # Misc/Sales/Recruitment or dynamically created label
+        # Resolved (and if new, created once) through the shared registry; Misc if creation fails
+        cat_label_id = labels.get_or_create(gmail_service, category) or labels.get('misc')
         
-        # ALWAYS Cleanup
-        if ai_processed_id:
-            try:
-                gmail_service.users().messages().modify(userId='me', id=msg_id, body={'addLabelIds': [ai_processed_id]}).execute()
-                print(f"Marked {msg_id} as AI Processed.")
-            except Exception as e:
-                print(f"Failed to apply AI Processed label, attempting dynamic lookup: {e}")
-                results = gmail_service.users().labels().list(userId='me').execute()
-                real_ai_processed = next((l for l in results.get('labels', []) if l['name'] == 'AI Processed'), None)
-                
-                if not real_ai_processed:
-                    print("Re-creating missing 'AI Processed' label...")
-                    try:
-                        label_object = {
-                            'name': 'AI Processed',
-                            'labelListVisibility': 'labelShow',
-                            'messageListVisibility': 'hide'
-                        }
-                        real_ai_processed = gmail_service.users().labels().create(userId='me', body=label_object).execute()
-                    except Exception as creation_err:
-                        print(f"Failed to re-create label: {creation_err}")
-
-                if real_ai_processed:
-                    try:
-                        gmail_service.users().messages().modify(userId='me', id=msg_id, body={'addLabelIds': [real_ai_processed['id']]}).execute()
-                        print(f"Successfully marked {msg_id} as AI Processed on retry.")
-                    except Exception as apply_err:
-                        print(f"Critical error applying AI Processed label: {apply_err}")
-            
-    except Exception as e:
-        print(f"Failed processing {msg_id}: {e}")
+        # If we still don't have a cat_label_id (e.g. Misc doesn't exist either), just skip applying the category label
+        if cat_label_id:
+            label_changes.add(msg_id, add=[cat_label_id])
+            print(f"Queued label {category} ({cat_label_id})")
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import argparse
+import threading
+import urllib.request
+
+WATCH_STATE_FILE = "watch_state.json"
+# users.watch expires after 7 days; renew well before that
+WATCH_RENEW_MARGIN_SECONDS = 24 * 3600
+# A pending marker older than this belongs to a run that died; the next notification replaces it
+PENDING_STALE_SECONDS = 600
+DEFAULT_LEASE_SECONDS = 900
+
+
+def parse_push_notification(envelope):
+    """Returns (email_address, history_id) from a Pub/Sub push envelope, or None if malformed.
+
+    Gmail publishes `{"emailAddress": ..., "historyId": ...}` as the base64
+    `message.data` of the envelope.
+    """
+    try:
+        data = base64.b64decode(envelope['message']['data'])
+        payload = json.loads(data)
+        return payload['emailAddress'].lower(), int(payload['historyId'])
+    except Exception:
+        return None
+
+
+def make_push_envelope(email_address, history_id, subscription="projects/local/subscriptions/gmail-bot"):
+    """Builds a synthetic Pub/Sub push body, as Gmail would send after a mailbox change."""
+    data = json.dumps({'emailAddress': email_address, 'historyId': history_id}).encode('utf-8')
+    return {
+        'message': {
+            'data': base64.b64encode(data).decode('ascii'),
+            'messageId': str(int(time.time() * 1000)),
+            'publishTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'subscription': subscription,
+    }
+
+
+def _put_if_absent(store, key, value, lock):
+    if hasattr(store, 'put'):
+        return store.put(key, value, skip_if_exists=True)
+    with lock:
+        if key in store:
+            return False
+        store[key] = value
+        return True
+
+
+class PushCoalescer:
+    """Collapses bursts of notifications for a mailbox into a single pending sync.
+
+    `store` is any mapping shared by the endpoint and the worker (a
+    modal.Dict in production, a dict locally). The first notification marks
+    the mailbox pending and should trigger a sync; later ones are absorbed
+    until the worker calls `start`, which clears the marker right before it
+    syncs, so anything arriving mid-run schedules exactly one follow-up.
+    """
+
+    def __init__(self, store, stale_seconds=PENDING_STALE_SECONDS):
+        self.store = store
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(mailbox):
+        return f"pending:{mailbox.lower()}"
+
+    def notify(self, mailbox, now=None):
+        """Records a notification. Returns True if the caller should trigger a sync."""
+        now = now if now is not None else time.time()
+        key = self._key(mailbox)
+        if _put_if_absent(self.store, key, now, self._lock):
+            return True
+        since = self.store.get(key)
+        if since is not None and now - since > self.stale_seconds:
+            self.store[key] = now
+            return True
+        return False
+
+    def start(self, mailbox):
+        """Called by the worker just before it syncs; later notifications schedule a new run."""
+        self.store.pop(self._key(mailbox), None)
+
+    def pending(self, mailbox):
+        return self._key(mailbox) in self.store
+
+
+class SyncLease:
+    """At most one sync per account at a time, across containers.
+
+    Leases expire after `lease_seconds` so a crashed run can't block its
+    account forever. Each acquisition has its own ID; an expired lease is
+    taken over by first claiming a marker keyed by that ID, so when several
+    runs find it expired only one of them gets it.
+    """
+
+    def __init__(self, store, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.store = store
+        self.lease_seconds = lease_seconds
+        self._held = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(account_id):
+        return f"lease:{account_id}"
+
+    def acquire(self, account_id, now=None):
+        now = now if now is not None else time.time()
+        key = self._key(account_id)
+        lease = {'id': uuid.uuid4().hex, 'expires_at': now + self.lease_seconds}
+        if _put_if_absent(self.store, key, lease, self._lock):
+            self._held[account_id] = lease['id']
+            return True
+        current = self.store.get(key)
+        if current is None:
+            return False
+        if not isinstance(current, dict):
+            # Written before leases had IDs
+            current = {'id': f"legacy-{current}", 'expires_at': current}
+        if current['expires_at'] >= now:
+            return False
+        if not _put_if_absent(self.store, f"{key}:takeover:{current['id']}", lease['id'], self._lock):
+            return False
+        lease['replaces'] = current['id']
+        self.store[key] = lease
+        # Runs of older code take over without the marker: make sure this write is the one that stuck
+        if (self.store.get(key) or {}).get('id') != lease['id']:
+            return False
+        self._held[account_id] = lease['id']
+        return True
+
+    def release(self, account_id):
+        lease_id = self._held.pop(account_id, None)
+        key = self._key(account_id)
+        current = self.store.get(key)
+        if isinstance(current, dict) and current.get('id') != lease_id:
+            # Expired and taken over meanwhile: the lease is someone else's now
+            return
+        self.store.pop(key, None)
+        if isinstance(current, dict) and current.get('replaces'):
+            self.store.pop(f"{key}:takeover:{current['replaces']}", None)
+
+
+def load_watch_state(state_dir):
+    try:
+        with open(os.path.join(state_dir, WATCH_STATE_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error reading watch state: {e}")
+        return {}
+
+
+def save_watch_state(state_dir, state):
+    path = os.path.join(state_dir, WATCH_STATE_FILE)
+    os.makedirs(state_dir, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def ensure_watch(gmail_service, state_dir, topic_name, label_ids=('INBOX',), margin=WATCH_RENEW_MARGIN_SECONDS):
+    """Starts or renews the users.watch subscription when it is missing, retargeted or close to expiry.
+
+    Returns the watch state. Renewing an active watch is harmless: Gmail just
+    extends the expiration.
+    """
+    state = load_watch_state(state_dir)
+    expires_at = int(state.get('expiration', 0)) / 1000
+    if state.get('topic') == topic_name and expires_at - time.time() > margin:
+        return state
+    response = gmail_service.users().watch(userId='me', body={
+        'topicName': topic_name,
+        'labelIds': list(label_ids),
+        'labelFilterBehavior': 'INCLUDE',
+    }).execute()
+    state = {
+        'topic': topic_name,
+        'history_id': response.get('historyId'),
+        'expiration': int(response.get('expiration', 0)),
+        'renewed_at': int(time.time()),
+    }
+    save_watch_state(state_dir, state)
+    print(f"Gmail watch on {topic_name} active until {time.strftime('%Y-%m-%d %H:%M', time.gmtime(state['expiration'] / 1000))} UTC")
+    return state
+
+
+def post_notification(url, email_address, history_id, token=None):
+    """Posts one synthetic push notification. Returns the HTTP status."""
+    if token:
+        url += ('&' if '?' in url else '?') + f"token={token}"
+    body = json.dumps(make_push_envelope(email_address, history_id)).encode('utf-8')
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.status
+
+
+def main(argv=None):
+    """Local stand-in for Pub/Sub: posts synthetic Gmail notifications to the push endpoint.
+
+    Without --url, the notifications are fed to an in-memory coalescer and
+    the number of syncs they would trigger is printed.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--url", help="push endpoint URL (from `modal serve` or `modal deploy`)")
+    parser.add_argument("--email", default="me@example.com")
+    parser.add_argument("--history-id", type=int, default=1)
+    parser.add_argument("--count", type=int, default=1, help="notifications to send")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between notifications")
+    parser.add_argument("--token", default=os.environ.get("PUSH_VERIFICATION_TOKEN"))
+    args = parser.parse_args(argv)
+
+    coalescer = PushCoalescer({})
+    triggered = 0
+    for n in range(args.count):
+        history_id = args.history_id + n
+        if args.url:
+            status = post_notification(args.url, args.email, history_id, args.token)
+            print(f"Notification {n + 1}/{args.count} (historyId {history_id}): HTTP {status}")
+        elif coalescer.notify(args.email):
+            triggered += 1
+        if args.interval:
+            time.sleep(args.interval)
+    if not args.url:
+        print(f"{args.count} notifications -> {triggered} sync(s) triggered")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
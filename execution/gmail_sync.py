@@ -0,0 +1,114 @@
+import os
+import json
+from datetime import datetime, timedelta
+
+from googleapiclient.errors import HttpError  # type: ignore
+
+SYNC_STATE_FILE = "sync_state.json"
+UNPROCESSED_QUERY = 'label:INBOX -label:"AI Processed"'
+
+# How far back the very first run (no cursor, no previous sync) looks
+INITIAL_WINDOW_MINUTES = 20
+
+
+def load_sync_state(state_dir):
+    path = os.path.join(state_dir, SYNC_STATE_FILE)
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error reading sync state: {e}")
+        return {}
+
+
+def save_sync_state(state_dir, state):
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, SYNC_STATE_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def list_query_message_ids(gmail_service, query, page_size=500):
+    """Lists every message matching the query, following nextPageToken."""
+    message_ids = []
+    page_token = None
+    while True:
+        kwargs = {'userId': 'me', 'q': query, 'maxResults': page_size}
+        if page_token:
+            kwargs['pageToken'] = page_token
+        results = gmail_service.users().messages().list(**kwargs).execute()
+        message_ids.extend(m['id'] for m in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return message_ids
+
+
+def list_history_message_ids(gmail_service, start_history_id, ai_processed_id=None):
+    """Returns (message_ids, latest_history_id) for inbox mail added since the cursor.
+
+    Raises HttpError 404 when the cursor is too old for Gmail to serve.
+    """
+    message_ids = []
+    seen = set()
+    latest_history_id = start_history_id
+    page_token = None
+
+    while True:
+        kwargs = {
+            'userId': 'me',
+            'startHistoryId': start_history_id,
+            'historyTypes': ['messageAdded', 'labelAdded'],
+            'labelId': 'INBOX',
+        }
+        if page_token:
+            kwargs['pageToken'] = page_token
+        results = gmail_service.users().history().list(**kwargs).execute()
+
+        for record in results.get('history', []):
+            candidates = [m['message'] for m in record.get('messagesAdded', [])]
+            # Messages moved (back) into the inbox show up as label additions
+            candidates += [
+                m['message'] for m in record.get('labelsAdded', [])
+                if 'INBOX' in m.get('labelIds', [])
+            ]
+            for message in candidates:
+                label_ids = message.get('labelIds', [])
+                if 'INBOX' not in label_ids or (ai_processed_id and ai_processed_id in label_ids):
+                    continue
+                if message['id'] not in seen:
+                    seen.add(message['id'])
+                    message_ids.append(message['id'])
+
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return message_ids, latest_history_id
+
+
+def sync_message_ids(gmail_service, state, profile_history_id, ai_processed_id=None):
+    """Returns (message_ids, new_history_id) for this tick.
+
+    Uses the persisted historyId cursor when possible and falls back to a full,
+    paginated query resync when there is no cursor or Gmail reports it expired.
+    `profile_history_id` must be read before listing so nothing slips between
+    the resync and the next delta.
+    """
+    cursor = state.get('history_id')
+    if cursor:
+        try:
+            return list_history_message_ids(gmail_service, cursor, ai_processed_id)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print(f"History cursor {cursor} expired. Falling back to full resync...")
+
+    synced_at = state.get('synced_at')
+    if not synced_at:
+        synced_at = int((datetime.now() - timedelta(minutes=INITIAL_WINDOW_MINUTES)).timestamp())
+    query = f'{UNPROCESSED_QUERY} after:{synced_at}'
+    print(f"Full resync with query: {query}")
+    return list_query_message_ids(gmail_service, query), profile_history_id
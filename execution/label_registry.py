@@ -0,0 +1,168 @@
+import os
+import re
+import time
+import threading
+
+from googleapiclient.errors import HttpError  # type: ignore
+
+AI_PROCESSED_LABEL = "AI Processed"
+# Labels created by the bot, kept on the state volume (the directives folder is part of the image)
+LABEL_MAP_FILE = "gmail_labels.md"
+
+# Re-list the mailbox's labels after this long so labels made or deleted by hand are picked up
+DEFAULT_REFRESH_SECONDS = 3600
+
+# "- **Name**: `Label_ID`" lines of directives/gmail_labels.md
+_MAP_LINE = re.compile(r'^\s*[-*]?\s*\*\*(.+?)\*\*\s*:?\s*`([^`]+)`')
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def read_label_map(path):
+    """Label name -> ID pairs from a Markdown label map, in file order."""
+    labels = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                match = _MAP_LINE.match(line)
+                if match:
+                    labels.append((match.group(1).strip(), match.group(2).strip()))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error reading labels map: {e}")
+    return labels
+
+
+class GmailLabelRegistry:
+    """Label name -> Gmail label ID for one mailbox, resolved case-insensitively.
+
+    Seeded from the directive label map with the state copy laid over it,
+    then replaced by a single `labels.list` per refresh and kept in memory
+    for the life of the container. Creation is single-flight per name, so a
+    burst of mail in a new category creates the label once; created IDs are
+    written to the state copy.
+    """
+
+    def __init__(self, map_path=None, refresh_seconds=DEFAULT_REFRESH_SECONDS, state_path=None):
+        self.map_path = map_path
+        self.state_path = state_path
+        self.refresh_seconds = refresh_seconds
+        self.listed_at = 0
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._creating = {}
+        for path in (map_path, state_path):
+            for name, label_id in read_label_map(path) if path else []:
+                self._labels[name.lower()] = label_id
+
+    def refresh(self, gmail_service, force=False):
+        """Lists the mailbox's labels (skipped while fresh). Returns False if the listing failed."""
+        if not force and self.listed_at and time.time() - self.listed_at < self.refresh_seconds:
+            return True
+        try:
+            results = gmail_service.users().labels().list(userId='me').execute()
+        except Exception as e:
+            print(f"Error listing Gmail labels: {e}")
+            return False
+        labels = {}
+        for label in results.get('labels', []):
+            labels.setdefault(label['name'].lower(), label['id'])
+        with self._lock:
+            self._labels = labels
+            self.listed_at = time.time()
+        print(f"Indexed {len(labels)} Gmail labels.")
+        return True
+
+    def get(self, name):
+        with self._lock:
+            return self._labels.get(name.lower())
+
+    def has_id(self, label_id):
+        with self._lock:
+            return label_id in self._labels.values()
+
+    def get_or_create(self, gmail_service, name, message_visibility='show'):
+        """ID of the label called `name` (any case), creating it if the mailbox has none. None on failure."""
+        key = name.lower()
+        with self._lock:
+            label_id = self._labels.get(key)
+            if label_id:
+                return label_id
+            name_lock = self._creating.setdefault(key, threading.Lock())
+
+        with name_lock:
+            # Another thread may have created it while we waited
+            label_id = self.get(name)
+            if label_id:
+                return label_id
+            try:
+                label = gmail_service.users().labels().create(userId='me', body={
+                    'name': name,
+                    'labelListVisibility': 'labelShow',
+                    'messageListVisibility': message_visibility
+                }).execute()
+                label_id = label['id']
+                print(f"Created Gmail label '{name}' ({label_id})")
+            except HttpError as e:
+                if e.resp.status != 409:
+                    print(f"Error creating Gmail label '{name}': {e}")
+                    return None
+                # Created by hand or by another container since the last listing
+                if self.refresh(gmail_service, force=True):
+                    label_id = self.get(name)
+                if not label_id:
+                    print(f"Gmail label '{name}' exists but could not be resolved.")
+                    return None
+                return label_id
+            except Exception as e:
+                print(f"Error creating Gmail label '{name}': {e}")
+                return None
+            with self._lock:
+                self._labels[key] = label_id
+            self._write_back(name, label_id)
+            return label_id
+
+    def _write_back(self, name, label_id):
+        """Records a created label in the state map, replacing a stale entry for the same name."""
+        if not self.state_path:
+            return
+        entry = f"- **{name}**: `{label_id}`\n"
+        with self._file_lock:
+            try:
+                try:
+                    with open(self.state_path, "r") as f:
+                        lines = f.readlines()
+                except FileNotFoundError:
+                    lines = ["# Gmail Label Map\n", "\n"]
+                for i, line in enumerate(lines):
+                    match = _MAP_LINE.match(line)
+                    if match and match.group(1).strip().lower() == name.lower():
+                        lines[i] = entry
+                        break
+                else:
+                    if lines and not lines[-1].endswith("\n"):
+                        lines[-1] += "\n"
+                    lines.append(entry)
+                os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+                with open(self.state_path + ".tmp", "w") as f:
+                    f.writelines(lines)
+                os.replace(self.state_path + ".tmp", self.state_path)
+            except Exception as e:
+                print(f"Error writing labels map: {e}")
+
+
+def get_label_registry(map_path, refresh_seconds=DEFAULT_REFRESH_SECONDS, state_dir=None):
+    """One registry per mailbox, shared by every thread and invocation in the container.
+
+    Created labels are recorded in `state_dir`, which must be on the state volume to outlive the container.
+    """
+    state_path = os.path.join(state_dir, LABEL_MAP_FILE) if state_dir else None
+    with _registries_lock:
+        registry = _registries.get((map_path, state_path))
+        if registry is None:
+            registry = GmailLabelRegistry(map_path, refresh_seconds, state_path)
+            _registries[(map_path, state_path)] = registry
+        return registry
@@ -0,0 +1,278 @@
+import os
+import re
+import sys
+import zlib
+import math
+import argparse
+import threading
+from collections import Counter
+
+import numpy as np  # type: ignore
+
+DEFAULT_DIMS = 1024
+DEFAULT_MAX_ENTRIES = 20000
+# Rows allocated at first; the buffers double from there up to max_entries
+INITIAL_CAPACITY = 256
+BODY_PREFIX_CHARS = 500
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+_DIGITS = re.compile(r'\d+')
+
+
+def tokenize(subject, body):
+    subject_tokens = _TOKEN.findall(_DIGITS.sub('0', (subject or '').lower()))
+    body_tokens = _TOKEN.findall(_DIGITS.sub('0', (body or '')[:BODY_PREFIX_CHARS].lower()))
+    # Subject words are kept as separate features from body words
+    return ['s:' + t for t in subject_tokens] + body_tokens
+
+
+def hashed_tf(subject, body, dims=DEFAULT_DIMS):
+    """Sublinear term-frequency vector using the hashing trick (crc32 is stable across processes)."""
+    vector = np.zeros(dims, dtype=np.float32)
+    for token, count in Counter(tokenize(subject, body)).items():
+        vector[zlib.crc32(token.encode('utf-8')) % dims] += 1.0 + math.log(count)
+    return vector
+
+
+class NeighbourIndex:
+    """Hashed TF-IDF vectors of past LLM-labelled emails, stored as one compact .npz file.
+
+    IDF weights come from the stored vectors themselves, so no vocabulary is
+    kept. The index is tied to an instructions version and starts empty when
+    it changes.
+
+    Vectors live in preallocated buffers that wrap around once `max_entries`
+    is reached. Document frequencies are updated per added row and only that
+    row is weighted; every row is re-weighted with fresh IDF after about 10%
+    new rows.
+    """
+
+    def __init__(self, path, version, dims=DEFAULT_DIMS, max_entries=DEFAULT_MAX_ENTRIES,
+                 k=5, threshold=0.85, min_votes=3, agreement=0.8):
+        self.path = path
+        self.version = version
+        self.dims = dims
+        self.max_entries = max_entries
+        self.k = k
+        self.threshold = threshold
+        self.min_votes = min_votes
+        self.agreement = agreement
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((0, dims), dtype=np.float16)
+        self._labels = np.zeros(0, dtype=np.int32)
+        self._weighted = np.zeros((0, dims), dtype=np.float32)
+        self._label_names = []
+        self._count = 0
+        # Row the next entry goes to; once the buffers are full, the oldest entry
+        self._next = 0
+        self._df = np.zeros(dims, dtype=np.int64)
+        self._idf_weights = np.ones(dims, dtype=np.float32)
+        self._stale = 0
+        self._dirty = False
+        self._load()
+
+    def __len__(self):
+        return self._count
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data['version']) != self.version or data['vectors'].shape[1] != self.dims:
+                    print("Instructions changed, starting a fresh neighbour index.")
+                    return
+                vectors = data['vectors'][-self.max_entries:].astype(np.float16)
+                labels = data['labels'][-self.max_entries:].astype(np.int32)
+                self._label_names = [str(n) for n in data['label_names']]
+        except Exception as e:
+            print(f"Error reading neighbour index: {e}")
+            return
+        self._grow(len(labels))
+        self._count = len(labels)
+        self._next = self._count % self.max_entries
+        self._vectors[:self._count] = vectors
+        self._labels[:self._count] = labels
+        self._reweight()
+
+    def _grow(self, needed):
+        """Makes room for `needed` rows, doubling the buffers (up to max_entries)."""
+        capacity = len(self._labels)
+        if needed <= capacity:
+            return
+        capacity = min(self.max_entries, max(INITIAL_CAPACITY, capacity * 2, needed))
+        for name in ('_vectors', '_weighted'):
+            old = getattr(self, name)
+            grown = np.zeros((capacity, self.dims), dtype=old.dtype)
+            grown[:self._count] = old[:self._count]
+            setattr(self, name, grown)
+        labels = np.zeros(capacity, dtype=np.int32)
+        labels[:self._count] = self._labels[:self._count]
+        self._labels = labels
+
+    def _ordered(self, rows):
+        """Stored rows, oldest first."""
+        if self._count < self.max_entries:
+            return rows[:self._count]
+        return np.concatenate([rows[self._next:self._count], rows[:self._next]])
+
+    def _reweight(self):
+        """Recomputes document frequencies, IDF and every weighted row."""
+        vectors = self._vectors[:self._count]
+        self._df = np.count_nonzero(vectors, axis=0).astype(np.int64)
+        self._idf_weights = self._idf_from(self._df, self._count)
+        self._weighted[:self._count] = self._normalize(vectors.astype(np.float32) * self._idf_weights)
+        self._stale = 0
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_path = self.path + ".tmp.npz"
+            np.savez_compressed(
+                tmp_path,
+                version=np.array(self.version),
+                vectors=self._ordered(self._vectors),
+                labels=self._ordered(self._labels),
+                label_names=np.array(self._label_names, dtype=str),
+            )
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+    @staticmethod
+    def _idf_from(df, n):
+        return np.log((1.0 + n) / (1.0 + df)).astype(np.float32) + 1.0
+
+    def _idf(self, vectors):
+        return self._idf_from(np.count_nonzero(vectors, axis=0), len(vectors))
+
+    def _normalize(self, matrix):
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def vote(self, similarities, labels):
+        """Returns the agreed label code among the top-k neighbours, or None."""
+        top = np.argsort(-similarities)[:self.k]
+        close = [labels[i] for i in top if similarities[i] >= self.threshold]
+        if len(close) < self.min_votes:
+            return None
+        label, count = Counter(close).most_common(1)[0]
+        if count / len(close) < self.agreement:
+            return None
+        return label
+
+    def predict(self, subject, body):
+        """Returns a category when enough close neighbours agree, else None."""
+        vector = hashed_tf(subject, body, self.dims)
+        with self._lock:
+            if self._count < self.min_votes or not vector.any():
+                self.misses += 1
+                return None
+            query = self._normalize(vector * self._idf_weights)
+            label = self.vote(self._weighted[:self._count] @ query, self._labels[:self._count])
+            if label is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._label_names[label]
+
+    def add(self, subject, body, category):
+        vector = hashed_tf(subject, body, self.dims)
+        if not vector.any():
+            return
+        with self._lock:
+            if category not in self._label_names:
+                self._label_names.append(category)
+            row_vector = vector.astype(np.float16)
+            if self._count < self.max_entries:
+                self._grow(self._count + 1)
+                row = self._count
+                self._count += 1
+            else:
+                row = self._next
+                self._df -= self._vectors[row] != 0
+            self._next = (row + 1) % self.max_entries
+            self._vectors[row] = row_vector
+            self._labels[row] = self._label_names.index(category)
+            self._df += row_vector != 0
+            self._weighted[row] = self._normalize(row_vector.astype(np.float32) * self._idf_weights)
+            self._stale += 1
+            # IDF drifts as entries come and go; refresh every row once a tenth of them are new
+            if self._stale > max(self.min_votes, self._count // 10):
+                self._reweight()
+            self._dirty = True
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': self._count,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+        }
+
+    def evaluate(self, sample=2000, chunk=256):
+        """Replays the newest `sample` entries against only the entries stored before each one.
+
+        Every stored label came from the LLM, so accuracy here is agreement
+        with the LLM and coverage is the fraction of LLM calls that would
+        have been avoided.
+        """
+        with self._lock:
+            vectors = self._ordered(self._vectors).astype(np.float32)
+            labels = self._ordered(self._labels).copy()
+        total = len(labels)
+        start = max(self.min_votes, total - sample)
+        if start >= total:
+            return {'evaluated': 0, 'answered': 0, 'correct': 0, 'accuracy': 0.0, 'calls_avoided': 0.0}
+
+        idf = self._idf(vectors)
+        matrix = self._normalize(vectors * idf)
+        answered = correct = 0
+        for chunk_start in range(start, total, chunk):
+            rows = np.arange(chunk_start, min(chunk_start + chunk, total))
+            similarities = matrix[rows] @ matrix.T
+            # Only entries older than the query may vote
+            similarities[np.arange(total)[None, :] >= rows[:, None]] = -1.0
+            for offset, row in enumerate(rows):
+                label = self.vote(similarities[offset], labels)
+                if label is not None:
+                    answered += 1
+                    correct += int(label == labels[row])
+
+        evaluated = total - start
+        return {
+            'evaluated': evaluated,
+            'answered': answered,
+            'correct': correct,
+            'accuracy': round(correct / answered, 4) if answered else 0.0,
+            'calls_avoided': round(answered / evaluated, 4),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the neighbour index against the LLM labels it was built from.")
+    parser.add_argument("index_path")
+    parser.add_argument("--sample", type=int, default=2000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--min-votes", type=int, default=3)
+    parser.add_argument("--agreement", type=float, default=0.8)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.index_path):
+        print(f"Index not found: {args.index_path}")
+        sys.exit(1)
+    with np.load(args.index_path, allow_pickle=False) as data:
+        version = str(data['version'])
+        dims = data['vectors'].shape[1]
+    index = NeighbourIndex(args.index_path, version, dims=dims, k=args.k, threshold=args.threshold,
+                           min_votes=args.min_votes, agreement=args.agreement)
+    print(index.evaluate(sample=args.sample))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import io
+import os
+import sys
+import pstats
+import cProfile
+import threading
+import contextlib
+from collections import Counter
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """cProfile over the block, including threads it starts, merged into one pstats file at `path`.
+
+    Python 3.12+ allows one active profiler per process; there only the
+    calling thread is profiled (use `StackSampler` for the worker threads).
+    """
+    profiles = [cProfile.Profile()]
+
+    def start_thread(frame, event, arg):
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return
+        profiles.append(profile)
+
+    threading.setprofile(start_thread)
+    profiles[0].enable()
+    try:
+        yield
+    finally:
+        profiles[0].disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(25)
+        print(out.getvalue(), file=sys.stderr)
+
+
+class StackSampler:
+    """Samples every thread's Python stack at a fixed interval.
+
+    Sees worker threads on any Python version. Writes folded stacks
+    ("a;b;c count" lines, for flamegraph.pl or speedscope).
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def write_folded(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top(self, n=20):
+        """Functions by share of samples on top of the stack (self) and anywhere in it (total)."""
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        samples = sum(self.stacks.values()) or 1
+        return {
+            'self': {name: round(c / samples, 3) for name, c in own.most_common(n)},
+            'total': {name: round(c / samples, 3) for name, c in total.most_common(n)},
+        }
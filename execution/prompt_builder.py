@@ -0,0 +1,233 @@
+import re
+import html
+import codecs
+import base64
+import textwrap
+import threading
+
+# Same rough ratio the LLM rate limiter uses to estimate prompt tokens; used for budgets without a tokenizer
+CHARS_PER_TOKEN = 4
+# tiktoken encoding of gpt-4o / gpt-4o-mini (close enough for the Groq models' budgets as well)
+TOKENIZER_ENCODING = "o200k_base"
+# HTML carries several characters of markup per character of text
+HTML_DECODE_FACTOR = 4
+# Extra text decoded so the budget is still filled after quotes and signatures are dropped
+QUOTE_DECODE_FACTOR = 2
+# Instructions beyond this many tokens are cut from the shared prefix
+DEFAULT_INSTRUCTION_TOKENS = 1500
+MAX_MIME_DEPTH = 10
+
+_CHARSET = re.compile(r'charset\s*=\s*"?([\w.:-]+)', re.IGNORECASE)
+_HTML_DROP = re.compile(r'<(script|style|head|title)\b.*?</\1\s*>|<!--.*?-->', re.IGNORECASE | re.DOTALL)
+_HTML_BREAK = re.compile(r'<(br|/p|/div|/li|/tr|/h[1-6]|/blockquote|hr)\b[^>]*>', re.IGNORECASE)
+_HTML_QUOTE = re.compile(r'<blockquote\b.*?</blockquote\s*>|<div class="gmail_quote".*', re.IGNORECASE | re.DOTALL)
+_HTML_TAG = re.compile(r'<[^>]+>')
+# A decoded window can end inside a style/script block or a tag
+_HTML_TRUNCATED = re.compile(r'<(script|style)\b[^>]*>(?:(?!</\1).)*$|<[^>]*$', re.IGNORECASE | re.DOTALL)
+_BLANK_LINES = re.compile(r'\n\s*\n+')
+_SPACES = re.compile(r'[ \t\r\f\v\xa0]+')
+# Where quoted history or a signature starts; everything from that line on is dropped
+_CUT_LINE = re.compile(
+    r'^(on .{0,200}wrote:?|-----\s*original message\s*-----|_{10,}|from:\s.+|-- ?|sent from my \w+.*|get outlook for \w+.*)$',
+    re.IGNORECASE
+)
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """The tokenizer prompt budgets are counted with, loaded once per container; None without tiktoken."""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken  # type: ignore
+                _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+            except Exception as e:
+                print(f"No tokenizer ({e}), estimating {CHARS_PER_TOKEN} characters per token.")
+                _encoding = False
+        return _encoding or None
+
+
+def truncate_tokens(text, max_tokens, keep_end=False):
+    """Cuts `text` to `max_tokens`, at a word boundary when one is close. `keep_end` keeps the last tokens instead.
+
+    Tokens are counted with the model's tokenizer when tiktoken is installed,
+    and estimated from CHARS_PER_TOKEN otherwise.
+    """
+    encoding = get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        cut = encoding.decode(tokens[-max_tokens:] if keep_end and max_tokens else tokens[:max_tokens])
+    else:
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        if len(text) <= max_chars:
+            return text
+        cut = text[-max_chars:] if keep_end and max_chars else text[:max_chars]
+    if keep_end:
+        return cut
+    space = cut.rfind(' ', int(len(cut) * 0.8))
+    return cut[:space if space != -1 else len(cut)].rstrip()
+
+
+def part_charset(part):
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = _CHARSET.search(header['value'])
+            if match:
+                try:
+                    return codecs.lookup(match.group(1)).name
+                except LookupError:
+                    return 'utf-8'
+    return 'utf-8'
+
+
+def decode_text(data, max_chars=None, charset='utf-8'):
+    """Decodes base64 text, touching only the prefix needed for `max_chars` characters."""
+    if max_chars is None:
+        return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)).decode(charset, errors='replace')
+    # UTF-8 needs at most 4 bytes per character, base64 4 chars per 3 bytes
+    prefix = data[:((4 * max_chars + 2) // 3 + 1) * 4]
+    prefix = prefix[:len(prefix) - len(prefix) % 4] if len(prefix) < len(data) else prefix
+    text = base64.urlsafe_b64decode(prefix + "=" * (-len(prefix) % 4)).decode(charset, errors='ignore')
+    return text[:max_chars]
+
+
+def iter_text_parts(payload, depth=0):
+    """Yields the readable text parts of a MIME tree, depth first, without decoding anything.
+
+    Attachments are skipped. Within multipart/alternative only the plain
+    text version is used, or the HTML one when there is no plain text.
+    """
+    if depth > MAX_MIME_DEPTH:
+        return
+    mime_type = (payload.get('mimeType') or '').lower()
+    if payload.get('filename'):
+        return
+    if mime_type.startswith('multipart/'):
+        parts = payload.get('parts') or []
+        if mime_type == 'multipart/alternative':
+            plain = [p for p in parts if (p.get('mimeType') or '').lower() == 'text/plain']
+            parts = plain or parts
+        for part in parts:
+            yield from iter_text_parts(part, depth + 1)
+    elif mime_type in ('text/plain', 'text/html') and payload.get('body', {}).get('data'):
+        yield payload
+
+
+def html_to_text(markup):
+    """Fast, regex-based HTML to text: drops scripts, styles and quoted blocks, keeps line breaks."""
+    markup = _HTML_DROP.sub(' ', markup)
+    markup = _HTML_TRUNCATED.sub(' ', markup)
+    markup = _HTML_QUOTE.sub(' ', markup)
+    markup = _HTML_BREAK.sub('\n', markup)
+    text = html.unescape(_HTML_TAG.sub(' ', markup))
+    text = _SPACES.sub(' ', text)
+    return _BLANK_LINES.sub('\n\n', "\n".join(line.strip() for line in text.split('\n'))).strip()
+
+
+def strip_quotes(text):
+    """Drops quoted replies ("> ..." lines, "On ... wrote:" and everything after) and signatures."""
+    kept = []
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if _CUT_LINE.match(stripped) and (kept or stripped.startswith('--')):
+            break
+        if stripped.startswith('>'):
+            continue
+        kept.append(line.rstrip())
+    return _BLANK_LINES.sub('\n\n', "\n".join(kept)).strip()
+
+
+def extract_body(payload, max_chars=None, clean=True):
+    """Readable text of a message payload, up to `max_chars`.
+
+    Walks nested multiparts, prefers plain text, converts HTML-only mail and
+    stops decoding once the budget is filled. With `clean`, quoted history
+    and signatures are dropped.
+    """
+    body = ""
+    for part in iter_text_parts(payload):
+        remaining = None if max_chars is None else max_chars - len(body)
+        if remaining is not None and remaining <= 0:
+            break
+        is_html = (part.get('mimeType') or '').lower() == 'text/html'
+        window = remaining
+        if window is not None:
+            window *= (HTML_DECODE_FACTOR if is_html else 1) * (QUOTE_DECODE_FACTOR if clean else 1)
+        while True:
+            raw = decode_text(part['body']['data'], window, part_charset(part))
+            text = html_to_text(raw) if is_html else raw
+            if clean:
+                text = strip_quotes(text)
+            # Markup-heavy HTML (large style blocks) can leave the window short of text: widen it
+            if window is None or len(raw) < window or len(text) >= remaining:
+                break
+            window *= 4
+        if text:
+            body += ("\n\n" if body else "") + text
+    return body if max_chars is None else body[:max_chars]
+
+
+def compact_instructions(instructions, max_tokens=DEFAULT_INSTRUCTION_TOKENS):
+    """Directive text with markdown emphasis, indentation and blank runs removed, capped at `max_tokens`."""
+    text = "\n".join(line.strip().replace('**', '') for line in (instructions or '').split('\n'))
+    text = _BLANK_LINES.sub('\n', text).strip()
+    compacted = truncate_tokens(text, max_tokens)
+    if len(compacted) < len(text):
+        print(f"Instructions exceed {max_tokens} tokens, truncated in prompts.")
+    return compacted
+
+
+class PromptBuilder:
+    """Classification prompts within a token budget.
+
+    Every classification request starts with the same system prefix (rules
+    plus compacted instructions), so providers that cache prompt prefixes
+    reuse it; only the user message varies. Bodies are cut to a per-email
+    token budget.
+    """
+
+    def __init__(self, category_rules, instructions, body_tokens=250, batch_body_tokens=125,
+                 instruction_tokens=DEFAULT_INSTRUCTION_TOKENS):
+        self.body_tokens = body_tokens
+        self.batch_body_tokens = batch_body_tokens
+        self.classify_prefix = (
+            textwrap.dedent(category_rules).strip()
+            + "\n\nINSTRUCTIONS:\n" + compact_instructions(instructions, instruction_tokens)
+        )
+
+    def classify(self, subject, body):
+        """(system, user) for a single email; the answer is the bare category name."""
+        user = (
+            "Reply ONLY with the exact category name. Do not include quotes, punctuation, or explanations.\n\n"
+            f"SUBJECT: {subject}\nBODY: {truncate_tokens(body or '', self.body_tokens)}"
+        )
+        return self.classify_prefix, user
+
+    def classify_batch(self, emails):
+        """(system, user) for several (email_id, subject, body); the answer is a JSON object of categories."""
+        listing = "\n".join(
+            f"EMAIL ID: {email_id}\nSUBJECT: {subject}\nBODY: {truncate_tokens(body or '', self.batch_body_tokens)}\n"
+            for email_id, subject, body in emails
+        )
+        user = (
+            "Classify EACH of the emails below independently.\n"
+            'Reply ONLY with a JSON object mapping every EMAIL ID to its category name, e.g. {"1": "Personal", "2": "Accounting"}.\n\n'
+            + listing
+        )
+        return self.classify_prefix, user
+
+
+REPLY_SYSTEM = "Write a natural, friendly, and concise reply to the email below. Reply with the body text only."
+
+
+def reply_prompt(subject, body, context="", body_tokens=250, context_tokens=375):
+    """(system, user) for drafting a reply, with the latest part of the earlier thread as context."""
+    user = f"SUBJECT: {subject}\n\nBODY: {truncate_tokens(body or '', body_tokens)}"
+    if context:
+        user += f"\n\nEARLIER IN THE THREAD (oldest first):\n{truncate_tokens(context, context_tokens, keep_end=True)}"
+    return REPLY_SYSTEM, user
@@ -0,0 +1,437 @@
+import os
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+from googleapiclient.http import HttpRequest  # type: ignore
+
+import telemetry
+
+# Gmail API quota units per method (https://developers.google.com/gmail/api/reference/quota)
+GMAIL_QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.get': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.messages.send': 100,
+    'gmail.users.drafts.create': 10,
+    'gmail.users.threads.get': 10,
+    'gmail.users.watch': 100,
+    'gmail.users.stop': 50,
+}
+DEFAULT_GMAIL_UNITS = 5
+
+# Drive throttles sustained writes far below its overall request quota
+DRIVE_WRITE_METHODS = ('drive.files.create', 'drive.files.update', 'drive.files.copy')
+
+# A 5xx on these may still have taken effect, so only rate-limit answers are retried
+NON_IDEMPOTENT_METHODS = (
+    'gmail.users.messages.send', 'gmail.users.drafts.create', 'gmail.users.labels.create',
+    'drive.files.create', 'drive.files.copy',
+)
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+_backends = {}
+_backends_lock = threading.Lock()
+# Containers serving accounts at once, each holding an equal share of the LLM key's limits
+_llm_shards = 1
+
+
+class Saturated(Exception):
+    """The backend is backed off (circuit open, or the wait for quota exceeds its limit)."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second.
+
+    Callers reserve tokens up front and sleep off any debt, so concurrent
+    callers are served in arrival order and a request larger than the bucket
+    still goes through once its share has accrued. `pause` holds every caller
+    back, e.g. after the provider answered 429.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, n, max_wait=None):
+        """Takes `n` tokens. Returns seconds to wait before using them, or None if over `max_wait`."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, (n - self.tokens) / self.rate if self.tokens < n else 0.0, self.paused_until - now)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= n
+            return wait
+
+    def adjust(self, n):
+        """Debits (or refunds, when negative) tokens once the real cost is known."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - n)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def set_rate(self, rate, capacity=None):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = float(rate)
+            self.capacity = float(capacity if capacity is not None else rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; lets one trial call through after `reset_seconds`."""
+
+    def __init__(self, threshold=5, reset_seconds=60):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        # Thread running the half-open trial call, if any
+        self._trial = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial is not None or time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self._trial = threading.get_ident()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial is not None or self.failures >= self.threshold:
+                if self.opened_at is None or self._trial is not None:
+                    print(f"Circuit opened after {self.failures} consecutive failures.")
+                self.opened_at = time.monotonic()
+                self._trial = None
+
+    def abandon(self):
+        """Fails this thread's trial call if it ended without a recorded outcome (e.g. a non-retryable error)."""
+        with self._lock:
+            if self._trial != threading.get_ident():
+                return
+        self.record_failure()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self._trial is not None else 'open'
+
+
+def status_of(error):
+    resp = getattr(error, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None):
+        return int(resp.status)
+    status = getattr(error, 'status_code', None)
+    return int(status) if status else None
+
+
+def is_rate_limited(error):
+    status = status_of(error)
+    if status == 429:
+        return True
+    return status == 403 and any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error):
+    if is_rate_limited(error) or status_of(error) in RETRYABLE_STATUSES:
+        return True
+    # Transport failures: socket timeouts, resets, and the OpenAI client's wrappers for them
+    return isinstance(error, (TimeoutError, ConnectionError)) or \
+        type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+def retry_after(error):
+    """Seconds the provider asked us to wait (Retry-After / retry-after-ms), or None."""
+    headers = getattr(error, 'resp', None)
+    response = getattr(error, 'response', None)
+    if response is not None and hasattr(response, 'headers'):
+        headers = response.headers
+    if headers is None or not hasattr(headers, 'get'):
+        return None
+    millis = headers.get('retry-after-ms')
+    if millis:
+        try:
+            return float(millis) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Backend:
+    """Quota buckets, retry policy and circuit breaker shared by every call to one API."""
+
+    def __init__(self, name, buckets, max_retries=5, base_delay=1.0, max_delay=60.0, max_wait=None, breaker=None):
+        self.name = name
+        self.buckets = buckets
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.breaker = breaker
+        self.counters = {'calls': 0, 'retries': 0, 'rate_limited': 0, 'saturated': 0, 'throttled_s': 0.0}
+        self._lock = threading.Lock()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] += n
+
+    def backoff(self, attempt, hint=None):
+        """Full-jitter exponential delay, never shorter than the provider's Retry-After."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if hint is not None:
+            delay = min(max(hint, 0.0), self.max_delay * 5) + random.uniform(0, self.base_delay)
+        return delay
+
+    def acquire(self, **costs):
+        """Blocks until every bucket can cover its cost, e.g. acquire(requests=1, tokens=800)."""
+        wait = 0.0
+        reserved = []
+        for bucket_name, n in costs.items():
+            bucket = self.buckets.get(bucket_name)
+            if bucket is None or not n:
+                continue
+            needed = bucket.reserve(n, self.max_wait)
+            if needed is None:
+                for taken, amount in reserved:
+                    taken.adjust(-amount)
+                self._count('saturated')
+                telemetry.count('api.saturated', backend=self.name, bucket=bucket_name)
+                raise Saturated(f"{self.name} {bucket_name} quota exhausted beyond {self.max_wait}s")
+            reserved.append((bucket, n))
+            wait = max(wait, needed)
+        if wait:
+            self._count('throttled_s', wait)
+            telemetry.count('api.throttled_seconds', wait, backend=self.name)
+            time.sleep(wait)
+
+    def adjust(self, bucket_name, n):
+        bucket = self.buckets.get(bucket_name)
+        if bucket is not None and n:
+            bucket.adjust(n)
+
+    def penalize(self, error):
+        """Backs every caller off after a rate-limit answer. Returns the provider's hint, if any."""
+        hint = retry_after(error)
+        if is_rate_limited(error):
+            self._count('rate_limited')
+            for bucket in self.buckets.values():
+                bucket.pause(hint if hint is not None else self.base_delay)
+        return hint
+
+    def call(self, fn, idempotent=True, method=None, **costs):
+        """Runs `fn()` under quota, retrying transient failures with backoff.
+
+        With `idempotent=False` only rate-limit answers are retried, since the
+        provider rejected those before doing any work. `method` names the
+        call in telemetry spans and counters.
+        """
+        method = method or self.name
+        for attempt in range(self.max_retries + 1):
+            if self.breaker and not self.breaker.allow():
+                self._count('saturated')
+                telemetry.count('api.calls', backend=self.name, method=method, outcome='circuit_open')
+                raise Saturated(f"{self.name} circuit open")
+            settled = False
+            try:
+                self.acquire(**costs)
+                self._count('calls')
+                try:
+                    with telemetry.span(method, backend=self.name, attempt=attempt):
+                        result = fn()
+                except Exception as e:
+                    telemetry.count('api.calls', backend=self.name, method=method, outcome=status_of(e) or type(e).__name__)
+                    if not is_retryable(e) or (not idempotent and not is_rate_limited(e)):
+                        raise
+                    hint = self.penalize(e)
+                    if self.breaker:
+                        self.breaker.record_failure()
+                        settled = True
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.backoff(attempt, hint)
+                    self._count('retries')
+                    telemetry.count('api.retries', backend=self.name, method=method)
+                    print(f"{self.name} call failed ({e}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                telemetry.count('api.calls', backend=self.name, method=method, outcome='ok')
+                if self.breaker:
+                    self.breaker.record_success()
+                    settled = True
+                return result
+            finally:
+                # A trial call that raised anything else (or found no quota) must not leave the circuit half-open
+                if self.breaker and not settled:
+                    self.breaker.abandon()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['throttled_s'] = round(stats['throttled_s'], 2)
+        if self.breaker:
+            stats['circuit'] = self.breaker.state
+        return stats
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def _llm_rates(shards):
+    """(requests, tokens) per second for one container's share of the LLM key's limits."""
+    return (_env_float("LLM_REQUESTS_PER_MINUTE", "500") / 60 / shards,
+            _env_float("LLM_TOKENS_PER_MINUTE", "200000") / 60 / shards)
+
+
+def _build_backend(name):
+    if name == 'gmail':
+        # Per-user limit: 250 quota units per second (moving average)
+        units = _env_float("GMAIL_QUOTA_UNITS_PER_SECOND", "250")
+        return Backend('gmail', {'units': TokenBucket(units)})
+    if name == 'drive':
+        requests = _env_float("DRIVE_REQUESTS_PER_MINUTE", "12000") / 60
+        writes = _env_float("DRIVE_WRITES_PER_SECOND", "3")
+        return Backend('drive', {'requests': TokenBucket(requests), 'writes': TokenBucket(writes, max(1.0, writes * 2))})
+    if name == 'llm':
+        requests, tokens = _llm_rates(_llm_shards)
+        return Backend(
+            'llm',
+            {'requests': TokenBucket(requests, max(1.0, requests * 5)), 'tokens': TokenBucket(tokens, tokens * 10)},
+            max_retries=int(os.environ.get("LLM_MAX_RETRIES", "3")),
+            max_wait=_env_float("LLM_MAX_WAIT_SECONDS", "30"),
+            breaker=CircuitBreaker(
+                threshold=int(os.environ.get("LLM_CIRCUIT_THRESHOLD", "5")),
+                reset_seconds=_env_float("LLM_CIRCUIT_RESET_SECONDS", "60")
+            )
+        )
+    raise ValueError(f"Unknown backend {name}")
+
+
+def get_backend(name, scope=None):
+    """One backend per API and scope, shared by every thread and invocation in the container.
+
+    Gmail and Drive quotas are per user, so callers scope them by account;
+    the LLM budget belongs to the API key and is never scoped.
+    """
+    key = (name, None if name == 'llm' else scope)
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is None:
+            backend = _build_backend(name)
+            _backends[key] = backend
+        return backend
+
+
+def set_llm_shards(shards):
+    """Splits the LLM key's limits between `shards` containers. A warm container's backend is rescaled in place."""
+    global _llm_shards
+    with _backends_lock:
+        _llm_shards = max(1, int(shards))
+        backend = _backends.get(('llm', None))
+    if backend is not None:
+        requests, tokens = _llm_rates(_llm_shards)
+        backend.buckets['requests'].set_rate(requests, max(1.0, requests * 5))
+        backend.buckets['tokens'].set_rate(tokens, tokens * 10)
+
+
+def reset_backends():
+    """Forgets every backend (and its buckets and counters), e.g. between benchmark runs."""
+    with _backends_lock:
+        _backends.clear()
+
+
+def backend_stats(scope=None):
+    with _backends_lock:
+        backends = {name: backend for (name, backend_scope), backend in _backends.items() if backend_scope in (scope, None)}
+    return {name: backend.stats() for name, backend in backends.items()}
+
+
+def service_scope(service):
+    """The quota scope a discovery service was built with (see `throttled_request_class`)."""
+    return getattr(getattr(service, '_requestBuilder', None), 'scope', None)
+
+
+def request_costs(method_id):
+    """Returns (backend_name, costs) for a discovery method ID such as 'gmail.users.messages.get'."""
+    method_id = method_id or ''
+    if method_id.startswith('gmail.'):
+        return 'gmail', {'units': GMAIL_QUOTA_UNITS.get(method_id, DEFAULT_GMAIL_UNITS)}
+    if method_id.startswith('drive.'):
+        return 'drive', {'requests': 1, 'writes': 1 if method_id in DRIVE_WRITE_METHODS else 0}
+    return None, {}
+
+
+class ThrottledHttpRequest(HttpRequest):
+    """googleapiclient request whose execute() goes through the shared quota scheduler.
+
+    Passed to discovery as `requestBuilder`, so every Gmail/Drive call site is
+    covered without wrapping each `.execute()`.
+    """
+    scope = None
+
+    def execute(self, http=None, num_retries=0):
+        name, costs = request_costs(self.methodId)
+        if name is None:
+            return super().execute(http=http, num_retries=num_retries)
+        return get_backend(name, self.scope).call(
+            lambda: HttpRequest.execute(self, http=http, num_retries=0),
+            idempotent=self.methodId not in NON_IDEMPOTENT_METHODS,
+            method=self.methodId,
+            **costs
+        )
+
+
+_request_classes = {}
+
+
+def throttled_request_class(scope=None):
+    """ThrottledHttpRequest bound to one account's quota scope."""
+    with _backends_lock:
+        cls = _request_classes.get(scope)
+        if cls is None:
+            cls = type('ThrottledHttpRequest', (ThrottledHttpRequest,), {'scope': scope})
+            _request_classes[scope] = cls
+        return cls
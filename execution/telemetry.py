@@ -0,0 +1,307 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextlib
+import urllib.request
+from collections import Counter, defaultdict
+
+# Spans kept for export per tick; past this only the per-stage aggregates grow
+DEFAULT_MAX_SPANS = 20000
+OTLP_BATCH_SPANS = 1000
+SERVICE_NAME = "gmail-bot"
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Telemetry:
+    """Timing spans and counters for one tick, aggregated in memory and exported when the tick ends.
+
+    Recording a span or counter is a clock read and a locked append, cheap
+    enough to leave on in production. Spans nest per thread, so API calls
+    made inside a pipeline stage are exported as its children.
+    """
+
+    def __init__(self, attributes=None, exporters=(), max_spans=DEFAULT_MAX_SPANS):
+        self.attributes = dict(attributes or {})
+        self.exporters = list(exporters)
+        self.max_spans = max_spans
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self.dropped_spans = 0
+        self.durations = defaultdict(list)
+        self.errors = Counter()
+        self.counters = Counter()
+        # Spans started outside any other span (e.g. on pipeline worker threads) hang off the tick span
+        self.root_span_id = uuid.uuid4().hex[:16]
+        self.started_ns = time.time_ns()
+        self._started = time.perf_counter_ns()
+        self._clock_offset = self.started_ns - time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Times the enclosed block as `name`. Exceptions mark the span as failed and propagate."""
+        parent = getattr(self._local, 'span_id', None)
+        span_id = uuid.uuid4().hex[:16]
+        self._local.span_id = span_id
+        start = time.perf_counter_ns()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self._local.span_id = parent
+            self.record_span(name, start, time.perf_counter_ns(), attributes, error, span_id, parent or self.root_span_id)
+
+    def record_span(self, name, start_ns, end_ns, attributes=None, error=None, span_id=None, parent_id=None):
+        """Records a span from perf_counter_ns() readings, for timings measured elsewhere."""
+        with self._lock:
+            self.durations[name].append(end_ns - start_ns)
+            if error:
+                self.errors[name] += 1
+            if len(self.spans) < self.max_spans:
+                self.spans.append({
+                    'name': name,
+                    'span_id': span_id or uuid.uuid4().hex[:16],
+                    'parent_id': parent_id or (self.root_span_id if name != 'tick' else None),
+                    'start_ns': start_ns + self._clock_offset,
+                    'end_ns': end_ns + self._clock_offset,
+                    'attributes': attributes or {},
+                    'error': error,
+                })
+            else:
+                self.dropped_spans += 1
+
+    def count(self, name, n=1, **labels):
+        with self._lock:
+            self.counters[(name, _label_key(labels))] += n
+
+    def summary(self):
+        """Per-stage latency (count, total, p50/p95/max), counters and derived hit rates for the tick."""
+        with self._lock:
+            durations = {name: sorted(values) for name, values in self.durations.items()}
+            errors = dict(self.errors)
+            counters = dict(self.counters)
+            dropped = self.dropped_spans
+        stages = {}
+        for name, values in sorted(durations.items()):
+            stages[name] = {
+                'count': len(values),
+                'total_s': round(sum(values) / 1e9, 3),
+                'p50_ms': round(_percentile(values, 0.5) / 1e6, 1),
+                'p95_ms': round(_percentile(values, 0.95) / 1e6, 1),
+                'max_ms': round(values[-1] / 1e6, 1),
+                'errors': errors.get(name, 0),
+            }
+        flat = {}
+        for (name, key), n in sorted(counters.items()):
+            label = name + ("{" + ",".join(f"{k}={v}" for k, v in key) + "}" if key else "")
+            flat[label] = round(n, 3) if isinstance(n, float) else n
+        return {
+            'trace_id': self.trace_id,
+            **self.attributes,
+            'seconds': round((time.time_ns() - self.started_ns) / 1e9, 2),
+            'stages': stages,
+            'counters': flat,
+            'rates': self._rates(counters),
+            'dropped_spans': dropped,
+        }
+
+    @staticmethod
+    def _rates(counters):
+        """Hit rates of each classification source and of attachment dedup."""
+        totals = defaultdict(Counter)
+        for (name, key), n in counters.items():
+            labels = dict(key)
+            if name == 'classify.source':
+                totals['classify'][labels.get('source')] += n
+            elif name == 'attachments':
+                totals['attachments']['dedup' if labels.get('mode') in ('duplicate', 'shortcut') else 'upload'] += n
+        rates = {}
+        for group, counts in totals.items():
+            total = sum(counts.values())
+            for key, n in counts.items():
+                rates[f"{group}.{key}"] = round(n / total, 3)
+        return rates
+
+    def finish(self):
+        """Prints the tick summary as one JSON line and hands everything to the exporters."""
+        self.record_span('tick', self._started, time.perf_counter_ns(), dict(self.attributes), span_id=self.root_span_id)
+        summary = self.summary()
+        print(json.dumps({'event': 'tick_summary', **summary}))
+        for exporter in self.exporters:
+            try:
+                exporter.export(self, summary)
+            except Exception as e:
+                print(f"Telemetry export via {type(exporter).__name__} failed: {e}")
+        return summary
+
+
+class NullTelemetry:
+    """Drop-in used when telemetry is off or outside a tick: records nothing."""
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        yield attributes
+
+    def record_span(self, *args, **kwargs):
+        pass
+
+    def count(self, name, n=1, **labels):
+        pass
+
+    def finish(self):
+        return None
+
+
+class JsonLinesExporter:
+    """Writes spans and counters as JSON lines, to stdout or appended to a file."""
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def export(self, telemetry, summary):
+        lines = [json.dumps({'event': 'span', 'trace_id': telemetry.trace_id, **span}) for span in telemetry.spans]
+        for label, n in summary['counters'].items():
+            lines.append(json.dumps({'event': 'counter', 'trace_id': telemetry.trace_id, 'name': label, 'value': n}))
+        if self.path is None:
+            for line in lines:
+                print(line)
+            return
+        with open(self.path, "a") as f:
+            f.write("\n".join(lines + [json.dumps({'event': 'tick_summary', **summary})]) + "\n")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{'key': k, 'value': _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+
+class OtlpExporter:
+    """Sends spans and counters to an OpenTelemetry collector over OTLP/HTTP (JSON encoding).
+
+    Uses the standard OTEL_EXPORTER_OTLP_ENDPOINT and OTEL_EXPORTER_OTLP_HEADERS
+    variables; no OpenTelemetry SDK is needed.
+    """
+
+    def __init__(self, endpoint=None, headers=None, timeout=10):
+        self.endpoint = (endpoint or os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")).rstrip("/")
+        self.headers = {'Content-Type': 'application/json'}
+        for item in (headers or os.environ.get("OTEL_EXPORTER_OTLP_HEADERS", "")).split(","):
+            if "=" in item:
+                key, value = item.split("=", 1)
+                self.headers[key.strip()] = value.strip()
+        self.timeout = timeout
+
+    def _post(self, path, body):
+        request = urllib.request.Request(self.endpoint + path, data=json.dumps(body).encode('utf-8'),
+                                         headers=self.headers, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.status
+
+    def _resource(self, telemetry):
+        attributes = {'service.name': os.environ.get("OTEL_SERVICE_NAME", SERVICE_NAME)}
+        attributes.update(telemetry.attributes)
+        return {'attributes': _otlp_attributes(attributes)}
+
+    def export(self, telemetry, summary):
+        resource = self._resource(telemetry)
+        scope = {'name': SERVICE_NAME}
+        for start in range(0, len(telemetry.spans), OTLP_BATCH_SPANS):
+            spans = [{
+                'traceId': telemetry.trace_id,
+                'spanId': span['span_id'],
+                'parentSpanId': span['parent_id'] or '',
+                'name': span['name'],
+                'kind': 1,
+                'startTimeUnixNano': str(span['start_ns']),
+                'endTimeUnixNano': str(span['end_ns']),
+                'attributes': _otlp_attributes(span['attributes']),
+                'status': {'code': 2, 'message': span['error']} if span['error'] else {'code': 1},
+            } for span in telemetry.spans[start:start + OTLP_BATCH_SPANS]]
+            self._post('/v1/traces', {'resourceSpans': [{'resource': resource, 'scopeSpans': [{'scope': scope, 'spans': spans}]}]})
+
+        now = str(time.time_ns())
+        metrics = defaultdict(list)
+        with telemetry._lock:
+            counters = dict(telemetry.counters)
+        for (name, key), n in counters.items():
+            point = {'attributes': _otlp_attributes(dict(key)), 'startTimeUnixNano': str(telemetry.started_ns), 'timeUnixNano': now}
+            point.update({'asDouble': n} if isinstance(n, float) else {'asInt': str(n)})
+            metrics[name].append(point)
+        if metrics:
+            # Each tick reports its own increments: delta temporality
+            payload = [{'name': name, 'sum': {'dataPoints': points, 'aggregationTemporality': 1, 'isMonotonic': True}}
+                       for name, points in metrics.items()]
+            self._post('/v1/metrics', {'resourceMetrics': [{'resource': resource, 'scopeMetrics': [{'scope': scope, 'metrics': payload}]}]})
+
+
+def exporters_from_env():
+    """Exporters named in TELEMETRY_EXPORT, e.g. "jsonl", "jsonl:/root/state/telemetry.jsonl", "otlp"."""
+    exporters = []
+    for item in os.environ.get("TELEMETRY_EXPORT", "").split(","):
+        kind, _, target = item.strip().partition(":")
+        if kind == "jsonl":
+            exporters.append(JsonLinesExporter(target or None))
+        elif kind == "otlp":
+            exporters.append(OtlpExporter(target or None))
+        elif kind:
+            print(f"Unknown telemetry exporter '{kind}', ignoring.")
+    return exporters
+
+
+_null = NullTelemetry()
+_current = _null
+_last_summary = None
+
+
+def start_tick(**attributes):
+    """Starts collecting for a tick and makes it the process-wide current telemetry."""
+    global _current
+    if os.environ.get("TELEMETRY", "on").lower() in ("0", "off", "false"):
+        _current = _null
+    else:
+        _current = Telemetry(attributes, exporters_from_env(),
+                             int(os.environ.get("TELEMETRY_MAX_SPANS", str(DEFAULT_MAX_SPANS))))
+    return _current
+
+
+def finish_tick():
+    """Emits the current tick's summary and exports. Returns the summary (None when off)."""
+    global _current, _last_summary
+    telemetry, _current = _current, _null
+    _last_summary = telemetry.finish()
+    return _last_summary
+
+
+def last_summary():
+    """Summary of the most recently finished tick in this process."""
+    return _last_summary
+
+
+def span(name, **attributes):
+    return _current.span(name, **attributes)
+
+
+def count(name, n=1, **labels):
+    _current.count(name, n, **labels)
@@ -0,0 +1,57 @@
+import os
+import base64
+import hashlib
+import json
+
+import pytest  # type: ignore
+
+from attachment_dedup import sha256_of
+from attachment_transfer import Base64Reader
+
+
+def response_for(data):
+    """Attachment response bytes as Gmail sends them, plus the [start, end) span of the base64 `data`."""
+    encoded = base64.urlsafe_b64encode(data)
+    raw = json.dumps({'size': len(data), 'data': encoded.decode()}).encode()
+    start = raw.index(encoded)
+    return raw, start, start + len(encoded)
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 4, 1000, 1001, 1002])
+def test_reads_back_the_decoded_bytes(size):
+    data = os.urandom(size)
+    reader = Base64Reader(*response_for(data))
+
+    assert reader.size == size
+    assert reader.read() == data
+    assert reader.read() == b""
+
+
+def test_reads_arbitrary_windows():
+    data = bytes(range(256)) * 40
+    reader = Base64Reader(*response_for(data))
+
+    for offset, n in [(0, 1), (1, 5), (2, 7), (4095, 100), (len(data) - 3, 10), (len(data), 5)]:
+        reader.seek(offset)
+        assert reader.read(n) == data[offset:offset + n]
+        assert reader.tell() == min(offset + n, len(data))
+
+
+def test_seeks_like_a_file():
+    data = os.urandom(500)
+    reader = Base64Reader(*response_for(data))
+
+    assert reader.seek(-10, os.SEEK_END) == 490
+    assert reader.read() == data[490:]
+    reader.seek(100)
+    assert reader.seek(20, os.SEEK_CUR) == 120
+    assert reader.seek(10000) == 500
+    assert reader.seek(-5) == 0
+
+
+def test_chunked_hash_matches_and_rewinds():
+    data = os.urandom(10000)
+    reader = Base64Reader(*response_for(data))
+
+    assert sha256_of(reader, chunk_size=333) == hashlib.sha256(data).hexdigest()
+    assert reader.tell() == 0
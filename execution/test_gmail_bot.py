@@ -0,0 +1,27 @@
+from gmail_bot import parse_batch_categories
+
+IDS = ['1', '2', '3']
+
+
+def test_parses_a_plain_reply():
+    assert parse_batch_categories('{"1": "Accounting", "2": "social", "3": "Misc"}', IDS) == {
+        '1': 'Accounting', '2': 'Social', '3': 'Misc',
+    }
+
+
+def test_parses_json_wrapped_in_prose_or_code_fences():
+    text = 'Here you go:\n```json\n{"1": "Accounting", "2": "Personal"}\n```'
+    assert parse_batch_categories(text, IDS) == {'1': 'Accounting', '2': 'Personal'}
+
+
+def test_drops_unknown_ids_and_unusable_categories():
+    text = '{"1": "Accounting", "9": "Social", " 2 ": "Personal", "3": ["Misc"]}'
+    assert parse_batch_categories(text, IDS) == {'1': 'Accounting', '2': 'Personal'}
+    assert parse_batch_categories('{"1": ""}', IDS) == {}
+    assert parse_batch_categories('{"1": "' + 'x' * 40 + '"}', IDS) == {}
+
+
+def test_unparseable_replies_give_nothing():
+    assert parse_batch_categories('Accounting', IDS) == {}
+    assert parse_batch_categories('{"1": "Accounting",', IDS) == {}
+    assert parse_batch_categories('["Accounting"]', IDS) == {}
@@ -0,0 +1,103 @@
+from types import SimpleNamespace
+
+import pytest  # type: ignore
+
+from fake_services import google_error
+from gmail_sync import UNPROCESSED_QUERY, load_sync_state, save_sync_state, sync_message_ids
+
+AI_PROCESSED = 'Label_AI'
+
+
+class Call:
+    def __init__(self, handler, kwargs):
+        self.handler = handler
+        self.kwargs = kwargs
+
+    def execute(self):
+        return self.handler(**self.kwargs)
+
+
+class StubGmail:
+    """Serves history.list and messages.list from canned pages, keyed by page token."""
+
+    def __init__(self, history_pages=None, message_pages=None, history_error=None):
+        self.history_pages = history_pages or {}
+        self.message_pages = message_pages or {}
+        self.history_error = history_error
+        self.history_calls = []
+        self.message_calls = []
+
+    def users(self):
+        return self
+
+    def history(self):
+        return SimpleNamespace(list=lambda **kwargs: Call(self._history, kwargs))
+
+    def messages(self):
+        return SimpleNamespace(list=lambda **kwargs: Call(self._messages, kwargs))
+
+    def _history(self, **kwargs):
+        self.history_calls.append(kwargs)
+        if self.history_error:
+            raise self.history_error
+        return self.history_pages[kwargs.get('pageToken')]
+
+    def _messages(self, **kwargs):
+        self.message_calls.append(kwargs)
+        return self.message_pages[kwargs.get('pageToken')]
+
+
+def added(msg_id, *label_ids):
+    return {'messagesAdded': [{'message': {'id': msg_id, 'labelIds': list(label_ids)}}]}
+
+
+def test_cursor_lists_new_inbox_mail_across_pages():
+    gmail = StubGmail(history_pages={
+        None: {'history': [added('a', 'INBOX'), added('b', 'SENT'), added('a', 'INBOX')], 'nextPageToken': 'p2'},
+        'p2': {
+            'history': [
+                added('c', 'INBOX', AI_PROCESSED),
+                # Moved back into the inbox by hand
+                {'labelsAdded': [{'message': {'id': 'd', 'labelIds': ['INBOX']}, 'labelIds': ['INBOX']}]},
+            ],
+            'historyId': '120',
+        },
+    })
+
+    message_ids, history_id = sync_message_ids(gmail, {'history_id': '100'}, '130', AI_PROCESSED)
+
+    assert message_ids == ['a', 'd']
+    assert history_id == '120'
+    assert [call['startHistoryId'] for call in gmail.history_calls] == ['100', '100']
+    assert not gmail.message_calls
+
+
+def test_expired_cursor_falls_back_to_full_resync():
+    gmail = StubGmail(
+        history_error=google_error(404, 'notFound'),
+        message_pages={
+            None: {'messages': [{'id': 'a'}, {'id': 'b'}], 'nextPageToken': 'p2'},
+            'p2': {'messages': [{'id': 'c'}]},
+        },
+    )
+
+    message_ids, history_id = sync_message_ids(gmail, {'history_id': '100', 'synced_at': 1700000000}, '130')
+
+    assert message_ids == ['a', 'b', 'c']
+    # The profile's historyId (read before listing) becomes the new cursor
+    assert history_id == '130'
+    assert gmail.message_calls[0]['q'] == f"{UNPROCESSED_QUERY} after:1700000000"
+
+
+def test_other_history_errors_are_not_resynced():
+    gmail = StubGmail(history_error=google_error(500))
+
+    with pytest.raises(Exception):
+        sync_message_ids(gmail, {'history_id': '100'}, '130')
+    assert not gmail.message_calls
+
+
+def test_sync_state_round_trip(tmp_path):
+    assert load_sync_state(str(tmp_path)) == {}
+    save_sync_state(str(tmp_path / "state"), {'history_id': '120', 'synced_at': 1700000000})
+    assert load_sync_state(str(tmp_path / "state")) == {'history_id': '120', 'synced_at': 1700000000}
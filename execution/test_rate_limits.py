@@ -0,0 +1,112 @@
+import threading
+
+import pytest  # type: ignore
+
+import rate_limits
+from rate_limits import Backend, CircuitBreaker, Saturated, TokenBucket
+
+RESET_SECONDS = 60
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status_code = status
+
+
+class Clock:
+    """Stands in for the `time` module inside rate_limits, so waits move the clock instead of sleeping."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limits, 'time', clock)
+    return clock
+
+
+def open_backend(clock, max_wait=None):
+    """LLM-like backend whose circuit has opened and is due for its trial call."""
+    breaker = CircuitBreaker(threshold=1, reset_seconds=RESET_SECONDS)
+    backend = Backend('llm', {'requests': TokenBucket(100)}, max_retries=0, base_delay=0, max_wait=max_wait,
+                      breaker=breaker)
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(Saturated):
+        backend.call(lambda: 'ok', requests=1)
+    clock.sleep(RESET_SECONDS)
+    return backend, breaker
+
+
+def test_trial_with_non_retryable_error_reopens_circuit(clock):
+    backend, breaker = open_backend(clock)
+
+    def bad_request():
+        raise FakeHttpError(400)
+
+    with pytest.raises(FakeHttpError):
+        backend.call(bad_request, requests=1)
+    assert breaker.state == 'open'
+    with pytest.raises(Saturated):
+        backend.call(lambda: 'ok', requests=1)
+    # The next trial goes through instead of failing with "circuit open" forever
+    clock.sleep(RESET_SECONDS)
+    assert backend.call(lambda: 'ok', requests=1) == 'ok'
+    assert breaker.state == 'closed'
+
+
+def test_trial_without_quota_reopens_circuit(clock):
+    backend, breaker = open_backend(clock, max_wait=0.01)
+    backend.buckets['requests'].pause(RESET_SECONDS)
+
+    with pytest.raises(Saturated):
+        backend.call(lambda: 'ok', requests=1)
+    assert breaker.state == 'open'
+    clock.sleep(RESET_SECONDS)
+    assert backend.call(lambda: 'ok', requests=1) == 'ok'
+    assert breaker.state == 'closed'
+
+
+def test_non_trial_error_leaves_other_threads_trial_alone(clock):
+    breaker = CircuitBreaker(threshold=1, reset_seconds=RESET_SECONDS)
+    backend = Backend('llm', {}, max_retries=0, breaker=breaker)
+    started, proceed = threading.Event(), threading.Event()
+    errors = []
+
+    def slow_bad_request():
+        started.set()
+        proceed.wait(5)
+        raise FakeHttpError(400)
+
+    def worker():
+        try:
+            backend.call(slow_bad_request)
+        except FakeHttpError as e:
+            errors.append(e)
+
+    # A call let through while the circuit was closed fails after another thread took the trial
+    thread = threading.Thread(target=worker)
+    thread.start()
+    started.wait(5)
+    breaker.record_failure()
+    clock.sleep(RESET_SECONDS)
+    assert breaker.allow()
+    proceed.set()
+    thread.join(5)
+
+    assert errors
+    assert breaker.state == 'half-open'
+    breaker.record_success()
+    assert breaker.state == 'closed'
@@ -0,0 +1,57 @@
+import pytest  # type: ignore
+
+from thread_decisions import ThreadDecisions
+
+INSTRUCTIONS = "Invoices go to Accounting."
+ALICE = "Alice <alice@example.com>"
+BOB = "bob@example.com"
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "thread_decisions.sqlite")
+
+
+def test_replies_from_known_participants_inherit_the_category(path):
+    threads = ThreadDecisions(path, INSTRUCTIONS)
+    threads.record('t1', ALICE, "Invoice 1042", 'Accounting')
+
+    assert threads.lookup('t1', "alice@example.com", "Re: Invoice 1042") == 'Accounting'
+    assert threads.lookup('t1', ALICE, "RE: Fwd: invoice 1042") == 'Accounting'
+    assert threads.stats() == {'inherited': 2, 'changed': 0, 'new': 0}
+    threads.close()
+
+
+def test_new_sender_or_subject_is_flagged_as_changed(path):
+    threads = ThreadDecisions(path, INSTRUCTIONS)
+    threads.record('t1', ALICE, "Invoice 1042", 'Accounting')
+
+    assert threads.lookup('t1', BOB, "Re: Invoice 1042") is None
+    assert threads.lookup('t1', ALICE, "Re: Dinner on Friday?") is None
+    assert threads.lookup('t2', ALICE, "Invoice 1042") is None
+    assert threads.stats() == {'inherited': 0, 'changed': 2, 'new': 1}
+    threads.close()
+
+
+def test_recorded_senders_join_the_participants(path):
+    threads = ThreadDecisions(path, INSTRUCTIONS)
+    threads.record('t1', ALICE, "Invoice 1042", 'Accounting')
+    threads.record('t1', BOB, "Re: Invoice 1042", 'Accounting')
+
+    assert threads.lookup('t1', ALICE, "Re: Invoice 1042") == 'Accounting'
+    assert threads.lookup('t1', BOB, "Re: Invoice 1042") == 'Accounting'
+    threads.close()
+
+
+def test_decisions_expire_and_are_dropped_when_instructions_change(path):
+    threads = ThreadDecisions(path, INSTRUCTIONS, ttl_seconds=-1)
+    threads.record('t1', ALICE, "Invoice 1042", 'Accounting')
+    assert threads.lookup('t1', ALICE, "Re: Invoice 1042") is None
+    threads.close()
+
+    threads = ThreadDecisions(path, INSTRUCTIONS)
+    threads.record('t1', ALICE, "Invoice 1042", 'Accounting')
+    threads.close()
+    threads = ThreadDecisions(path, INSTRUCTIONS + "\nReceipts go to Accounting too.")
+    assert threads.lookup('t1', ALICE, "Re: Invoice 1042") is None
+    threads.close()
@@ -0,0 +1,82 @@
+import pytest  # type: ignore
+
+import work_queue
+from work_queue import WorkQueue
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(work_queue, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    queue = WorkQueue(str(tmp_path / "work_queue.sqlite"), max_attempts=2, lease_seconds=600)
+    yield queue
+    queue.close()
+
+
+def test_leased_messages_are_not_claimed_twice(queue, clock):
+    queue.enqueue(['a', 'b'])
+
+    assert queue.claim(['a', 'b'], 'tick-1') == ['a', 'b']
+    assert queue.claim(['a', 'b'], 'tick-2') == []
+    assert queue.pending_ids() == []
+    # An abandoned lease lapses and the message is retried
+    clock.now += 601
+    assert sorted(queue.pending_ids()) == ['a', 'b']
+    assert queue.claim(['a'], 'tick-2') == ['a']
+
+
+def test_release_and_fail_free_messages_for_the_next_tick(queue):
+    queue.enqueue(['a', 'b', 'c'])
+    queue.claim(['a', 'b', 'c'], 'tick-1')
+    queue.complete(['a'])
+    queue.fail('b', RuntimeError("boom"))
+    queue.release('tick-1')
+
+    assert sorted(queue.pending_ids()) == ['b', 'c']
+    assert queue.claim(['a', 'b', 'c'], 'tick-2') == ['b', 'c']
+    assert queue.stats() == {'done': 1, 'pending': 2}
+
+
+def test_message_is_quarantined_after_max_attempts(queue):
+    queue.enqueue(['a'])
+    for owner in ('tick-1', 'tick-2'):
+        assert queue.claim(['a'], owner) == ['a']
+        queue.fail('a', RuntimeError("boom"))
+
+    assert queue.claim(['a'], 'tick-3') == []
+    assert queue.stats() == {'quarantined': 1}
+
+
+def test_checkpoints_survive_a_retry(queue):
+    queue.enqueue(['a'])
+    queue.claim(['a'], 'tick-1')
+    queue.set_category('a', 'Accounting')
+    queue.item('a').record('forward')
+    queue.release('tick-1')
+
+    item = queue.item('a')
+    assert item.category == 'Accounting'
+    assert item.done('forward')
+    assert not item.done('draft')
+
+
+def test_live_and_backfill_retries_stay_apart(queue):
+    queue.enqueue(['old-1', 'old-2'], origin='backfill')
+    # Live sync sees one of them too: it is new mail, so it becomes live
+    queue.enqueue(['old-2', 'new'])
+
+    assert sorted(queue.pending_ids(origin='live')) == ['new', 'old-2']
+    assert queue.pending_ids(origin='backfill') == ['old-1']
@@ -0,0 +1,112 @@
+import json
+import time
+import sqlite3
+import threading
+from email.utils import parseaddr
+
+from classification_cache import instructions_version, subject_template
+
+DEFAULT_TTL_SECONDS = 14 * 24 * 3600
+# How long a message waits for a sibling in its thread being classified elsewhere in the tick
+DEFAULT_WAIT_SECONDS = 60
+
+
+def sender_address(sender):
+    return parseaddr(sender or '')[1].lower() or (sender or '').lower()
+
+
+class ThreadDecisions:
+    """Category decided per Gmail thread, with the participants and subject it was decided for (SQLite).
+
+    A later message in the thread inherits the category unless a cheap change
+    detector flags it: a sender who hasn't written in the thread before, or a
+    subject that differs beyond reply prefixes. Decisions made under other
+    instructions are dropped on open.
+
+    `claim`/`release` make the first classification of a thread single-flight
+    across the tick's concurrent classify workers; the rest `wait` for it.
+    """
+
+    def __init__(self, path, instructions, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.version = instructions_version(instructions)
+        self.counters = {'inherited': 0, 'changed': 0, 'new': 0}
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            " thread_id TEXT PRIMARY KEY,"
+            " version TEXT NOT NULL,"
+            " category TEXT NOT NULL,"
+            " participants TEXT NOT NULL,"
+            " subject TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "DELETE FROM threads WHERE version != ? OR updated_at < ?",
+            (self.version, time.time() - ttl_seconds)
+        )
+        self._conn.commit()
+
+    def _row(self, thread_id):
+        return self._conn.execute(
+            "SELECT category, participants, subject, updated_at FROM threads WHERE thread_id = ? AND version = ?",
+            (thread_id, self.version)
+        ).fetchone()
+
+    def lookup(self, thread_id, sender, subject):
+        """Returns the thread's category for a new message, or None when unknown, expired or changed."""
+        with self._lock:
+            row = self._row(thread_id)
+            if not row or time.time() - row[3] > self.ttl_seconds:
+                self.counters['new'] += 1
+                return None
+            if sender_address(sender) not in json.loads(row[1]) or subject_template(subject) != row[2]:
+                self.counters['changed'] += 1
+                return None
+            self._conn.execute("UPDATE threads SET updated_at = ? WHERE thread_id = ?", (time.time(), thread_id))
+            self._conn.commit()
+            self.counters['inherited'] += 1
+            return row[0]
+
+    def record(self, thread_id, sender, subject, category):
+        """Stores the decision for the thread; the sender joins its participants, the subject replaces the old one."""
+        with self._lock:
+            row = self._row(thread_id)
+            participants = set(json.loads(row[1])) if row else set()
+            participants.add(sender_address(sender))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO threads (thread_id, version, category, participants, subject, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (thread_id, self.version, category, json.dumps(sorted(participants)), subject_template(subject), time.time())
+            )
+            self._conn.commit()
+
+    def claim(self, thread_id):
+        """True if the caller should classify the thread; False if another worker already is."""
+        with self._lock:
+            if thread_id in self._inflight:
+                return False
+            self._inflight[thread_id] = threading.Event()
+            return True
+
+    def release(self, thread_id):
+        with self._lock:
+            event = self._inflight.pop(thread_id, None)
+        if event:
+            event.set()
+
+    def wait(self, thread_id, timeout=DEFAULT_WAIT_SECONDS):
+        with self._lock:
+            event = self._inflight.get(thread_id)
+        if event:
+            event.wait(timeout)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,1063 @@
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import base64
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+from collections import Counter, defaultdict, deque
+from email.utils import getaddresses
+from types import SimpleNamespace
+
+import gmail_bot
+import telemetry
+from accounts import Account, load_accounts
+from benchmark import REPO_DIRECTIVES, NullVolume, RunProbe, compare_reports, environment, patched
+from classification_cache import subject_template
+from classification_rules import load_rules
+from fake_services import FOLDER_MIME_TYPE, CallStats, FakeBatch, FakeLLMError, FakeRequest, FakeService, google_error
+from gmail_backfill import build_backfill_query, new_backfill_state
+from gmail_push import SyncLease
+from profiling import StackSampler, profiled
+from prompt_builder import REPLY_SYSTEM
+from rate_limits import NON_IDEMPOTENT_METHODS, reset_backends, status_of
+
+CASSETTE_VERSION = 1
+REPLAY_SCOPE = "replay"
+# Directives copied (redacted) into the cassette, so a replay runs with the recorded rules and label IDs
+CASSETTE_DIRECTIVES = ("gmail_labels.md", "drive_config.md", "gmail_instructions.md", "gmail_rules.md")
+# Calls that change the mailbox or Drive; a read-only recording answers them itself instead
+WRITE_METHODS = NON_IDEMPOTENT_METHODS + (
+    'gmail.users.messages.modify', 'gmail.users.messages.batchModify', 'gmail.users.messages.trash',
+    'gmail.users.threads.modify', 'gmail.users.watch', 'gmail.users.stop', 'drive.files.update', 'drive.files.delete',
+)
+SIMULATED_ID_PREFIX = "readonly-"
+# Request arguments that name one resource: such calls are only ever answered by a recording of the same call
+IDENTITY_ARGS = ('id', 'messageId', 'fileId', 'startHistoryId', 'pageToken')
+
+# Headers kept in a cassette (addresses pseudonymized, file names in MIME parameters too); all others are dropped
+KEPT_HEADERS = (
+    'subject', 'date', 'message-id', 'in-reply-to', 'references', 'mime-version', 'content-type',
+    'content-disposition', 'content-transfer-encoding', 'precedence', 'auto-submitted', 'list-unsubscribe',
+)
+ADDRESS_HEADERS = ('from', 'to', 'cc', 'bcc', 'reply-to', 'sender', 'delivered-to', 'return-path', 'x-original-to')
+# Automated senders keep their address, so sender rules still match in a replay
+ROLE_LOCAL_PARTS = {
+    'noreply', 'no-reply', 'donotreply', 'do-not-reply', 'notifications', 'notification', 'alerts', 'billing',
+    'invoice', 'invoices', 'receipts', 'accounts', 'accounting', 'support', 'info', 'news', 'newsletter', 'updates',
+    'team', 'hello', 'deals', 'marketing', 'orders', 'shipping', 'mailer-daemon', 'postmaster', 'unsubscribe',
+}
+REDACTED_URL = "https://redacted.invalid/"
+FILLER_PREFIX = "filler:"
+FILLER_WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+                "et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris").split()
+
+_EMAIL = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+_URL = re.compile(r'https?://[^\s<>"\',]+')
+_REPLY_PREFIX = re.compile(r'^\s*((re|fw|fwd|aw|sv)\s*:\s*)+', re.IGNORECASE)
+_MIME_FILENAME = re.compile(r'\b((?:file)?name)(\*?\d*\*?)\s*=\s*("[^"]*"|[^;\s]*)', re.IGNORECASE)
+_CHARSET_PREFIX = re.compile(r"^[\w.-]*'[\w-]*'")
+_PSEUDONYM_LOCAL = re.compile(r'^u-[a-p]{10}$')
+_PSEUDONYM_SUBJECT = re.compile(r'^subj-[a-p]{10}$')
+_PSEUDONYM_FILE = re.compile(r'^file-[a-p]{10}(\.\w+)?$')
+_PROMPT_ID = re.compile(r'EMAIL ID: (\S+)')
+_PROMPT_SUBJECT = re.compile(r'SUBJECT: (.*)')
+
+
+def _letters(salt, text, n=10):
+    digest = hashlib.sha256(salt + text.encode('utf-8')).digest()
+    return ''.join(chr(97 + b % 16) for b in digest[:n])
+
+
+def filler_text(seed, size):
+    """`size` characters of placeholder words, the same for the same seed."""
+    rng = random.Random(seed)
+    block = " ".join(rng.choice(FILLER_WORDS) for _ in range(700))[:4096]
+    return (block * (size // len(block) + 1))[:size]
+
+
+class Redactor:
+    """Replaces personal content in recorded traffic, keeping sizes and structure.
+
+    Addresses, subjects and file names become salted pseudonyms that stay
+    consistent within a recording, so threads, senders and subject templates
+    group as they did. Bodies and attachments are reduced to a seed and a
+    size, and filled with placeholder text on replay. Only the headers the
+    bot reads are kept (plus any named in `headers`, e.g. by header rules).
+    Already-redacted values are left alone, so a replay computes the same
+    request keys.
+    """
+
+    def __init__(self, salt=None, headers=()):
+        # Never stored: pseudonyms can't be reversed by hashing guesses
+        self.salt = salt if salt is not None else os.urandom(16)
+        self.kept_headers = set(KEPT_HEADERS) | set(ADDRESS_HEADERS) | {h.lower() for h in headers}
+
+    def address(self, address):
+        local, _, domain = address.rpartition('@')
+        if not local or local.lower() in ROLE_LOCAL_PARTS or _PSEUDONYM_LOCAL.match(local):
+            return address
+        return f"u-{_letters(self.salt, local.lower())}@{domain.lower()}"
+
+    def text(self, value):
+        """Free text with addresses and URLs replaced."""
+        value = _EMAIL.sub(lambda m: self.address(m.group(0)), value)
+        return _URL.sub(lambda m: m.group(0) if m.group(0).startswith(REDACTED_URL)
+                        else REDACTED_URL + _letters(self.salt, m.group(0)), value)
+
+    def subject(self, value):
+        """Reply prefixes are kept and the rest hashed by its template, so subjects group as before."""
+        match = _REPLY_PREFIX.match(value or '')
+        prefix = match.group(0) if match else ''
+        rest = (value or '')[len(prefix):].strip()
+        if not rest or _PSEUDONYM_SUBJECT.match(rest):
+            return value
+        return f"{prefix}subj-{_letters(self.salt, subject_template(rest))}"
+
+    def filename(self, value):
+        if not value or _PSEUDONYM_FILE.match(value):
+            return value
+        stem, ext = os.path.splitext(value)
+        return f"file-{_letters(self.salt, stem)}{ext.lower()}"
+
+    def mime_params(self, value):
+        """A Content-Type/Content-Disposition value with its name and filename parameters pseudonymized."""
+        def pseudonym(match):
+            name = match.group(3).strip('"')
+            return f'{match.group(1)}="{self.filename(_CHARSET_PREFIX.sub("", name))}"'
+        return _MIME_FILENAME.sub(pseudonym, value)
+
+    def headers(self, headers):
+        """Message and part headers reduced to the allowlist."""
+        redacted = []
+        for header in headers:
+            name, value = header.get('name', ''), header.get('value', '')
+            if name.lower() not in self.kept_headers:
+                continue
+            if name.lower() in ADDRESS_HEADERS:
+                value = ", ".join(self.address(addr) for _, addr in getaddresses([value]) if addr)
+            elif name.lower() == 'subject':
+                value = self.subject(value)
+            elif name.lower() in ('content-type', 'content-disposition'):
+                value = self.mime_params(value)
+            else:
+                value = self.text(value)
+            redacted.append(dict(header, value=value))
+        return redacted
+
+    def data(self, value):
+        """Base64 content reduced to a marker holding its seed and decoded size."""
+        if value.startswith(FILLER_PREFIX):
+            return value
+        size = len(value) * 3 // 4 - value[-2:].count('=')
+        return f"{FILLER_PREFIX}{_letters(self.salt, value, 16)}:{size}"
+
+    def walk(self, value, key=None, parent=None):
+        """Redacts a request or response body."""
+        if isinstance(value, dict):
+            return {k: self.walk(v, k, value) for k, v in value.items()}
+        if isinstance(value, list):
+            if key == 'headers':
+                return self.headers(value)
+            return [self.walk(v, key, parent) for v in value]
+        if not isinstance(value, str):
+            return value
+        if key in ('data', 'raw'):
+            return self.data(value)
+        if key == 'snippet':
+            return filler_text(_letters(self.salt, value, 16), len(value))
+        if key == 'emailAddress':
+            return self.address(value)
+        if key == 'q':
+            return self.text(value)
+        if key in ('filename', 'originalFilename'):
+            return self.filename(value)
+        if key == 'name' and parent is not None and 'mimeType' in parent and parent['mimeType'] != FOLDER_MIME_TYPE:
+            # Drive files; label and folder names are categories and stay readable
+            return self.filename(value)
+        return value
+
+
+def request_key(method, kwargs, redactor):
+    """Stable key of a call's arguments, computed on redacted values (so record and replay agree)."""
+    kwargs = {k: v for k, v in kwargs.items() if k != 'media_body'}
+    if method in NON_IDEMPOTENT_METHODS:
+        kwargs.pop('body', None)
+    canonical = json.dumps(redactor.walk(kwargs), sort_keys=True, default=str)
+    return hashlib.sha256(f"{method}\x1f{canonical}".encode('utf-8')).hexdigest()[:20]
+
+
+def simulated_call(method, kwargs):
+    """Whether a read-only run answers a call itself: writes, and calls on what it pretended to create."""
+    return method in WRITE_METHODS or any(str(kwargs.get(arg, '')).startswith(SIMULATED_ID_PREFIX)
+                                          for arg in IDENTITY_ARGS)
+
+
+class Simulator:
+    """Stand-in answers for the calls a read-only run skips.
+
+    What a write pretends to create is named after the redacted call and how
+    many times it was made, so a replay makes up the same IDs whatever order
+    its threads write in.
+    """
+
+    def __init__(self, redactor):
+        self.redactor = redactor
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def answer(self, method, kwargs):
+        kwargs = {k: v for k, v in kwargs.items() if k != 'media_body'}
+        canonical = json.dumps(self.redactor.walk(kwargs), sort_keys=True, default=str)
+        digest = hashlib.sha256(f"{method}\x1f{canonical}".encode('utf-8')).hexdigest()[:12]
+        with self._lock:
+            self._counts[digest] += 1
+            resource_id = f"{SIMULATED_ID_PREFIX}{digest}-{self._counts[digest]}"
+        body = kwargs.get('body') or {}
+        response = {'id': kwargs.get('id') or kwargs.get('fileId') or resource_id}
+        if 'name' in body:
+            response['name'] = body['name']
+        if method == 'gmail.users.drafts.create':
+            response['message'] = {'id': resource_id, 'threadId': (body.get('message') or {}).get('threadId')}
+        return response
+
+
+def materialize(value):
+    """Response with filler markers expanded into base64 placeholder content."""
+    if isinstance(value, dict):
+        return {k: materialize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [materialize(v) for v in value]
+    if isinstance(value, str) and value.startswith(FILLER_PREFIX):
+        seed, size = value[len(FILLER_PREFIX):].split(':')
+        return base64.urlsafe_b64encode(filler_text(seed, int(size)).encode()).decode()
+    return value
+
+
+def _outcomes(attempts):
+    """Collapses raw HTTP exchanges into per-call outcomes: [status, ms], one per execute() attempt.
+
+    Successful exchanges (including resumable upload chunks) add up to one
+    call; every error answer is a failed attempt of its own.
+    """
+    outcomes, elapsed = [], 0.0
+    for status, ms in attempts:
+        elapsed += ms
+        if status >= 400:
+            outcomes.append([status, round(elapsed, 1)])
+            elapsed = 0.0
+    if elapsed or not outcomes:
+        outcomes.append([200, round(elapsed, 1)])
+    return outcomes
+
+
+class Cassette:
+    """Recorded calls of one run: a header (what was run), the calls and a summary, stored as gzipped JSON lines."""
+
+    def __init__(self, header=None, entries=None, summary=None):
+        self.header = header or {}
+        self.entries = entries or []
+        self.summary = summary or {}
+        self._lock = threading.Lock()
+
+    def add(self, entry):
+        with self._lock:
+            entry['seq'] = len(self.entries)
+            self.entries.append(entry)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+            f.write(json.dumps({'type': 'header', 'version': CASSETTE_VERSION, **self.header}) + "\n")
+            for entry in self.entries:
+                f.write(json.dumps({'type': 'call', **entry}, separators=(',', ':')) + "\n")
+            f.write(json.dumps({'type': 'summary', **self.summary}) + "\n")
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        cassette = cls()
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                kind = record.pop('type', None)
+                if kind == 'header':
+                    cassette.header = record
+                elif kind == 'call':
+                    cassette.entries.append(record)
+                elif kind == 'summary':
+                    cassette.summary = record
+        if cassette.header.get('version') != CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version {cassette.header.get('version')}")
+        return cassette
+
+    def call_stats(self):
+        """Calls per backend and method (each attempt counted, batches once) and failed attempts, as the fakes report them."""
+        stats = CallStats()
+        batches = set()
+        for entry in self.entries:
+            for attempt in entry['attempts']:
+                stats.count(entry['backend'], entry['method'])
+                if attempt[0] >= 400:
+                    stats.fault(entry['backend'], str(attempt[0]))
+            if entry.get('batch') is not None and entry['batch'] not in batches:
+                batches.add(entry['batch'])
+                stats.count(entry['backend'], 'batch')
+            usage = entry.get('usage')
+            if usage:
+                stats.add_tokens(usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+        return stats.report()
+
+
+# --- Recording ---
+
+class _TimedHttp:
+    """Wraps an httplib2-style transport, noting the status and duration of every exchange."""
+
+    def __init__(self, http, attempts):
+        self._http = http
+        self._attempts = attempts
+
+    def request(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            resp, content = self._http.request(*args, **kwargs)
+        except Exception:
+            self._attempts.append((599, (time.perf_counter() - started) * 1000))
+            raise
+        self._attempts.append((int(resp.status), (time.perf_counter() - started) * 1000))
+        return resp, content
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+
+class Recorder:
+    """Collects the calls of one run into a cassette, redacting as they are recorded.
+
+    With `read_only`, writes (WRITE_METHODS) never reach the services: they
+    get a stand-in answer, recorded with no latency.
+    """
+
+    def __init__(self, redactor=None, read_only=True):
+        self.redactor = redactor or Redactor()
+        self.read_only = read_only
+        self.cassette = Cassette()
+        self.started = time.perf_counter()
+        self._batches = 0
+        self._simulator = Simulator(self.redactor)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def offset(self):
+        return round(time.perf_counter() - self.started, 3)
+
+    def next_batch(self):
+        with self._lock:
+            self._batches += 1
+            return self._batches
+
+    def skips(self, method, kwargs):
+        return self.read_only and simulated_call(method, kwargs)
+
+    def simulate(self, backend, method, kwargs, batch=None):
+        """Records and returns a stand-in answer for a call skipped by a read-only recording."""
+        response = self._simulator.answer(method, kwargs)
+        self.record_google(backend, method, kwargs, [[200, 0.0]], response, batch=batch, started=self.offset(),
+                           simulated=True)
+        return response
+
+    def record_google(self, backend, method, kwargs, attempts, response=None, error=None, batch=None, started=None,
+                      simulated=False):
+        if isinstance(response, bytes):
+            # Raw body (a caller-set postproc); a replay serializes the recorded JSON back to bytes
+            response = json.loads(response)
+        self.cassette.add({
+            'backend': backend,
+            'method': method,
+            'key': request_key(method, kwargs, self.redactor),
+            'scoped': any(arg in kwargs for arg in IDENTITY_ARGS),
+            'attempts': attempts,
+            'response': self.redactor.walk(response) if error is None else None,
+            'batch': batch,
+            't': started,
+            **({'simulated': True} if simulated else {}),
+        })
+
+    def record_llm(self, messages, status, ms, response=None, retry_after=None):
+        """Failed attempts are held per thread and attached to the retry of the same prompt that succeeds."""
+        system = next((m['content'] for m in messages if m['role'] == 'system'), '')
+        prompt = "\n".join(m['content'] for m in messages if m['role'] != 'system')
+        held_prompt, pending = getattr(self._local, 'llm_attempts', (None, []))
+        if held_prompt != prompt:
+            pending = []
+        attempt = [status, round(ms, 1)] + ([retry_after] if retry_after is not None else [])
+        if status >= 400:
+            self._local.llm_attempts = (prompt, pending + [attempt])
+            return
+        self._local.llm_attempts = (None, [])
+        purpose = llm_purpose(system, prompt)
+        content = response.choices[0].message.content or ""
+        usage = getattr(response, 'usage', None)
+        self.cassette.add({
+            'backend': 'llm',
+            'method': 'chat.completions.create',
+            'purpose': purpose,
+            'ids': _PROMPT_ID.findall(prompt),
+            'subjects': [self.redactor.subject(s.strip()) for s in _PROMPT_SUBJECT.findall(prompt)],
+            'attempts': pending + [attempt],
+            # Classifications are category names; drafts are written from the email, so only their size is kept
+            'content': filler_text(_letters(self.redactor.salt, content, 16), len(content)) if purpose == 'draft' else content,
+            'usage': {k: getattr(usage, k, 0) or 0 for k in ('prompt_tokens', 'completion_tokens', 'total_tokens')} if usage else None,
+            't': self.offset(),
+        })
+
+
+def llm_purpose(system, prompt):
+    if system.startswith(REPLY_SYSTEM):
+        return 'draft'
+    return 'classify_batch' if 'EMAIL ID:' in prompt else 'classify'
+
+
+def _time_transport(request, attempts):
+    """Times the request's HTTP exchanges; stand-ins without a transport are timed as a whole instead."""
+    if getattr(request, 'http', None) is None:
+        return False
+    request.http = _TimedHttp(request.http, attempts)
+    return True
+
+
+class RecordingRequest:
+    def __init__(self, recorder, backend, request, kwargs):
+        self._recorder = recorder
+        self._backend = backend
+        self._request = request
+        self._kwargs = kwargs
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+    def __setattr__(self, name, value):
+        # e.g. `postproc`, which callers set to get the raw response body
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._request, name, value)
+
+    def execute(self, http=None, num_retries=0):
+        if self._recorder.skips(self._request.methodId, self._kwargs):
+            return self._recorder.simulate(self._backend, self._request.methodId, self._kwargs)
+        attempts = []
+        timed = _time_transport(self._request, attempts)
+        started = self._recorder.offset()
+        began = time.perf_counter()
+        try:
+            response = self._request.execute(http=http, num_retries=num_retries)
+        except Exception as e:
+            outcomes = _outcomes(attempts) if timed else [[0, round((time.perf_counter() - began) * 1000, 1)]]
+            outcomes[-1][0] = status_of(e) or 599
+            self._recorder.record_google(self._backend, self._request.methodId, self._kwargs, outcomes,
+                                         error=e, started=started)
+            raise
+        outcomes = _outcomes(attempts) if timed else [[200, round((time.perf_counter() - began) * 1000, 1)]]
+        self._recorder.record_google(self._backend, self._request.methodId, self._kwargs, outcomes, response,
+                                     started=started)
+        return response
+
+
+class RecordingBatch:
+    """Batch whose sub-requests are each recorded, with the latency of the whole round trip."""
+
+    def __init__(self, recorder, backend, new_batch, callback=None):
+        self._recorder = recorder
+        self._backend = backend
+        self._callback = callback
+        self._batch = new_batch(callback=self._collect)
+        self._requests = []
+        self._simulated = []
+        self._results = {}
+
+    def _collect(self, request_id, response, exception):
+        self._results[request_id] = (response, exception)
+        if self._callback:
+            self._callback(request_id, response, exception)
+
+    def add(self, request, request_id=None):
+        if self._recorder.skips(request._request.methodId, request._kwargs):
+            self._simulated.append((request_id, request))
+            return
+        self._requests.append((request_id, request))
+        self._batch.add(request._request, request_id=request_id)
+
+    def execute(self, http=None):
+        batch = self._recorder.next_batch()
+        for request_id, request in self._simulated:
+            response = self._recorder.simulate(self._backend, request._request.methodId, request._kwargs, batch)
+            if self._callback:
+                self._callback(request_id, response, None)
+        if not self._requests:
+            return None
+        attempts = []
+        timed = all([_time_transport(request._request, attempts) for _, request in self._requests])
+        started = self._recorder.offset()
+        began = time.perf_counter()
+        try:
+            return self._batch.execute(http=http) if http else self._batch.execute()
+        finally:
+            ms = round(sum(ms for _, ms in attempts) if timed else (time.perf_counter() - began) * 1000, 1)
+            for request_id, request in self._requests:
+                if request_id not in self._results:
+                    continue
+                response, exception = self._results[request_id]
+                status = (status_of(exception) or 599) if exception is not None else 200
+                self._recorder.record_google(self._backend, request._request.methodId, request._kwargs, [[status, ms]],
+                                             response, exception, batch=batch, started=started)
+
+
+class RecordingService:
+    """Proxy for a discovery service (or one of its resources) that records every request executed through it."""
+
+    def __init__(self, recorder, backend, target):
+        self._recorder = recorder
+        self._backend = backend
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        if name == 'new_batch_http_request':
+            return lambda callback=None: RecordingBatch(self._recorder, self._backend, attr, callback)
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if isinstance(getattr(result, 'methodId', None), str):
+                return RecordingRequest(self._recorder, self._backend, result, kwargs)
+            return RecordingService(self._recorder, self._backend, result)
+        return call
+
+
+class RecordingLLM:
+    """OpenAI-compatible client proxy that records every completion (and failed attempt)."""
+
+    def __init__(self, recorder, client):
+        self._recorder = recorder
+        self._client = client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, messages=(), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self._client.chat.completions.create(messages=messages, **kwargs)
+        except Exception as e:
+            status = status_of(e)
+            if status:
+                hint = getattr(getattr(e, 'response', None), 'headers', {}) or {}
+                self._recorder.record_llm(messages, status, (time.perf_counter() - started) * 1000,
+                                          retry_after=hint.get('retry-after') if hasattr(hint, 'get') else None)
+            raise
+        self._recorder.record_llm(messages, 200, (time.perf_counter() - started) * 1000, response)
+        return response
+
+
+def _redacted_directives(account, redactor):
+    directives = {}
+    for name in CASSETTE_DIRECTIVES:
+        try:
+            with open(account.directive(name), "r") as f:
+                text = f.read()
+        except FileNotFoundError:
+            continue
+        # Label maps and Drive config hold only IDs and category names; rules and instructions may name people
+        directives[name] = text if name in ("gmail_labels.md", "drive_config.md") else redactor.text(text)
+    return directives
+
+
+def record_backfill(account, query, path, limit=200, actions=False, write=False, lease=None, log=None):
+    """Processes up to `limit` messages matching `query` with the real services, recording every call to `path`.
+
+    The run is a backfill slice over a scratch state folder, so it starts from
+    the same empty state a replay does and the two make the same calls.
+    Unless `write`, nothing is labelled, archived, uploaded or sent (see
+    Recorder). Forwards and reply drafts are only run with `actions`. With a
+    `lease` (gmail_push.SyncLease), the account's live syncs are held off
+    while recording. Returns the cassette's summary, or None if the account
+    is busy.
+    """
+    if lease is not None and not lease.acquire(account.account_id):
+        print(f"{account.account_id} is syncing, try again later.")
+        return None
+    try:
+        return _record_backfill(account, query, path, limit, actions, write, log)
+    finally:
+        if lease is not None:
+            lease.release(account.account_id)
+
+
+def _record_backfill(account, query, path, limit, actions, write, log):
+    scratch = tempfile.mkdtemp(prefix="gmail-bot-record-")
+    with contextlib.redirect_stdout(log or sys.stdout):
+        rules = load_rules(account.directive("gmail_rules.md"))
+    # Header rules need the headers they look at
+    recorder = Recorder(Redactor(headers=rules.header_names() if rules else ()), read_only=not write)
+    probe = RunProbe()
+    run_account = Account(account.account_id, account.email, account.token_env, account.shared_directives_dir, scratch)
+    directives = _redacted_directives(run_account, recorder.redactor)
+    get_clients, get_workers, get_llm = gmail_bot.get_google_clients, gmail_bot.worker_services, gmail_bot.get_llm_client
+
+    def recording_clients(token_json, state_dir=None):
+        creds, gmail, drive = get_clients(token_json, state_dir)
+        return creds, RecordingService(recorder, 'gmail', gmail), RecordingService(recorder, 'drive', drive)
+
+    @contextlib.contextmanager
+    def recording_workers(creds):
+        with get_workers(creds) as (gmail, drive):
+            yield RecordingService(recorder, 'gmail', gmail), RecordingService(recorder, 'drive', drive)
+
+    def recording_llm():
+        client, model = get_llm()
+        return (RecordingLLM(recorder, client) if client else None), model
+
+    try:
+        with environment({"GMAIL_PUBSUB_TOPIC": ""}), patched(
+            gmail_bot,
+            get_google_clients=recording_clients,
+            worker_services=recording_workers,
+            get_llm_client=recording_llm,
+            BACKFILL_SLICE_MESSAGES=limit,
+            BACKFILL_ACTIONS=actions,
+            prepare_email=probe.wrap_start(gmail_bot.prepare_email),
+            act_on_email=probe.wrap_end(gmail_bot.act_on_email),
+        ), contextlib.redirect_stdout(log or sys.stdout):
+            started = time.perf_counter()
+            report = gmail_bot.run_tick(run_account, backfill=new_backfill_state(query))
+            seconds = time.perf_counter() - started
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    cassette = recorder.cassette
+    cassette.header = {
+        'recorded_at': int(time.time()),
+        'mode': 'backfill',
+        'query': recorder.redactor.text(query),
+        'limit': limit,
+        'actions': actions,
+        'read_only': not write,
+        'paced_per_second': gmail_bot.BACKFILL_MESSAGES_PER_SECOND,
+        'directives': directives,
+    }
+    processed = (report or {}).get('processed', 0)
+    cassette.summary = {
+        'processed': processed,
+        'seconds': round(seconds, 2),
+        'msgs_per_s': round(processed / seconds, 2) if seconds else 0.0,
+        'latency_ms': probe.percentiles(),
+        **cassette.call_stats(),
+    }
+    cassette.save(path)
+    print(f"Recorded {len(cassette.entries)} calls for {processed} messages to {path}")
+    return cassette.summary
+
+
+# --- Replay ---
+
+class ReplayMiss(LookupError):
+    """A replayed call the cassette has no answer for: the replay no longer makes the calls that were recorded."""
+
+
+class Player:
+    """Answers replayed calls from a cassette.
+
+    A call gets the next unused recording of the same method and arguments.
+    Calls not naming a specific resource (labels, searches, uploads) fall back
+    to the next unused recording of the method. A repeat beyond what was
+    recorded reuses the last answer; anything else is a miss. Calls a
+    read-only recording answered itself are answered again the same way.
+    """
+
+    def __init__(self, cassette, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.redactor = Redactor(salt=b"")
+        self.read_only = cassette.header.get('read_only', False)
+        self.simulator = Simulator(self.redactor)
+        self.entries = [e for e in cassette.entries
+                        if e['backend'] != 'llm' and not (self.read_only and e.get('simulated'))]
+        self.counts = Counter()
+        self.missed = Counter()
+        self._used = [False] * len(self.entries)
+        self._by_key = defaultdict(deque)
+        self._by_method = defaultdict(deque)
+        self._last = {}
+        self._lock = threading.Lock()
+        for i, entry in enumerate(self.entries):
+            self._by_key[(entry['method'], entry['key'])].append(i)
+            if not entry['scoped']:
+                self._by_method[entry['method']].append(i)
+
+    def _take(self, queue):
+        while queue and self._used[queue[0]]:
+            queue.popleft()
+        if not queue:
+            return None
+        i = queue.popleft()
+        self._used[i] = True
+        return i
+
+    def match(self, method, kwargs):
+        if self.read_only and simulated_call(method, kwargs):
+            response = self.simulator.answer(method, kwargs)
+            with self._lock:
+                self.counts['simulated'] += 1
+            return {'attempts': [[200, 0.0]], 'response': response, 'simulated': True}
+        key = (method, request_key(method, kwargs, self.redactor))
+        with self._lock:
+            i = self._take(self._by_key[key])
+            kind = 'exact'
+            if i is None:
+                i = self._take(self._by_method[method])
+                kind = 'method'
+            if i is None:
+                i = self._last.get(key)
+                kind = 'reused'
+            if i is None:
+                self.counts['missed'] += 1
+                self.missed[method] += 1
+                return None
+            self._last[key] = i
+            self.counts[kind] += 1
+            return self.entries[i]
+
+    def sleep(self, ms, spent=0.0):
+        time.sleep(max(0.0, ms * self.latency_scale / 1000 - spent))
+
+
+class ReplayRequest(FakeRequest):
+    """Plays one recorded call back: its failed attempts in order, then its answer, each after its recorded latency."""
+
+    def __init__(self, service, method_id, kwargs):
+        super().__init__(service, method_id, None)
+        self.kwargs = kwargs
+        self.entry = None
+        self.attempt = 0
+        self.matched = False
+
+    def run_once(self, delay=True):
+        player = self.service.player
+        if not self.matched:
+            self.entry = player.match(self.methodId, self.kwargs)
+            self.matched = True
+        self.service.stats.count(self.service.name, self.methodId)
+        if self.entry is None:
+            raise ReplayMiss(f"no recording of {self.methodId}")
+        attempts = self.entry['attempts']
+        status, ms = attempts[min(self.attempt, len(attempts) - 1)][:2]
+        self.attempt += 1
+        started = time.perf_counter()
+        result = materialize(self.entry['response']) if status < 400 else None
+        if delay:
+            player.sleep(ms, time.perf_counter() - started)
+        if status >= 400:
+            self.service.stats.fault(self.service.name, str(status))
+            raise google_error(status, 'rateLimitExceeded' if status == 429 else 'backendError')
+        if self.postproc is not None:
+            return self.postproc(None, json.dumps(result).encode())
+        return result
+
+
+class ReplayBatch(FakeBatch):
+    def execute(self):
+        # One round trip for the whole batch, as long as the slowest recorded sub-request
+        for _, request in self.requests:
+            request.entry = self.service.player.match(request.methodId, request.kwargs)
+            request.matched = True
+        self.service.stats.count(self.service.name, 'batch')
+        self.service.player.sleep(max((r.entry['attempts'][0][1] for _, r in self.requests if r.entry), default=0.0))
+        for request_id, request in self.requests:
+            try:
+                response = request.run_once(delay=False)
+            except Exception as e:
+                self.callback(request_id, None, e)
+                continue
+            self.callback(request_id, response, None)
+
+
+class ReplayService(FakeService):
+    """Gmail or Drive answering from a cassette, through the real quota scheduler like the other fakes."""
+
+    def __init__(self, name, player, stats=None, scope=REPLAY_SCOPE):
+        super().__init__(name, stats=stats, scope=scope)
+        self.player = player
+
+    def __getattr__(self, name):
+        path = f"{self.name}.{name}"
+
+        def call(**kwargs):
+            return _ReplayNamespace(self, path)
+        return call
+
+    def new_batch_http_request(self, callback=None):
+        return ReplayBatch(self, callback)
+
+
+class _ReplayNamespace:
+    def __init__(self, service, path):
+        self._service = service
+        self._path = path
+
+    def __getattr__(self, name):
+        path = f"{self._path}.{name}"
+
+        def call(**kwargs):
+            # Resources are called without arguments, methods with at least userId or a body
+            if kwargs:
+                return ReplayRequest(self._service, path, kwargs)
+            return _ReplayNamespace(self._service, path)
+        return call
+
+
+class ReplayLLM:
+    """Chat client answering from a cassette.
+
+    Prompts are rebuilt from redacted mail, so they are matched by what they
+    are about rather than by text: classifications by subject,
+    drafts by subject, in recorded order otherwise.
+    """
+
+    def __init__(self, cassette, latency_scale=1.0, stats=None):
+        self.latency_scale = latency_scale
+        self.stats = stats or CallStats()
+        self.counts = Counter()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        # Batch IDs are positions within one request, so answers are keyed by subject pseudonym
+        self._by_subject = defaultdict(deque)
+        self._drafts = defaultdict(deque)
+        self._fifo = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        for entry in (e for e in cassette.entries if e['backend'] == 'llm'):
+            self._fifo[entry['purpose']].append(entry)
+            if entry['purpose'] == 'draft':
+                for subject in entry['subjects'][:1]:
+                    self._drafts[subject.lower()].append(entry)
+            elif entry['purpose'] == 'classify_batch':
+                try:
+                    answers = json.loads(entry['content'])
+                except ValueError:
+                    answers = {}
+                for email_id, subject in zip(entry['ids'], entry['subjects']):
+                    if isinstance(answers, dict) and email_id in answers:
+                        self._by_subject[subject.lower()].append((answers[email_id], entry))
+            else:
+                for subject in entry['subjects'][:1]:
+                    self._by_subject[subject.lower()].append((entry['content'].strip(), entry))
+
+    def _answer(self, subject):
+        """Next recorded answer for a subject; the last one is reused once the queue runs out."""
+        queue = self._by_subject.get(subject)
+        if not queue:
+            return None
+        return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def _match(self, purpose, prompt):
+        """(content, entry) for a prompt, or (None, None)."""
+        subjects = [s.strip().lower() for s in _PROMPT_SUBJECT.findall(prompt)]
+        with self._lock:
+            if purpose == 'classify_batch':
+                answers, timing = {}, None
+                for email_id, subject in zip(_PROMPT_ID.findall(prompt), subjects):
+                    found = self._answer(subject)
+                    if found:
+                        answers[email_id] = found[0]
+                        timing = timing or found[1]
+                if timing is None and self._fifo[purpose]:
+                    timing = self._fifo[purpose][0]
+                self.counts['exact' if answers else 'missed'] += 1
+                return (json.dumps(answers), timing) if answers else (None, None)
+            if purpose == 'draft':
+                queue = self._drafts.get(subjects[0] if subjects else '') or self._fifo[purpose]
+                entry = queue.popleft() if queue else None
+                self.counts['exact' if entry and subjects and entry['subjects'][:1] == subjects[:1] else
+                            'missed' if entry is None else 'method'] += 1
+                return (entry['content'], entry) if entry else (None, None)
+            found = self._answer(subjects[0]) if subjects else None
+            self.counts['exact' if found else 'missed'] += 1
+            return found if found else (None, None)
+
+    def create(self, model=None, messages=(), **kwargs):
+        system = next((m['content'] for m in messages if m['role'] == 'system'), '')
+        prompt = "\n".join(m['content'] for m in messages if m['role'] != 'system')
+        # Retries of the same prompt on this thread continue through the recorded attempts
+        pending = getattr(self._local, 'pending', None)
+        if pending and pending[0] == prompt and pending[3] < len(pending[2]['attempts']):
+            _, content, entry, attempt = pending
+        else:
+            content, entry = self._match(llm_purpose(system, prompt), prompt)
+            attempt = 0
+        self.stats.count('llm', 'chat.completions.create')
+        if entry is None:
+            raise ReplayMiss(f"no recorded {llm_purpose(system, prompt)} answer")
+        status, ms = entry['attempts'][attempt][:2]
+        self._local.pending = (prompt, content, entry, attempt + 1)
+        time.sleep(ms * self.latency_scale / 1000)
+        if status >= 400:
+            self.stats.fault('llm', str(status))
+            retry_after = entry['attempts'][attempt][2] if len(entry['attempts'][attempt]) > 2 else None
+            raise FakeLLMError(status, retry_after)
+        self._local.pending = None
+        usage = entry.get('usage') or {}
+        self.stats.add_tokens(usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(**{k: usage.get(k, 0) for k in ('prompt_tokens', 'completion_tokens', 'total_tokens')})
+        )
+
+
+def write_replay_directives(account, cassette):
+    os.makedirs(account.directives_dir, exist_ok=True)
+    for name, text in cassette.header.get('directives', {}).items():
+        with open(os.path.join(account.directives_dir, name), "w") as f:
+            f.write(text)
+
+
+def run_replay(cassette, latency_scale=1.0, env=None, log=None, profile=None, sampler=None):
+    """Replays a recorded run through the real pipeline. Returns a report like the benchmark's.
+
+    `profile` (a pstats path) wraps the run in cProfile; `sampler` (a
+    StackSampler) samples every thread while it runs.
+    """
+    stats = CallStats()
+    player = Player(cassette, latency_scale)
+    gmail = ReplayService('gmail', player, stats)
+    drive = ReplayService('drive', player, stats)
+    llm = ReplayLLM(cassette, latency_scale, stats)
+    creds = object()
+    probe = RunProbe()
+
+    tmp = tempfile.mkdtemp(prefix="gmail-bot-replay-")
+    account = Account("replay", token_env="GOOGLE_TOKEN_JSON_REPLAY", directives_dir=os.path.join(tmp, "directives"),
+                      state_dir=os.path.join(tmp, "state"))
+    write_replay_directives(account, cassette)
+    header = cassette.header
+    run_env = {"GOOGLE_TOKEN_JSON_REPLAY": "{}", "GMAIL_PUBSUB_TOPIC": ""}
+    run_env.update(env or {})
+    reset_backends()
+    try:
+        with environment(run_env), patched(
+            gmail_bot,
+            get_google_clients=lambda token_json, state_dir=None: (creds, gmail, drive),
+            worker_services=lambda c: contextlib.nullcontext((gmail, drive)),
+            get_llm_client=lambda: (llm, "replay-model"),
+            credentials_scope=lambda c: REPLAY_SCOPE,
+            state_volume=NullVolume(),
+            BACKFILL_SLICE_MESSAGES=header.get('limit', 200),
+            BACKFILL_ACTIONS=header.get('actions', False),
+            BACKFILL_MESSAGES_PER_SECOND=header.get('paced_per_second', gmail_bot.BACKFILL_MESSAGES_PER_SECOND),
+            prepare_email=probe.wrap_start(gmail_bot.prepare_email),
+            act_on_email=probe.wrap_end(gmail_bot.act_on_email),
+        ), open(os.devnull, "w") as devnull, contextlib.redirect_stdout(log or devnull), \
+                (profiled(profile) if profile else contextlib.nullcontext()), (sampler or contextlib.nullcontext()):
+            started = time.perf_counter()
+            report = gmail_bot.run_tick(account, backfill=new_backfill_state(header.get('query', '')))
+            seconds = time.perf_counter() - started
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    processed = (report or {}).get('processed', 0)
+    result = {
+        'processed': processed,
+        'seconds': round(seconds, 2),
+        'msgs_per_s': round(processed / seconds, 2) if seconds else 0.0,
+        'latency_ms': probe.percentiles(),
+        'latency_scale': latency_scale,
+        'matching': {'api': dict(player.counts), 'api_missed': dict(player.missed), 'llm': dict(llm.counts)},
+        'missed': player.counts['missed'] + llm.counts['missed'],
+        'settings': {'env': env or {}},
+    }
+    result.update(stats.report())
+    summary = telemetry.last_summary() or {}
+    result['stages'] = summary.get('stages', {})
+    result['recorded'] = cassette.summary
+    if sampler:
+        result['profile'] = sampler.top()
+    return result
+
+
+def main(argv=None):
+    """Records real Gmail, Drive and LLM traffic to a redacted cassette, or replays one offline."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="process real mail once, recording every call")
+    record.add_argument("--account", default="default")
+    record.add_argument("--after", help="YYYY/MM/DD")
+    record.add_argument("--before", help="YYYY/MM/DD")
+    record.add_argument("--query", help="Gmail search (default: the inbox)")
+    record.add_argument("--limit", type=int, default=200, help="messages to process")
+    record.add_argument("--actions", action="store_true", help="also run forwards and reply drafts")
+    record.add_argument("--write", action="store_true",
+                        help="really label, upload and send (default: writes are skipped and answered locally)")
+    record.add_argument("--directives", default=REPO_DIRECTIVES)
+    record.add_argument("--output", required=True, help="cassette path (.jsonl.gz)")
+
+    replay = commands.add_parser("replay", help="run the pipeline against a cassette")
+    replay.add_argument("cassette")
+    replay.add_argument("--latency-scale", type=float, default=1.0, help="multiply recorded latencies (0 = no waits)")
+    replay.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="extra bot setting for the run")
+    replay.add_argument("--profile", help="write cProfile stats here")
+    replay.add_argument("--sample", help="sample every thread's stack and write folded stacks here")
+    replay.add_argument("--sample-ms", type=float, default=5.0)
+    replay.add_argument("--output", help="write the JSON report here")
+    replay.add_argument("--baseline", help="earlier replay report to compare against")
+    replay.add_argument("--tolerance", type=float, default=0.1, help="allowed regression, as a fraction")
+    replay.add_argument("--verbose", action="store_true", help="show the bot's own log")
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        accounts = {a.account_id: a for a in load_accounts(args.directives, tempfile.gettempdir())}
+        account = accounts.get(args.account)
+        if account is None:
+            print(f"Unknown account {args.account}", file=sys.stderr)
+            return 1
+        query = build_backfill_query(args.after, args.before, args.query)
+        # Writes race the deployed bot's syncs, so they need its lease (and Modal credentials)
+        lease = SyncLease(gmail_bot.push_state, lease_seconds=gmail_bot.RECORD_TIMEOUT_SECONDS) if args.write else None
+        summary = record_backfill(account, query, args.output, args.limit, args.actions, args.write, lease, log=sys.stderr)
+        print(json.dumps(summary, indent=2))
+        return 0 if summary is not None else 1
+
+    env = dict(item.split("=", 1) for item in args.env)
+    sampler = StackSampler(args.sample_ms / 1000) if args.sample else None
+    report = run_replay(Cassette.load(args.cassette), args.latency_scale, env,
+                        log=sys.stderr if args.verbose else None, profile=args.profile, sampler=sampler)
+    if sampler:
+        sampler.write_folded(args.sample)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+    if report['missed']:
+        print(f"Error: {report['missed']} calls had no recording; the cassette no longer matches the pipeline.",
+              file=sys.stderr)
+        return 1
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare_reports(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Regression: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions against baseline.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
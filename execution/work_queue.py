@@ -0,0 +1,184 @@
+import json
+import time
+import sqlite3
+import threading
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_LEASE_SECONDS = 600
+DONE_RETENTION_SECONDS = 30 * 24 * 3600
+
+
+class WorkItem:
+    """Checkpoint view of one message: its stored category and completed side effects."""
+
+    def __init__(self, queue, msg_id, category=None, effects=()):
+        self.queue = queue
+        self.msg_id = msg_id
+        self.category = category
+        self.effects = set(effects)
+
+    def done(self, effect):
+        return effect in self.effects
+
+    def record(self, effect):
+        self.effects.add(effect)
+        self.queue.record_effect(self.msg_id, effect)
+
+
+class WorkQueue:
+    """Durable per-message pipeline state in SQLite (WAL), keyed by Gmail message ID.
+
+    Messages are enqueued as soon as sync sees them, so the history cursor can
+    move on safely. A tick claims messages under a lease, which lets
+    overlapping ticks run without processing the same message twice. The
+    category and each non-idempotent side effect (forward, draft, attachments)
+    are checkpointed, so a rerun resumes instead of repeating them. A message
+    that fails `max_attempts` times is quarantined. Each message remembers
+    whether live sync or a backfill queued it, so each retries only its own.
+    """
+
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " msg_id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            " stage TEXT NOT NULL DEFAULT 'queued',"
+            " category TEXT,"
+            " effects TEXT NOT NULL DEFAULT '[]',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT,"
+            " lease_owner TEXT,"
+            " lease_until REAL NOT NULL DEFAULT 0,"
+            " updated_at REAL NOT NULL,"
+            " origin TEXT NOT NULL DEFAULT 'live')"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)")]
+        if 'origin' not in columns:
+            self._conn.execute("ALTER TABLE messages ADD COLUMN origin TEXT NOT NULL DEFAULT 'live'")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_status ON messages (status, lease_until)")
+        self._conn.execute(
+            "DELETE FROM messages WHERE status = 'done' AND updated_at < ?",
+            (time.time() - DONE_RETENTION_SECONDS,)
+        )
+        self._conn.commit()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            self._conn.commit()
+            return cursor
+
+    def enqueue(self, msg_ids, origin='live'):
+        """Adds new messages. `origin` is 'live' or 'backfill'; live sync takes over a message a backfill also queued."""
+        now = time.time()
+        upsert = " ON CONFLICT (msg_id) DO UPDATE SET origin = 'live' WHERE status = 'pending'" if origin == 'live' else \
+            " ON CONFLICT (msg_id) DO NOTHING"
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO messages (msg_id, updated_at, origin) VALUES (?, ?, ?)" + upsert,
+                [(msg_id, now, origin) for msg_id in msg_ids]
+            )
+            self._conn.commit()
+
+    def pending_ids(self, origin='live', limit=500):
+        """Unfinished messages of one origin from earlier ticks whose lease has lapsed."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT msg_id FROM messages WHERE status = 'pending' AND origin = ? AND lease_until < ?"
+                " ORDER BY updated_at LIMIT ?",
+                (origin, time.time(), limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def claim(self, msg_ids, owner):
+        """Leases the given messages to `owner`. Returns the IDs actually claimed, in order."""
+        claimed = []
+        now = time.time()
+        with self._lock:
+            for msg_id in dict.fromkeys(msg_ids):
+                row = self._conn.execute(
+                    "SELECT status, attempts, lease_until FROM messages WHERE msg_id = ?", (msg_id,)
+                ).fetchone()
+                if not row or row[0] != 'pending' or row[2] >= now:
+                    continue
+                if row[1] >= self.max_attempts:
+                    self._conn.execute(
+                        "UPDATE messages SET status = 'quarantined', updated_at = ? WHERE msg_id = ?", (now, msg_id)
+                    )
+                    print(f"Quarantined {msg_id} after {row[1]} failed attempts.")
+                    continue
+                updated = self._conn.execute(
+                    "UPDATE messages SET lease_owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?"
+                    " WHERE msg_id = ? AND status = 'pending' AND lease_until < ?",
+                    (owner, now + self.lease_seconds, now, msg_id, now)
+                ).rowcount
+                if updated:
+                    claimed.append(msg_id)
+            self._conn.commit()
+        return claimed
+
+    def item(self, msg_id):
+        with self._lock:
+            row = self._conn.execute("SELECT category, effects FROM messages WHERE msg_id = ?", (msg_id,)).fetchone()
+        if not row:
+            return WorkItem(self, msg_id)
+        return WorkItem(self, msg_id, row[0], json.loads(row[1]))
+
+    def set_category(self, msg_id, category):
+        self._execute(
+            "UPDATE messages SET category = ?, stage = 'classified', updated_at = ? WHERE msg_id = ?",
+            (category, time.time(), msg_id)
+        )
+
+    def record_effect(self, msg_id, effect):
+        with self._lock:
+            row = self._conn.execute("SELECT effects FROM messages WHERE msg_id = ?", (msg_id,)).fetchone()
+            effects = set(json.loads(row[0])) if row else set()
+            effects.add(effect)
+            self._conn.execute(
+                "UPDATE messages SET effects = ?, updated_at = ? WHERE msg_id = ?",
+                (json.dumps(sorted(effects)), time.time(), msg_id)
+            )
+            self._conn.commit()
+
+    def set_stage(self, msg_id, stage):
+        self._execute("UPDATE messages SET stage = ?, updated_at = ? WHERE msg_id = ?", (stage, time.time(), msg_id))
+
+    def complete(self, msg_ids):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE messages SET status = 'done', stage = 'done', lease_owner = NULL, lease_until = 0,"
+                " last_error = NULL, updated_at = ? WHERE msg_id = ?",
+                [(now, msg_id) for msg_id in msg_ids]
+            )
+            self._conn.commit()
+
+    def fail(self, msg_id, error):
+        """Releases the lease so a later tick retries; the claim already counted the attempt."""
+        self._execute(
+            "UPDATE messages SET last_error = ?, lease_owner = NULL, lease_until = 0, updated_at = ? WHERE msg_id = ?",
+            (str(error)[:500], time.time(), msg_id)
+        )
+
+    def release(self, owner):
+        """Drops any lease `owner` still holds, e.g. messages that never reached the end of the pipeline."""
+        self._execute(
+            "UPDATE messages SET lease_owner = NULL, lease_until = 0 WHERE lease_owner = ? AND status = 'pending'",
+            (owner,)
+        )
+
+    def stats(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM messages GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()